@@ -0,0 +1,153 @@
+# backend/answer_cache.py
+"""
+简单查询的答案缓存
+
+动态路由中被判定为 Easy 的查询只依据问题本身作答（不携带上下文），相同或几乎相同的问题可以直接复用答案，
+省去复杂度分类和 deepseek-chat 两次 API 调用。
+
+- 查询先做归一化（NFKC、去除标点空白和"请问"等客套词）后精确匹配
+- 设置 ANSWER_CACHE_SIMILARITY 后，未精确命中时通过字符二元组倒排索引查找 Jaccard 相似度不低于阈值的近似问题；
+  两个问题中有连续两个及以上的字不同（如"含义"/"出处"、"史记"/"汉书"）时视为不同的问题
+- 缓存项有 TTL，条目数超过上限时按 LRU 淘汰
+"""
+import difflib
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+
+from metrics import CACHE_REQUESTS
+
+# 缓存条目数上限
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+# 缓存有效期（秒）
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))
+# 近似匹配的最低 Jaccard 相似度，0 表示只做精确匹配（默认）；短问题中一两个字的差别往往意味着不同的问题
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
+# 近似匹配允许的最长连续不同字数
+ANSWER_CACHE_MAX_DIFF_RUN = 1
+
+# 不影响问题含义的客套词
+FILLER_PATTERN = re.compile(r"^(请问一下|请问|请教一下|请教|想问一下|问一下|你好|您好)+|(呢|呀|啊|吗)$")
+# 标点、符号和空白
+IGNORABLE_PATTERN = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize_query(query):
+    """归一化查询：全角转半角、小写、去除标点空白和客套词"""
+    text = unicodedata.normalize("NFKC", query).lower()
+    text = IGNORABLE_PATTERN.sub("", text)
+    return FILLER_PATTERN.sub("", text) or text
+
+
+def char_ngrams(text, n=2):
+    """字符 n-gram 集合；不足 n 个字符时以整个文本作为唯一元素"""
+    if len(text) < n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def differs_only_slightly(a, b, max_run=ANSWER_CACHE_MAX_DIFF_RUN):
+    """
+    两个归一化查询的不同之处是否都不超过 max_run 个连续的字（增、删、改）
+
+    >>> differs_only_slightly("解释一下论语中学而时习之这句话的含义", "解释一下论语中学而时习之这句话的出处")
+    False
+    >>> differs_only_slightly("汉书中司马迁是如何评价项羽的", "史记中司马迁是如何评价项羽的")
+    False
+    >>> differs_only_slightly("论语的作者是谁", "论语作者是谁")
+    True
+    """
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag != "equal" and max(i2 - i1, j2 - j1) > max_run:
+            return False
+    return True
+
+
+class AnswerCache:
+    """精确匹配 + 字符二元组相似度匹配的答案缓存"""
+
+    def __init__(self, max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl=ANSWER_CACHE_TTL,
+                 similarity=ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries = OrderedDict()  # 归一化查询 -> (写入时间, 答案, 模型, 二元组集合)
+        self._index = defaultdict(set)  # 二元组 -> 归一化查询集合
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        for gram in entry[3]:
+            keys = self._index[gram]
+            keys.discard(key)
+            if not keys:
+                del self._index[gram]
+
+    def _expired(self, entry, now):
+        return self.ttl and now - entry[0] > self.ttl
+
+    def _find_similar(self, query_key, grams, now):
+        """通过倒排索引统计共有二元组数，返回相似度最高、达到阈值且只有个别字不同的缓存键"""
+        if not self.similarity:
+            return None, 0.0
+        shared = defaultdict(int)
+        for gram in grams:
+            for key in self._index.get(gram, ()):
+                shared[key] += 1
+
+        best_key, best_score = None, self.similarity
+        for key, count in shared.items():
+            entry = self._entries[key]
+            score = count / (len(grams) + len(entry[3]) - count)
+            if (score >= best_score and not self._expired(entry, now)
+                    and differs_only_slightly(query_key, key)):
+                best_key, best_score = key, score
+        return best_key, best_score
+
+    def get(self, query):
+        """查找缓存的答案，返回 (答案, 模型, 相似度) 或 None"""
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                self._remove(key)
+                entry = None
+            score = 1.0
+            if entry is None:
+                key, score = self._find_similar(key, char_ngrams(key), now)
+                entry = self._entries.get(key) if key else None
+            if entry is None:
+                CACHE_REQUESTS.inc(cache="easy_answer", result="miss")
+                return None
+            self._entries.move_to_end(key)
+            CACHE_REQUESTS.inc(cache="easy_answer", result="hit")
+            return entry[1], entry[2], score
+
+    def put(self, query, answer, model):
+        key = normalize_query(query)
+        if not key or not answer:
+            return
+        grams = char_ngrams(key)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time(), answer, model, grams)
+            for gram in grams:
+                self._index[gram].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+answer_cache = AnswerCache()
@@ -1,10 +1,20 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, g, Response
 from flask_cors import CORS
-from routes.ner_routes import ner_bp
+from routes.ner_routes import ner_bp, process_text
 from routes.chat_routes import chat_bp
 from routes.auth_routes import auth_bp
+from routes.usage_routes import usage_bp
+from profiling import profile_bp
 from database.models import db
+import database.sqlite_config  # noqa: F401  为 SQLite 连接设置 WAL 等 PRAGMA
+from migrations.runner import run_migrations
+from database.write_behind import chat_writer
+from llm_usage import persist_pending_usage
+from rate_limit import limiter
+from ner_jobs import ner_job_queue
+from metrics import REGISTRY, CONTENT_TYPE_LATEST, HTTP_REQUESTS, HTTP_REQUEST_SECONDS
 import os
+import time
 
 app = Flask(__name__)
 
@@ -27,9 +37,11 @@ if not os.path.exists(db_dir):
 
 # 数据库配置
 db_path = os.path.join(db_dir, 'app.db')
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', f'sqlite:///{db_path}')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key')
+# 聊天记录后台批量写入（默认关闭，每轮对话在响应前以一个事务同步写入）
+app.config['CHAT_WRITE_BEHIND'] = os.getenv('CHAT_WRITE_BEHIND', '0').lower() in ('1', 'true', 'yes')
 
 # 初始化数据库
 db.init_app(app)
@@ -39,14 +51,28 @@ with app.app_context():
     try:
         db.create_all()
         print("数据库表创建成功")
+        applied = run_migrations(db.engine)
+        if applied:
+            print(f"已执行数据库迁移: {applied}")
     except Exception as e:
         print(f"创建数据库表时出错: {str(e)}")
 
+# 启动聊天记录后台写入线程（仅在开启 CHAT_WRITE_BEHIND 时）
+chat_writer.init_app(app)
+
+# 限流与准入控制
+limiter.init_app(app)
+
+# NER 文件后台任务的工作线程（进程重启后继续处理中断的任务）
+ner_job_queue.init_app(app, process_text)
+
 
 # 注册路由
 app.register_blueprint(ner_bp, url_prefix="/api")
 app.register_blueprint(chat_bp, url_prefix="/api")
 app.register_blueprint(auth_bp, url_prefix="/api/auth")
+app.register_blueprint(profile_bp, url_prefix="/api")
+app.register_blueprint(usage_bp, url_prefix="/api")
 
 # 在创建Flask app后添加
 app.config['JSON_AS_ASCII'] = False  # 确保JSON响应不使用ASCII编码
@@ -63,6 +89,32 @@ app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
 #         response.headers.add('Access-Control-Allow-Credentials', 'true')
 #     return response
 
+# 请求级指标
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # 使用路由规则而不是实际路径，避免标签基数膨胀
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.after_request
+def record_llm_usage(response):
+    # 写入本次请求中尚未随对话保存的大模型调用记录（如 NER 修正、实体解析）
+    persist_pending_usage()
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """以 Prometheus 文本格式输出指标"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE_LATEST)
+
 @app.route('/')
 def home():
     return "CS4ACNER Backend Service is Running!"
@@ -0,0 +1,17 @@
+# backend/asgi.py
+"""
+异步服务入口（说明见 async_server.py）
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 2
+"""
+from app import app
+from async_server import AsyncApp
+from routes.chat_routes import chat_async
+from routes.ner_routes import ner_async, entity_analysis_async
+
+# Flask 端点 -> 协程处理函数；等待大模型时间较长的接口走协程，其余接口仍由 Flask 视图处理
+application = AsyncApp(app, {
+    "chat.chat": chat_async,
+    "ner.ner": ner_async,
+    "ner.entity_analysis": entity_analysis_async,
+})
@@ -0,0 +1,136 @@
+# backend/async_llm.py
+"""
+异步大模型客户端（异步服务模式使用，见 async_server.py）
+
+utils.py、chat_routes.py、ner_routes.py 中的同步调用在等待大模型回复期间会占住整个 worker 线程；
+这里的协程版本基于 AsyncOpenAI 和 httpx.AsyncClient，同一个事件循环可以同时挂起大量等待中的调用。
+提示词、结果解析和用量记录与同步版本共用。
+"""
+import asyncio
+import logging
+import os
+
+import httpx
+from openai import AsyncOpenAI
+
+import utils
+from utils import (
+    DEEPSEEK_API_KEY,
+    DEEPSEEK_BASE_URL,
+    classify_messages,
+    parse_complexity,
+    traditional_culture_messages,
+    logical_analysis_messages
+)
+from metrics import CHAT_STAGE_SECONDS
+from llm_usage import track_llm_call
+
+logger = logging.getLogger(__name__)
+
+# 每个事件循环（即每个 worker 进程）与上游保持的最大连接数
+ASYNC_LLM_MAX_CONNECTIONS = int(os.getenv("ASYNC_LLM_MAX_CONNECTIONS", "1000"))
+# 空闲时保留的长连接数
+ASYNC_LLM_MAX_KEEPALIVE = int(os.getenv("ASYNC_LLM_MAX_KEEPALIVE", "100"))
+
+
+class AsyncLLMClients:
+    """按事件循环惰性创建的异步客户端（连接池不能跨事件循环使用）"""
+
+    def __init__(self):
+        self._loop = None
+        self._openai = None
+        self._http = None
+
+    def _ensure(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            limits = httpx.Limits(
+                max_connections=ASYNC_LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_LLM_MAX_KEEPALIVE
+            )
+            self._http = httpx.AsyncClient(limits=limits, timeout=150)
+            self._openai = AsyncOpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL, timeout=150)
+            self._loop = loop
+
+    @property
+    def openai(self):
+        self._ensure()
+        return self._openai
+
+    @property
+    def http(self):
+        self._ensure()
+        return self._http
+
+    async def aclose(self):
+        if self._loop is not None:
+            await self._http.aclose()
+            await self._openai.close()
+            self._loop = self._openai = self._http = None
+
+
+clients = AsyncLLMClients()
+
+
+async def post_json(url, headers, payload, timeout):
+    """发起 JSON POST 请求（对应同步代码中的 requests.post）"""
+    return await clients.http.post(url, headers=headers, json=payload, timeout=timeout)
+
+
+async def create_chat_completion(route, stage, model, messages, **kwargs):
+    """调用 chat completions 接口，并记录阶段耗时和用量"""
+    with CHAT_STAGE_SECONDS.time(stage=stage), track_llm_call(route, model) as call:
+        response = await clients.openai.chat.completions.create(model=model, messages=messages, **kwargs)
+        call.record(response.usage)
+    return response
+
+
+async def classify_input_complexity(query: str) -> str:
+    """utils.classify_input_complexity 的协程版本"""
+    if not utils.DEEPSEEK_AVAILABLE:
+        logger.warning("DeepSeek不可用，默认返回'hard'")
+        return "hard"
+
+    try:
+        response = await create_chat_completion(
+            "classify", "classify", "deepseek-chat", classify_messages(query),
+            temperature=0, max_tokens=5
+        )
+        return parse_complexity(response.choices[0].message.content)
+    except Exception as e:
+        logger.error(f'分类过程发生错误: {str(e)}')
+        return 'hard'
+
+
+async def process_with_traditional_culture_view(query: str) -> str:
+    """utils.process_with_traditional_culture_view 的协程版本"""
+    if not utils.DEEPSEEK_AVAILABLE:
+        return "DeepSeek模型不可用，请检查API密钥和网络连接"
+
+    try:
+        response = await create_chat_completion(
+            "auxiliary_a", "auxiliary_a", "deepseek-chat", traditional_culture_messages(query),
+            temperature=0.7, max_tokens=1024
+        )
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        error_msg = str(e).encode('utf-8', errors='replace').decode('utf-8')
+        logger.error(f"传统文化视角处理错误: {error_msg}")
+        return f"处理错误: {error_msg}"
+
+
+async def process_with_deepseek(query: str) -> str:
+    """utils.process_with_deepseek 的协程版本"""
+    if not utils.DEEPSEEK_AVAILABLE:
+        return "DeepSeek模型不可用，请检查API密钥和网络连接"
+
+    try:
+        response = await create_chat_completion(
+            "auxiliary_b", "auxiliary_b", "deepseek-chat", logical_analysis_messages(query),
+            temperature=0.7, max_tokens=1024
+        )
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        error_msg = str(e).encode('utf-8', errors='replace').decode('utf-8')
+        logger.error(f"DeepSeek模型处理错误: {error_msg}")
+        return f"DeepSeek模型处理错误: {error_msg}"
@@ -0,0 +1,242 @@
+# backend/async_server.py
+"""
+异步服务模式（ASGI）
+
+同步部署中每个请求占用一个 worker 线程，复杂问题路由一次要等待大模型一分钟以上，
+少量慢对话就会占满全部 worker。异步模式下：
+
+- 注册了协程版本的接口（见 asgi.py）在事件循环中处理，等待大模型回复时只挂起协程，
+  少量 worker 进程即可同时保持成百上千个进行中的大模型调用
+- JWT 校验、限流、数据库读写等短小的阻塞操作通过 run_sync 放到线程池中执行；BERT 推理使用单独的推理线程池
+- 协程中可以照常使用 flask.request、flask.g、jsonify 和 db.session：每个请求在自己的 asyncio 任务中
+  压入 Flask 请求上下文，asyncio.to_thread 会把上下文一并带入线程池
+- before_request / after_request 钩子（CORS、请求指标、用量写入）与限流规则同 WSGI 部署一致，
+  接口路径、请求和响应格式不变
+- 其余接口（含 OPTIONS 预检和文件上传）原样交给 Flask 应用，经 asgiref 在线程池中执行
+- 客户端在等待期间断开时取消对应的协程，不再继续等待上游回复
+- 流式响应（如 SSE）的响应体在单独的线程中逐块迭代并发送；客户端断开时停止迭代并关闭响应体生成器
+
+暂不支持的功能：协程版本的接口不做 cProfile 请求级分析（X-Profile），需要时使用 WSGI 部署。
+"""
+import asyncio
+import io
+import logging
+import sys
+import threading
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import HTTPException
+
+import async_llm
+from rate_limit import limiter
+
+logger = logging.getLogger(__name__)
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    在线程池中执行使用请求上下文的阻塞调用
+    所在任务被取消（客户端断开）时仍等待调用执行完毕再抛出 CancelledError，
+    避免线程还在读写 db.session 时请求上下文已被弹出
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait({future})
+        raise
+
+
+async def _read_body(receive):
+    """读取完整的请求体；客户端提前断开时返回 None"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+def build_environ(scope, body):
+    """由 ASGI scope 和请求体构造 WSGI environ，供 Flask 请求上下文使用"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("127.0.0.1", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsyncApp:
+    """
+    ASGI 应用：按 Flask 端点名把请求分发给协程处理函数，未注册的端点交给 Flask 应用本身
+    async_views 形如 {"chat.chat": chat_async}，协程处理函数的返回值与 Flask 视图相同
+    """
+
+    def __init__(self, flask_app, async_views):
+        self.flask_app = flask_app
+        self.async_views = dict(async_views)
+        self.wsgi = WsgiToAsgi(flask_app)
+
+    def _match(self, scope):
+        """返回请求对应的协程处理函数和 Flask 视图，不存在时返回 None"""
+        if not self.async_views:
+            return None
+        adapter = self.flask_app.url_map.bind("localhost", script_name=scope.get("root_path") or None)
+        try:
+            endpoint, _ = adapter.match(scope["path"], method=scope["method"])
+        except HTTPException:
+            return None
+        handler = self.async_views.get(endpoint)
+        if handler is None:
+            return None
+        return handler, self.flask_app.view_functions[endpoint]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        matched = self._match(scope) if scope["type"] == "http" else None
+        if matched is None:
+            await self.wsgi(scope, receive, send)
+            return
+
+        body = await _read_body(receive)
+        if body is None:
+            return
+        handler, view = matched
+        task = asyncio.ensure_future(self._dispatch(scope, body, handler, view))
+        disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+        done, _ = await asyncio.wait({task, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        if task not in done:
+            # 客户端已断开，取消仍在等待的上游调用
+            logger.info(f"客户端断开，取消请求: {scope['method']} {scope['path']}")
+            task.cancel()
+            return
+        response = task.result()
+        if response.is_streamed:
+            await self._stream_response(send, response, disconnect)
+            return
+        disconnect.cancel()
+        await self._send_response(send, response)
+
+    async def _dispatch(self, scope, body, handler, view):
+        """在 Flask 请求上下文中执行协程处理函数，返回 Flask 响应对象"""
+        app = self.flask_app
+        ctx = app.request_context(build_environ(scope, body))
+        ctx.push()
+        try:
+            try:
+                rv = await run_sync(app.preprocess_request)
+                if rv is None:
+                    # 与同步视图上的 @limiter.limit 使用同一限额
+                    rate_limit = getattr(view, "rate_limit", None)
+                    if rate_limit is not None:
+                        rv = await run_sync(limiter.check, **rate_limit)
+                if rv is None:
+                    rv = await handler()
+                response = app.make_response(rv)
+            except Exception as e:
+                response = app.make_response(await run_sync(app.handle_user_exception, e))
+            return await run_sync(app.process_response, response)
+        except Exception as e:
+            return app.make_response(await run_sync(app.handle_exception, e))
+        finally:
+            ctx.pop()
+
+    @staticmethod
+    async def _send_response(send, response):
+        headers = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in response.headers.items()
+        ]
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": response.get_data()})
+
+    @staticmethod
+    async def _stream_response(send, response, disconnect):
+        """
+        逐块发送流式响应。响应体（通常由 stream_with_context 包装）需要在同一个线程中迭代和关闭，
+        因此在单独的线程中迭代，通过队列交给事件循环发送；客户端断开时，该线程在下一块数据到达时
+        停止迭代并关闭响应体（生成器中的 finally 随即关闭上游连接）
+        """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        stopped = threading.Event()
+
+        def produce():
+            try:
+                for chunk in response.iter_encoded():
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            except Exception:
+                logger.exception("流式响应生成失败")
+            finally:
+                response.close()
+                loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+        producer = asyncio.ensure_future(asyncio.to_thread(produce))
+        headers = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in response.headers.items()
+        ]
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+        try:
+            while True:
+                chunk = asyncio.ensure_future(chunks.get())
+                done, _ = await asyncio.wait({chunk, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+                if chunk not in done:
+                    chunk.cancel()
+                    logger.info("客户端断开，停止流式响应")
+                    return
+                if chunk.result() is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk.result(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+            await producer
+        finally:
+            stopped.set()
+            disconnect.cancel()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await async_llm.clients.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
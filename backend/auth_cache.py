@@ -0,0 +1,192 @@
+# backend/auth_cache.py
+"""
+JWT 校验与用户记录缓存
+
+每个需要登录的请求原本都要做一次 HS256 签名校验，再按 user_id 查询一次 SQLite。
+这里缓存两类结果：
+
+- 已校验的 token：以 token 的 SHA-256 摘要为键，记录 user_id；缓存项在 token 的 exp 时刻失效，
+  过期的 token 会重新走 jwt.decode 并照常返回 "token已过期"
+- 用户记录：按 user_id 缓存各列的值，有 TTL；命中时以 merge(load=False) 放入当前会话，
+  视图中对 current_user 的修改照常提交
+
+用户记录通过 ORM 更新或删除时（在 flush 时和提交后各清理一次）清除对应的用户缓存；
+修改密码或删除用户时同时清除该用户的全部 token 缓存。缓存是进程内的，
+多进程部署时其他进程的修改最多在 USER_CACHE_TTL 秒后生效；绕过 ORM 的批量 UPDATE/DELETE 不会触发清理。
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from database.models import User, db
+from metrics import REGISTRY, CACHE_REQUESTS
+
+# 已校验 token 的缓存条目数上限
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+# 用户记录的缓存条目数上限
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+# 用户记录缓存的有效期（秒），0 表示不缓存
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+AUTH_CACHE_INVALIDATIONS = REGISTRY.counter(
+    "auth_cache_invalidations_total", "认证缓存清理次数", ("cache", "reason"))
+
+
+def token_key(token):
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+class TokenCache:
+    """已校验 token 的 LRU 缓存，缓存项在 token 过期时失效"""
+
+    def __init__(self, max_entries=TOKEN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # token 摘要 -> (user_id, exp 时间戳)
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """返回 token 对应的 user_id；未命中或已过期时返回 None"""
+        key = token_key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                CACHE_REQUESTS.inc(cache="jwt_token", result="miss")
+                return None
+            self._entries.move_to_end(key)
+        CACHE_REQUESTS.inc(cache="jwt_token", result="hit")
+        return entry[0]
+
+    def put(self, token, user_id, exp):
+        """缓存校验通过的 token；没有 exp 的 token 不缓存"""
+        if not self.max_entries or exp is None:
+            return
+        with self._lock:
+            self._entries[token_key(token)] = (user_id, float(exp))
+            self._entries.move_to_end(token_key(token))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id, reason):
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry[0] == user_id]
+            for key in keys:
+                del self._entries[key]
+        if keys:
+            AUTH_CACHE_INVALIDATIONS.inc(len(keys), cache="jwt_token", reason=reason)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class UserCache:
+    """按 user_id 缓存用户记录各列的值（TTL + LRU）"""
+
+    def __init__(self, max_entries=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (加载时间, 列值字典)
+        self._lock = threading.Lock()
+        self._columns = [attr.key for attr in inspect(User).column_attrs]
+
+    def _get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[user_id]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+        return entry[1] if entry is not None else None
+
+    def _put(self, user):
+        values = {key: getattr(user, key) for key in self._columns}
+        with self._lock:
+            self._entries[user.id] = (time.monotonic(), values)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def load(self, user_id):
+        """返回当前会话中的 User 对象，用户不存在时返回 None"""
+        if not self.ttl or not self.max_entries:
+            return db.session.get(User, user_id)
+
+        values = self._get(user_id)
+        if values is None:
+            CACHE_REQUESTS.inc(cache="auth_user", result="miss")
+            user = db.session.get(User, user_id)
+            if user is not None:
+                self._put(user)
+            return user
+
+        CACHE_REQUESTS.inc(cache="auth_user", result="hit")
+        snapshot = User.__mapper__.class_manager.new_instance()
+        for key, value in values.items():
+            setattr(snapshot, key, value)
+        make_transient_to_detached(snapshot)
+        return db.session.merge(snapshot, load=False)
+
+    def invalidate(self, user_id, reason):
+        with self._lock:
+            removed = self._entries.pop(user_id, None)
+        if removed is not None:
+            AUTH_CACHE_INVALIDATIONS.inc(cache="auth_user", reason=reason)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache()
+user_cache = UserCache()
+
+
+def invalidate_user(user_id, reason, tokens=False):
+    """清除用户记录缓存；tokens 为 True 时同时清除该用户的全部 token 缓存"""
+    user_cache.invalidate(user_id, reason)
+    if tokens:
+        token_cache.invalidate_user(user_id, reason)
+
+
+def _defer_invalidation(target, reason, tokens):
+    """flush 时立即清理一次，并在事务提交后再清理一次，
+    以免其他请求在 flush 与提交之间把旧记录重新放回缓存"""
+    invalidate_user(target.id, reason, tokens)
+    session = Session.object_session(target)
+    if session is not None:
+        pending = session.info.setdefault("auth_cache_pending", {})
+        _, pending_tokens = pending.get(target.id, (None, False))
+        pending[target.id] = (reason, tokens or pending_tokens)
+
+
+@event.listens_for(User, "after_update")
+def _user_updated(mapper, connection, target):
+    password_changed = inspect(target).attrs.password_hash.history.has_changes()
+    reason = "password_change" if password_changed else "update"
+    _defer_invalidation(target, reason, tokens=password_changed)
+
+
+@event.listens_for(User, "after_delete")
+def _user_deleted(mapper, connection, target):
+    _defer_invalidation(target, "delete", tokens=True)
+
+
+@event.listens_for(Session, "after_commit")
+def _session_committed(session):
+    pending = session.info.pop("auth_cache_pending", None)
+    for user_id, (reason, tokens) in (pending or {}).items():
+        invalidate_user(user_id, reason, tokens)
+
+
+@event.listens_for(Session, "after_rollback")
+def _session_rolled_back(session):
+    session.info.pop("auth_cache_pending", None)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+/api/chat 端到端压力测试
+
+按设定的简单/复杂查询比例回放对话，测量动态路由流程、数据库写入和并发上限，
+大模型调用全部由本地 DeepSeek 替身服务应答，不消耗真实 API 额度。
+
+默认在进程内启动替身服务，并以临时 SQLite 数据库加载 Flask 应用；
+也可以通过 --url 压测已启动的后端（此时后端需设置 DEEPSEEK_BASE_URL 指向替身服务）。
+
+用法示例：
+    python benchmarks/chat_load_test.py --users 20 --turns 5 --hard-ratio 0.3 \\
+        --latency lognormal:-0.5,0.4 --latency deepseek-reasoner=uniform:3,8
+    python benchmarks/deepseek_stub.py --port 8900 &
+    DEEPSEEK_BASE_URL=http://127.0.0.1:8900/v1 python app.py &
+    python benchmarks/chat_load_test.py --url http://127.0.0.1:5000 --users 50
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# 添加 backend 目录到路径，使能够正确导入模块
+sys.path.append(BACKEND_DIR)
+
+from benchmarks.deepseek_stub import DeepSeekStubServer, parse_latency_specs
+from benchmarks.ner_benchmark import percentile, peak_rss_mb
+
+# 简单查询：定义、常识类问题
+EASY_QUERIES = [
+    "什么是仁",
+    "子曰是什么意思",
+    "《论语》的作者是谁",
+    "学而时习之的出处",
+    "孔子是哪国人",
+    "桂枝汤由哪些药材组成",
+    "足三里穴在什么位置",
+    "伤寒论是谁写的",
+]
+
+# 复杂查询：替身服务会将包含"分析""比较""为什么"等关键词的查询判为 Hard
+HARD_QUERIES = [
+    "比较孔子与孟子仁政思想的异同",
+    "分析王安石变法失败的原因",
+    "为什么说项羽是悲剧英雄",
+    "如何理解《伤寒论》中的六经辨证",
+    "论述汉代察举制对后世的影响",
+    "评价司马迁在《史记》中的叙事手法",
+]
+
+
+class InProcessClient:
+    """通过 Flask test client 调用应用"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, payload=None):
+        client = self.app.test_client()
+        response = client.open(path, method=method, json=payload)
+        return response.status_code, response.get_json(silent=True) or {}
+
+
+class HTTPClient:
+    """通过 HTTP 调用已启动的后端"""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def request(self, method, path, payload=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(
+            f"{self.base_url}{path}", data=data, method=method,
+            headers={"Content-Type": "application/json; charset=utf-8"}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, json.loads(response.read().decode("utf-8") or "{}")
+        except urllib.error.HTTPError as e:
+            try:
+                return e.code, json.loads(e.read().decode("utf-8") or "{}")
+            except ValueError:
+                return e.code, {}
+        except (urllib.error.URLError, TimeoutError):
+            return 0, {}
+
+
+class LoadTest:
+    """虚拟用户并发对话压测"""
+
+    def __init__(self, args, client):
+        self.args = args
+        self.client = client
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def _virtual_user(self, user_index):
+        rng = random.Random(self.args.seed + user_index)
+        status, body = self.client.request("GET", "/api/session")
+        if status != 200 or "session_id" not in body:
+            with self._lock:
+                self.samples.append({"route": "session", "status": status, "latency": 0.0})
+            return
+        session_id = body["session_id"]
+
+        for _ in range(self.args.turns):
+            is_hard = rng.random() < self.args.hard_ratio
+            query = rng.choice(HARD_QUERIES if is_hard else EASY_QUERIES)
+            started = time.perf_counter()
+            status, body = self.client.request("POST", "/api/chat", {
+                "query": query,
+                "session_id": session_id,
+                "use_dynamic_routing": not self.args.no_routing
+            })
+            latency = time.perf_counter() - started
+            routing_info = body.get("routing_info") or {}
+            with self._lock:
+                self.samples.append({
+                    "route": routing_info.get("complexity", "fallback"),
+                    "expected": "hard" if is_hard else "easy",
+                    "status": status,
+                    "latency": latency
+                })
+            if self.args.think_time > 0:
+                time.sleep(rng.uniform(0, 2 * self.args.think_time))
+
+    def run(self):
+        started = time.perf_counter()
+        threads = [threading.Thread(target=self._virtual_user, args=(i,)) for i in range(self.args.users)]
+        for thread in threads:
+            thread.start()
+            if self.args.ramp_up > 0:
+                time.sleep(self.args.ramp_up / self.args.users)
+        for thread in threads:
+            thread.join()
+        return self.summarize(time.perf_counter() - started)
+
+    def summarize(self, elapsed):
+        """按路由汇总延迟分布、吞吐量和状态码"""
+        chat_samples = [s for s in self.samples if s["route"] != "session"]
+        groups = defaultdict(list)
+        for sample in chat_samples:
+            if sample["status"] == 200:
+                groups[sample["route"]].append(sample["latency"])
+                groups["all"].append(sample["latency"])
+
+        routes = {}
+        for route, latencies in groups.items():
+            routes[route] = {
+                "count": len(latencies),
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "max_ms": max(latencies) * 1000
+            }
+
+        return {
+            "elapsed_sec": elapsed,
+            "requests": len(chat_samples),
+            "throughput_rps": len(chat_samples) / elapsed if elapsed else 0.0,
+            "status_codes": dict(Counter(str(s["status"]) for s in self.samples)),
+            "routes": routes,
+            "peak_rss_mb": peak_rss_mb()
+        }
+
+
+def build_in_process_client(args):
+    """启动替身服务并以临时数据库加载应用，返回 (客户端, 替身服务)"""
+    stub = None
+    if args.stub_url:
+        base_url = args.stub_url
+    else:
+        default_latency, model_latency = parse_latency_specs(args.latency)
+        stub = DeepSeekStubServer(
+            latency=default_latency,
+            model_latency=model_latency,
+            error_rate=args.error_rate,
+            error_codes=[int(c) for c in args.error_codes.split(",")],
+            mode="replay" if args.cassette else "synthetic",
+            cassette=args.cassette,
+            seed=args.seed
+        ).start()
+        base_url = stub.base_url
+
+    # 必须在导入应用之前设置，utils.py 与各路由模块在导入时读取这些配置
+    os.environ["DEEPSEEK_BASE_URL"] = base_url
+    os.environ.setdefault("DEEPSEEK_API_KEY", "load-test")
+    # 压测的虚拟用户都来自同一个IP，关闭按用户/IP的限流和准入控制
+    os.environ["RATE_LIMIT_ENABLED"] = "0"
+    if not args.keep_database:
+        db_file = os.path.join(tempfile.mkdtemp(prefix="chat_load_test_"), "app.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{db_file}"
+    os.chdir(BACKEND_DIR)
+
+    from app import app
+    return InProcessClient(app), stub
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="/api/chat 端到端压力测试")
+    parser.add_argument("--url", help="压测已启动的后端，如 http://127.0.0.1:5000")
+    parser.add_argument("--stub-url", help="使用已启动的替身服务，如 http://127.0.0.1:8900/v1")
+    parser.add_argument("--users", type=int, default=10, help="并发虚拟用户数")
+    parser.add_argument("--turns", type=int, default=5, help="每个用户的对话轮数")
+    parser.add_argument("--hard-ratio", type=float, default=0.3, help="复杂查询的比例")
+    parser.add_argument("--think-time", type=float, default=0.0, help="两轮对话之间的平均间隔（秒）")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="所有用户全部启动所需时间（秒）")
+    parser.add_argument("--no-routing", action="store_true", help="关闭动态路由")
+    parser.add_argument("--latency", action="append", help="替身服务延迟分布，格式同 deepseek_stub.py")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-codes", default="500")
+    parser.add_argument("--cassette", help="以回放模式使用录制的真实交互")
+    parser.add_argument("--keep-database", action="store_true", help="使用应用默认数据库而不是临时数据库")
+    parser.add_argument("--timeout", type=float, default=600.0, help="--url 模式下的请求超时（秒）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="结果 JSON 输出路径")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stub = None
+    if args.url:
+        client = HTTPClient(args.url, args.timeout)
+    else:
+        client, stub = build_in_process_client(args)
+
+    try:
+        report = LoadTest(args, client).run()
+    finally:
+        if stub:
+            stub.stop()
+
+    print(f"请求数: {report['requests']}  耗时: {report['elapsed_sec']:.1f}s  "
+          f"吞吐量: {report['throughput_rps']:.2f} req/s  峰值内存: {report['peak_rss_mb']:.1f}MB")
+    print(f"状态码: {report['status_codes']}")
+    for route, stats in sorted(report["routes"].items()):
+        print(f"  {route:<9} n={stats['count']:<5} p50={stats['p50_ms']:9.1f}ms "
+              f"p95={stats['p95_ms']:9.1f}ms p99={stats['p99_ms']:9.1f}ms max={stats['max_ms']:9.1f}ms")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
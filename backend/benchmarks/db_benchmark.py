@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+聊天数据库查询基准测试
+
+在临时 SQLite 数据库中生成会话与消息，分别在两种配置下测量热点查询耗时：
+    before  默认 SQLite 配置（回滚日志、synchronous=FULL），没有复合索引
+    after   WAL + synchronous=NORMAL + busy_timeout + mmap，并执行全部迁移（复合索引）
+
+用法示例：
+    python benchmarks/db_benchmark.py
+    python benchmarks/db_benchmark.py --users 200 --sessions-per-user 20 --messages-per-session 60
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# 添加 backend 目录到路径，使能够正确导入模块
+sys.path.append(BACKEND_DIR)
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import sqlite as sqlite_dialect
+from sqlalchemy.schema import CreateTable
+
+from benchmarks.ner_benchmark import percentile
+from database.models import db
+from database.sqlite_config import apply_sqlite_pragmas
+from migrations.runner import run_migrations
+
+# 与 chat_routes 中 ORM 查询等价的 SQL
+QUERIES = {
+    # load_recent_history：最近一页消息
+    "recent_history": (
+        "SELECT id, role, content FROM chat_messages WHERE session_id = :session_id "
+        "ORDER BY id DESC LIMIT 20"
+    ),
+    # /api/history?before_id=...：向前翻页
+    "history_page": (
+        "SELECT * FROM chat_messages WHERE session_id = :session_id AND id < :before_id "
+        "ORDER BY id DESC LIMIT 51"
+    ),
+    # 按时间顺序读取整个会话
+    "history_by_time": (
+        "SELECT * FROM chat_messages WHERE session_id = :session_id ORDER BY created_at"
+    ),
+    # /api/sessions：当前用户的活跃会话，按最近活动倒序
+    "sessions_page": (
+        "SELECT * FROM chat_sessions WHERE is_active = 1 AND user_id = :user_id "
+        "ORDER BY last_activity DESC, id DESC LIMIT 21"
+    ),
+    # _derive_fallback_titles：每个会话的第一条用户消息
+    "fallback_titles": (
+        "SELECT session_id, content FROM ("
+        "SELECT session_id, content, row_number() OVER (PARTITION BY session_id ORDER BY id) AS rn "
+        "FROM chat_messages WHERE session_id IN ({session_ids}) AND role = 'user'"
+        ") WHERE rn = 1"
+    ),
+}
+
+
+def create_schema(path):
+    """按模型定义建表，但不创建任何索引（即迁移前的表结构）"""
+    conn = sqlite3.connect(path)
+    dialect = sqlite_dialect.dialect()
+    for table in db.metadata.sorted_tables:
+        conn.execute(str(CreateTable(table).compile(dialect=dialect)))
+    conn.commit()
+    return conn
+
+
+def populate(conn, args):
+    """生成测试数据，返回 (用户ID列表, 会话ID列表)"""
+    rng = random.Random(args.seed)
+    now = datetime(2024, 1, 1)
+    user_ids = list(range(1, args.users + 1))
+    conn.executemany(
+        "INSERT INTO users (id, username, password_hash, created_at) VALUES (?, ?, ?, ?)",
+        [(uid, f"user{uid}", "x", now) for uid in user_ids]
+    )
+
+    sessions, messages = [], []
+    for uid in user_ids:
+        for s in range(args.sessions_per_user):
+            session_id = f"{uid:06d}-{s:04d}-{rng.getrandbits(32):08x}"
+            started = now + timedelta(minutes=rng.randint(0, 500000))
+            sessions.append((session_id, uid, None, started, started, 1))
+            for m in range(args.messages_per_session):
+                messages.append((
+                    session_id, "user" if m % 2 == 0 else "assistant",
+                    "子曰学而时习之不亦说乎" * rng.randint(1, 8),
+                    started + timedelta(seconds=m * 30)
+                ))
+
+    # 消息按时间交错写入，模拟多个会话同时进行时的真实存储顺序
+    rng.shuffle(messages)
+    messages.sort(key=lambda m: m[3])
+    conn.executemany(
+        "INSERT INTO chat_sessions (id, user_id, title, created_at, last_activity, is_active) "
+        "VALUES (?, ?, ?, ?, ?, ?)", sessions
+    )
+    conn.executemany(
+        "INSERT INTO chat_messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+        messages
+    )
+    conn.commit()
+    return user_ids, [s[0] for s in sessions]
+
+
+def time_query(conn, name, params_list):
+    latencies = []
+    for params in params_list:
+        sql = QUERIES[name]
+        if "{session_ids}" in sql:
+            ids = params.pop("session_ids")
+            placeholders = ", ".join(f":s{i}" for i in range(len(ids)))
+            sql = sql.format(session_ids=placeholders)
+            params.update({f"s{i}": sid for i, sid in enumerate(ids)})
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def time_chat_turn_writes(conn, session_ids, iterations, rng):
+    """一轮对话的写入：两条消息 + 更新会话活动时间，一次提交"""
+    latencies = []
+    for _ in range(iterations):
+        session_id = rng.choice(session_ids)
+        now = datetime.utcnow()
+        started = time.perf_counter()
+        conn.execute(
+            "INSERT INTO chat_messages (session_id, role, content, created_at) VALUES (?, 'user', ?, ?)",
+            (session_id, "什么是仁", now)
+        )
+        conn.execute(
+            "INSERT INTO chat_messages (session_id, role, content, created_at) VALUES (?, 'assistant', ?, ?)",
+            (session_id, "仁者爱人", now)
+        )
+        conn.execute("UPDATE chat_sessions SET last_activity = ? WHERE id = ?", (now, session_id))
+        conn.commit()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def run_suite(path, user_ids, session_ids, args, tuned):
+    conn = sqlite3.connect(path)
+    if tuned:
+        apply_sqlite_pragmas(conn)
+    rng = random.Random(args.seed + 1)
+
+    def sample_sessions():
+        return [rng.choice(session_ids) for _ in range(args.iterations)]
+
+    max_message_id = conn.execute("SELECT max(id) FROM chat_messages").fetchone()[0]
+    results = {
+        "recent_history": time_query(conn, "recent_history",
+                                     [{"session_id": s} for s in sample_sessions()]),
+        "history_page": time_query(conn, "history_page",
+                                   [{"session_id": s, "before_id": rng.randint(1, max_message_id)}
+                                    for s in sample_sessions()]),
+        "history_by_time": time_query(conn, "history_by_time",
+                                      [{"session_id": s} for s in sample_sessions()]),
+        "sessions_page": time_query(conn, "sessions_page",
+                                    [{"user_id": rng.choice(user_ids)} for _ in range(args.iterations)]),
+        "fallback_titles": time_query(conn, "fallback_titles",
+                                      [{"session_ids": rng.sample(session_ids, 20)}
+                                       for _ in range(args.iterations)]),
+        "chat_turn_write": time_chat_turn_writes(conn, session_ids, args.write_iterations, rng),
+    }
+    conn.close()
+    return {
+        name: {
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "mean_ms": sum(latencies) / len(latencies) * 1000
+        }
+        for name, latencies in results.items()
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="聊天数据库查询基准测试")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--sessions-per-user", type=int, default=20)
+    parser.add_argument("--messages-per-session", type=int, default=40)
+    parser.add_argument("--iterations", type=int, default=200, help="每个读查询的执行次数")
+    parser.add_argument("--write-iterations", type=int, default=200, help="对话写入的执行次数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", help="数据库文件目录（默认使用临时目录并在结束后删除）")
+    parser.add_argument("--output", help="结果 JSON 输出路径")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="db_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    before_path = os.path.join(workdir, "before.db")
+    after_path = os.path.join(workdir, "after.db")
+
+    try:
+        for path in (before_path, after_path):
+            if os.path.exists(path):
+                os.remove(path)
+        conn = create_schema(before_path)
+        user_ids, session_ids = populate(conn, args)
+        conn.close()
+        print(f"已生成 {len(session_ids)} 个会话、{len(session_ids) * args.messages_per_session} 条消息")
+
+        # after 数据库：同样的数据，执行迁移（创建索引、切换到 WAL）
+        shutil.copyfile(before_path, after_path)
+        run_migrations(create_engine(f"sqlite:///{after_path}"))
+
+        report = {
+            "before": run_suite(before_path, user_ids, session_ids, args, tuned=False),
+            "after": run_suite(after_path, user_ids, session_ids, args, tuned=True),
+        }
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'查询':<18}{'before p50':>12}{'after p50':>12}{'before p95':>12}{'after p95':>12}{'加速':>9}")
+    for name in report["before"]:
+        before, after = report["before"][name], report["after"][name]
+        speedup = before["p50_ms"] / after["p50_ms"] if after["p50_ms"] else float("inf")
+        print(f"{name:<18}{before['p50_ms']:>10.3f}ms{after['p50_ms']:>10.3f}ms"
+              f"{before['p95_ms']:>10.3f}ms{after['p95_ms']:>10.3f}ms{speedup:>8.1f}x")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
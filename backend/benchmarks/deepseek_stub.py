@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+本地 DeepSeek 替身服务：兼容 OpenAI /chat/completions 接口，用于离线基准测试和压力测试
+
+- NER 矫正请求：从提示词中取出"现有实体"原样返回，走完整的解析和对齐流程
+- 复杂度分类请求：按关键词判断 Easy/Hard，便于压测脚本控制路由比例
+- deepseek-reasoner 请求：额外返回 reasoning_content
+- 支持流式输出（SSE 增量）、可配置的延迟分布、错误注入，以及对真实接口的录制和回放
+
+用法示例：
+    python benchmarks/deepseek_stub.py --latency lognormal:-0.5,0.4 --latency deepseek-reasoner=uniform:3,8
+    python benchmarks/deepseek_stub.py --error-rate 0.05 --error-codes 429,503
+    python benchmarks/deepseek_stub.py --mode record --cassette exchanges.jsonl --upstream https://api.deepseek.com/v1
+    python benchmarks/deepseek_stub.py --mode replay --cassette exchanges.jsonl
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# NER 矫正提示词中预标注实体所在的行
+EXISTING_ENTITIES_PATTERN = re.compile(r'现有实体（JSON List of Dict）：(.*)')
+# 批量实体解析提示词中的编号实体（见 entity_analysis.BATCH_PROMPTS）
+BATCH_ENTITY_PATTERN = re.compile(r"^\[(\d+)\] 实体：(.+?)（", re.MULTILINE)
+# 复杂度分类提示词（见 utils.classify_input_complexity）
+CLASSIFY_MARKER = "只返回'Easy'或'Hard'"
+CLASSIFY_QUERY_PATTERN = re.compile(r'查询: (.*?)\n')
+# 替身服务将包含以下关键词的查询判为 Hard
+HARD_QUERY_KEYWORDS = ("分析", "比较", "为什么", "如何", "论述", "异同", "评价")
+
+DEFAULT_REPLY = "这是本地替身服务返回的回答。"
+DEFAULT_REASONING = "这是本地替身服务返回的推理过程。"
+
+
+class LatencyModel:
+    """
+    延迟分布，规格形如：
+        fixed:0.5  uniform:0.2,1.5  normal:1.0,0.3  lognormal:-0.5,0.4
+    单位为秒，采样结果不小于 0
+    """
+
+    KINDS = ("fixed", "uniform", "normal", "lognormal")
+
+    def __init__(self, spec="fixed:0"):
+        kind, _, params = str(spec).partition(":")
+        if kind not in self.KINDS:
+            # 兼容直接传入秒数
+            kind, params = "fixed", spec
+        self.kind = kind
+        self.params = [float(p) for p in str(params).split(",") if p != ""] or [0.0]
+        self.spec = f"{self.kind}:{','.join(str(p) for p in self.params)}"
+
+    def sample(self, rng=random):
+        if self.kind == "uniform":
+            value = rng.uniform(self.params[0], self.params[1])
+        elif self.kind == "normal":
+            value = rng.gauss(self.params[0], self.params[1])
+        elif self.kind == "lognormal":
+            value = rng.lognormvariate(self.params[0], self.params[1])
+        else:
+            value = self.params[0]
+        return max(0.0, value)
+
+
+def request_key(payload):
+    """录制/回放时用于匹配请求的键（与是否流式无关）"""
+    canonical = json.dumps(
+        {"model": payload.get("model"), "messages": payload.get("messages", [])},
+        ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def classify_reply(prompt):
+    """复杂度分类请求的回答"""
+    match = CLASSIFY_QUERY_PATTERN.search(prompt)
+    query = match.group(1) if match else prompt
+    return "Hard" if any(k in query for k in HARD_QUERY_KEYWORDS) else "Easy"
+
+
+def build_reply(messages):
+    """根据请求内容生成回答文本"""
+    prompt = messages[-1].get("content", "") if messages else ""
+    if CLASSIFY_MARKER in prompt:
+        return classify_reply(prompt)
+    batch = BATCH_ENTITY_PATTERN.findall(prompt)
+    if batch:
+        return json.dumps({"results": [
+            {"id": int(i), "analysis": f"{text}：{DEFAULT_REPLY}"} for i, text in batch
+        ]}, ensure_ascii=False)
+    match = EXISTING_ENTITIES_PATTERN.search(prompt)
+    if match:
+        try:
+            entities = json.loads(match.group(1))
+            for ent in entities:
+                ent["source"] = "llm"
+            return json.dumps(entities, ensure_ascii=False)
+        except json.JSONDecodeError:
+            return "[]"
+    return DEFAULT_REPLY
+
+
+def estimate_usage(messages, content, reasoning=""):
+    """按字符数粗略估算 token 用量"""
+    prompt_tokens = sum(len(m.get("content", "")) for m in messages)
+    completion_tokens = len(content) + len(reasoning)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_cache_hit_tokens": 0,
+        "prompt_cache_miss_tokens": prompt_tokens
+    }
+
+
+def build_completion(model, content, reasoning=None, usage=None):
+    """构建 OpenAI 兼容的非流式响应体"""
+    message = {"role": "assistant", "content": content}
+    if reasoning:
+        message["reasoning_content"] = reasoning
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+        "usage": usage or {"prompt_tokens": 0, "completion_tokens": len(content), "total_tokens": len(content)}
+    }
+
+
+def build_chunk(completion_id, model, delta, finish_reason=None, usage=None):
+    """构建流式响应中的一个增量块"""
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+    if usage:
+        chunk["usage"] = usage
+    return chunk
+
+
+def split_text(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)] if text else []
+
+
+class Cassette:
+    """录制的真实交互，每行一条 JSON：{"key", "request", "response"}"""
+
+    def __init__(self, path):
+        self.path = path
+        self.exchanges = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.exchanges[record["key"]] = record["response"]
+
+    def get(self, key):
+        return self.exchanges.get(key)
+
+    def record(self, key, request_payload, response):
+        with self._lock:
+            self.exchanges[key] = response
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "request": request_payload, "response": response},
+                                   ensure_ascii=False) + "\n")
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """处理 /chat/completions 与 /v1/chat/completions 请求"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if self.path.rstrip("/") not in ("/chat/completions", "/v1/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length).decode("utf-8"))
+        except (ValueError, UnicodeDecodeError):
+            self._send_json(400, {"error": {"message": "invalid json", "type": "invalid_request_error"}})
+            return
+
+        server = self.server
+        model = payload.get("model", "deepseek-chat")
+
+        # 错误注入
+        fault = server.sample_fault()
+        if fault == "timeout":
+            time.sleep(server.hang_seconds)
+            self.close_connection = True
+            return
+        if fault:
+            status = fault
+            self._send_json(status, {"error": {"message": f"injected error {status}", "type": "server_error"}})
+            return
+
+        try:
+            completion = server.complete(payload)
+        except urllib.error.HTTPError as e:
+            self._send_json(e.code, {"error": {"message": str(e), "type": "upstream_error"}})
+            return
+
+        message = completion["choices"][0]["message"]
+        if payload.get("stream"):
+            self._stream(model, message, completion.get("usage"))
+        else:
+            time.sleep(server.sample_latency(model))
+            self._send_json(200, completion)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, model, message, usage):
+        """以 SSE 增量形式输出，首个增量前等待采样延迟（首 token 延迟）"""
+        server = self.server
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        time.sleep(server.sample_latency(model))
+        deltas = [{"role": "assistant", "content": ""}]
+        deltas += [{"reasoning_content": piece}
+                   for piece in split_text(message.get("reasoning_content") or "", server.chunk_size)]
+        deltas += [{"content": piece} for piece in split_text(message.get("content") or "", server.chunk_size)]
+
+        try:
+            for i, delta in enumerate(deltas):
+                if i > 0 and server.token_interval > 0:
+                    time.sleep(server.token_interval)
+                self._write_event(build_chunk(completion_id, model, delta))
+            self._write_event(build_chunk(completion_id, model, {}, finish_reason="stop", usage=usage))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开
+            pass
+
+    def _write_event(self, chunk):
+        self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        # 测试时不输出访问日志
+        pass
+
+
+class DeepSeekStubServer(ThreadingHTTPServer):
+    """可在后台线程中运行的替身服务"""
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, model_latency=None,
+                 error_rate=0.0, error_codes=(500,), timeout_rate=0.0, hang_seconds=300.0,
+                 chunk_size=4, token_interval=0.0, mode="synthetic", cassette=None,
+                 upstream=None, upstream_api_key=None, seed=None):
+        super().__init__((host, port), StubRequestHandler)
+        self.latency = latency if isinstance(latency, LatencyModel) else LatencyModel(latency)
+        self.model_latency = {
+            model: spec if isinstance(spec, LatencyModel) else LatencyModel(spec)
+            for model, spec in (model_latency or {}).items()
+        }
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.chunk_size = chunk_size
+        self.token_interval = token_interval
+        self.mode = mode
+        self.cassette = Cassette(cassette) if cassette else None
+        self.upstream = upstream
+        self.upstream_api_key = upstream_api_key
+        self.rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self._thread = None
+
+        if mode in ("record", "replay") and not self.cassette:
+            raise ValueError(f"{mode} 模式需要指定 cassette 文件")
+        if mode == "record" and not upstream:
+            raise ValueError("record 模式需要指定 upstream 地址")
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def sample_latency(self, model):
+        with self._rng_lock:
+            return self.model_latency.get(model, self.latency).sample(self.rng)
+
+    def sample_fault(self):
+        """按配置的概率决定本次请求是否注入故障：返回 "timeout"、错误状态码或 None"""
+        with self._rng_lock:
+            if self.rng.random() < self.timeout_rate:
+                return "timeout"
+            if self.rng.random() < self.error_rate:
+                return self.rng.choice(self.error_codes)
+        return None
+
+    def complete(self, payload):
+        """生成（或录制/回放）一次非流式补全结果"""
+        key = request_key(payload)
+        if self.mode == "replay":
+            recorded = self.cassette.get(key)
+            if recorded:
+                return recorded
+        elif self.mode == "record":
+            recorded = self._call_upstream(payload)
+            self.cassette.record(key, payload, recorded)
+            return recorded
+
+        messages = payload.get("messages", [])
+        model = payload.get("model", "deepseek-chat")
+        content = build_reply(messages)
+        reasoning = DEFAULT_REASONING if model == "deepseek-reasoner" else None
+        return build_completion(model, content, reasoning, estimate_usage(messages, content, reasoning or ""))
+
+    def _call_upstream(self, payload):
+        """转发到真实接口（总是以非流式请求，回放时再按需切分为增量）"""
+        body = dict(payload, stream=False)
+        request = urllib.request.Request(
+            f"{self.upstream.rstrip('/')}/chat/completions",
+            data=json.dumps(body, ensure_ascii=False).encode("utf-8"),
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self.upstream_api_key}"
+            }
+        )
+        with urllib.request.urlopen(request, timeout=600) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    def start(self):
+        """在后台线程中启动服务"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """停止服务"""
+        self.shutdown()
+        self.server_close()
+
+
+def parse_latency_specs(specs):
+    """解析 --latency 参数，返回 (默认分布, {模型: 分布})"""
+    default, per_model = LatencyModel("fixed:0"), {}
+    for spec in specs or []:
+        model, sep, dist = spec.partition("=")
+        if sep:
+            per_model[model] = LatencyModel(dist)
+        else:
+            default = LatencyModel(spec)
+    return default, per_model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地 DeepSeek 替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", action="append",
+                        help="延迟分布，如 lognormal:-0.5,0.4；加 模型= 前缀可单独配置某个模型")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误状态码的概率")
+    parser.add_argument("--error-codes", default="500", help="注入的错误状态码，逗号分隔")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="挂起请求（模拟超时）的概率")
+    parser.add_argument("--hang-seconds", type=float, default=300.0)
+    parser.add_argument("--chunk-size", type=int, default=4, help="流式输出每个增量的字符数")
+    parser.add_argument("--token-interval", type=float, default=0.0, help="流式增量之间的间隔（秒）")
+    parser.add_argument("--mode", choices=["synthetic", "record", "replay"], default="synthetic")
+    parser.add_argument("--cassette", help="录制/回放文件（JSONL）")
+    parser.add_argument("--upstream", default="https://api.deepseek.com/v1", help="录制模式下的真实接口地址")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    default_latency, model_latency = parse_latency_specs(args.latency)
+    server = DeepSeekStubServer(
+        args.host, args.port,
+        latency=default_latency,
+        model_latency=model_latency,
+        error_rate=args.error_rate,
+        error_codes=[int(c) for c in args.error_codes.split(",")],
+        timeout_rate=args.timeout_rate,
+        hang_seconds=args.hang_seconds,
+        chunk_size=args.chunk_size,
+        token_interval=args.token_interval,
+        mode=args.mode,
+        cassette=args.cassette,
+        upstream=args.upstream,
+        upstream_api_key=os.getenv("DEEPSEEK_API_KEY"),
+        seed=args.seed
+    )
+    print(f"DeepSeek 替身服务已启动: {server.base_url} (模式: {args.mode})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+NER 性能基准测试
+
+离线驱动 process_text 以及 /api/ner、/api/ner/file 接口，覆盖不同文本长度、批大小、
+模型类型和大模型增强开关；大模型调用由本地 DeepSeek 替身服务应答。
+输出 p50/p95/p99 延迟、每秒处理字符数和峰值内存，结果可保存为 JSON 基线并与之比较。
+
+用法示例：
+    python benchmarks/ner_benchmark.py --save-baseline main
+    python benchmarks/ner_benchmark.py --compare main --tolerance 0.15
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from datetime import datetime
+from io import BytesIO
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+CORPUS_DIR = os.path.join(BENCHMARK_DIR, "corpus")
+BASELINE_DIR = os.path.join(BENCHMARK_DIR, "baselines")
+
+# 添加 backend 目录到路径，使能够正确导入模块
+sys.path.append(BACKEND_DIR)
+
+from benchmarks.deepseek_stub import DeepSeekStubServer
+
+DEFAULT_LENGTHS = [10, 100, 1000, 10000, 100000]
+DEFAULT_BATCH_SIZES = [1, 8]
+
+# 各模型类型对应的真实古籍语料
+REAL_CORPORA = {
+    "A": ["lunyu_xueer.txt", "shiji_xiangyu.txt"],
+    "C": ["shanghanlun.txt"],
+}
+
+PUNCTUATION = "，。；：？！、"
+
+
+def load_corpus(model_type, extra_files=None):
+    """读取指定模型类型的真实语料"""
+    paths = [os.path.join(CORPUS_DIR, name) for name in REAL_CORPORA[model_type]]
+    paths += extra_files or []
+    texts = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            texts.append(f.read().strip())
+    return "".join(texts)
+
+
+def make_real_text(corpus, length, seed):
+    """从真实语料中截取（必要时循环拼接）指定长度的文本"""
+    if len(corpus) < length:
+        corpus = corpus * (length // len(corpus) + 1)
+    offset = random.Random(seed).randrange(0, len(corpus) - length + 1)
+    return corpus[offset:offset + length]
+
+
+def make_synthetic_text(corpus, length, seed):
+    """按语料字频随机生成文本，每隔 4~12 个字插入一个标点"""
+    rng = random.Random(seed)
+    chars = [c for c in corpus if c not in PUNCTUATION]
+    result = []
+    next_punct = rng.randint(4, 12)
+    while len(result) < length:
+        if next_punct == 0:
+            result.append(rng.choice(PUNCTUATION))
+            next_punct = rng.randint(4, 12)
+        else:
+            result.append(rng.choice(chars))
+            next_punct -= 1
+    return "".join(result)
+
+
+def percentile(values, p):
+    """最近秩法计算百分位数"""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def reset_peak_rss():
+    """把进程峰值常驻内存重置为当前值（Linux 的 /proc/self/clear_refs），不支持时返回 False"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """
+    进程峰值常驻内存（MB）
+    Linux 下读取 VmHWM，即上次 reset_peak_rss 以来的峰值；其他平台为进程启动以来的峰值
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 下单位为 KB，macOS 下为字节
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class NERBenchmark:
+    """基准测试执行器"""
+
+    def __init__(self, args):
+        self.args = args
+        self.stub = None
+        self.client = None
+
+    def setup(self):
+        """启动替身服务并导入后端模块（模型路径相对 backend 目录）"""
+        self.stub = DeepSeekStubServer(latency=self.args.stub_latency).start()
+        os.chdir(BACKEND_DIR)
+        # 基准测试的请求都来自同一个IP，关闭限流和准入控制
+        os.environ["RATE_LIMIT_ENABLED"] = "0"
+
+        from routes import ner_routes
+        ner_routes.config.api_endpoint = f"{self.stub.base_url}/chat/completions"
+        ner_routes.config.api_key = "benchmark"
+        ner_routes.llm_handler.api_endpoint = ner_routes.config.api_endpoint
+        ner_routes.llm_handler.api_key = ner_routes.config.api_key
+        self.ner_routes = ner_routes
+
+        if set(self.args.targets) & {"ner", "ner_file"}:
+            from app import app
+            self.client = app.test_client()
+
+    def teardown(self):
+        if self.stub:
+            self.stub.stop()
+
+    def _run_once(self, target, text, model_type, enable_llm):
+        """执行一次调用，返回是否成功"""
+        if target == "process_text":
+            _, error = self.ner_routes.process_text(text, enable_llm, model_type)
+            return error is None
+        if target == "ner":
+            response = self.client.post("/api/ner", json={
+                "text": text, "enable_llm": enable_llm, "model_type": model_type
+            })
+            return response.status_code == 200
+        response = self.client.post("/api/ner/file", data={
+            "file": (BytesIO(text.encode("utf-8")), "benchmark.txt"),
+            "enable_llm": str(enable_llm).lower(),
+            "model_type": model_type
+        }, content_type="multipart/form-data")
+        return response.status_code == 200
+
+    def run_case(self, target, model_type, enable_llm, corpus_kind, length, batch_size):
+        """运行单个测试用例并汇总指标"""
+        corpus = load_corpus(model_type, self.args.corpus)
+        make_text = make_real_text if corpus_kind == "real" else make_synthetic_text
+        batch = [make_text(corpus, length, seed) for seed in range(batch_size)]
+
+        # 峰值内存按用例统计；无法重置时只能得到进程启动以来的峰值，不参与基线比较
+        per_case_rss = reset_peak_rss()
+        for _ in range(self.args.warmup):
+            for text in batch:
+                self._run_once(target, text, model_type, enable_llm)
+
+        latencies = []
+        failures = 0
+        for _ in range(self.args.iterations):
+            started = time.perf_counter()
+            for text in batch:
+                if not self._run_once(target, text, model_type, enable_llm):
+                    failures += 1
+            latencies.append(time.perf_counter() - started)
+
+        total_chars = length * batch_size * len(latencies)
+        return {
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "mean_ms": sum(latencies) / len(latencies) * 1000,
+            "chars_per_sec": total_chars / sum(latencies),
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_scope": "case" if per_case_rss else "process",
+            "iterations": len(latencies),
+            "failures": failures
+        }
+
+    def run(self):
+        """遍历全部参数组合"""
+        results = {}
+        for target in self.args.targets:
+            for model_type in self.args.model_types:
+                for enable_llm in self.args.llm:
+                    for corpus_kind in self.args.corpus_kinds:
+                        for length in self.args.lengths:
+                            for batch_size in self.args.batch_sizes:
+                                key = (f"{target}|{model_type}|llm={'on' if enable_llm else 'off'}"
+                                       f"|{corpus_kind}|len={length}|batch={batch_size}")
+                                metrics = self.run_case(
+                                    target, model_type, enable_llm, corpus_kind, length, batch_size
+                                )
+                                results[key] = metrics
+                                print(f"{key:<60} p50={metrics['p50_ms']:9.1f}ms "
+                                      f"p95={metrics['p95_ms']:9.1f}ms p99={metrics['p99_ms']:9.1f}ms "
+                                      f"{metrics['chars_per_sec']:11.0f} chars/s "
+                                      f"rss={metrics['peak_rss_mb']:7.1f}MB")
+        return results
+
+
+def collect_metadata(args):
+    """记录运行环境，便于比较不同机器上的基线"""
+    meta = {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("save_baseline", "compare")}
+    }
+    try:
+        import torch
+        meta["torch"] = torch.__version__
+        meta["device"] = "cuda" if torch.cuda.is_available() else "cpu"
+    except ImportError:
+        pass
+    return meta
+
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def save_baseline(name, report):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    with open(baseline_path(name), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"基线已保存: {baseline_path(name)}")
+
+
+def compare_with_baseline(name, results, tolerance):
+    """与基线比较，返回回归项列表"""
+    with open(baseline_path(name), "r", encoding="utf-8") as f:
+        baseline = json.load(f)["cases"]
+
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            if current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append((key, metric, previous[metric], current[metric]))
+        if current["chars_per_sec"] < previous["chars_per_sec"] * (1 - tolerance):
+            regressions.append((key, "chars_per_sec", previous["chars_per_sec"], current["chars_per_sec"]))
+        if (current.get("peak_rss_scope") == previous.get("peak_rss_scope") == "case"
+                and current["peak_rss_mb"] > previous["peak_rss_mb"] * (1 + tolerance)):
+            regressions.append((key, "peak_rss_mb", previous["peak_rss_mb"], current["peak_rss_mb"]))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="NER 性能基准测试")
+    parser.add_argument("--targets", nargs="+", default=["process_text", "ner"],
+                        choices=["process_text", "ner", "ner_file"], help="测试对象")
+    parser.add_argument("--model-types", nargs="+", default=["A", "C"], choices=["A", "C"])
+    parser.add_argument("--llm", nargs="+", default=["off", "on"], choices=["off", "on"],
+                        help="是否启用大模型增强")
+    parser.add_argument("--corpus-kinds", nargs="+", default=["synthetic", "real"],
+                        choices=["synthetic", "real"])
+    parser.add_argument("--corpus", nargs="*", default=[], help="额外的真实语料文件")
+    parser.add_argument("--lengths", nargs="+", type=int, default=DEFAULT_LENGTHS)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=DEFAULT_BATCH_SIZES)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="替身服务的固定延迟（秒）")
+    parser.add_argument("--output", help="结果 JSON 输出路径")
+    parser.add_argument("--save-baseline", metavar="NAME", help="将结果保存为基线")
+    parser.add_argument("--compare", metavar="NAME", help="与指定基线比较")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="允许的性能退化比例")
+    args = parser.parse_args(argv)
+    args.llm = [v == "on" for v in args.llm]
+    args.corpus = [os.path.abspath(p) for p in args.corpus]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    benchmark = NERBenchmark(args)
+    try:
+        benchmark.setup()
+        results = benchmark.run()
+    finally:
+        benchmark.teardown()
+
+    report = {"meta": collect_metadata(args), "cases": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        save_baseline(args.save_baseline, report)
+
+    if args.compare:
+        regressions = compare_with_baseline(args.compare, results, args.tolerance)
+        if regressions:
+            print(f"\n发现 {len(regressions)} 项性能回归（容忍度 {args.tolerance:.0%}）：")
+            for key, metric, before, after in regressions:
+                print(f"  {key} {metric}: {before:.1f} -> {after:.1f}")
+            return 1
+        print(f"\n与基线 {args.compare} 相比未发现性能回归")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+聊天记录全文搜索（SQLite FTS5）
+
+FTS5 内置分词器按空白和标点切词，对不分词的中文（尤其是文言文）无法按词检索，trigram 分词器又不支持两个字的查询。
+这里把消息内容预先切分为字符二元组写入 FTS5 索引：
+
+- 连续的汉字（含假名）切成相邻二元组，末尾再补一个单字，例如 "王安石变法" -> 王安 安石 石变 变法 法；
+  字母和数字按单词切分并转为小写
+- 查询同样切分：多字的连续汉字作为二元组短语查询（相邻二元组必须连续出现，等价于子串匹配），
+  单字按前缀查询（任意位置的字都是某个二元组的首字或所在片段的末字），字母数字单词也按前缀查询，多个查询词之间为 AND
+- 二元组由注册到每个 SQLite 连接上的函数 cjk_bigrams() 计算，chat_messages 上的触发器调用它同步维护索引；
+  因此不经过本应用（例如 sqlite3 命令行）写入 chat_messages 时会报 no such function，需要在应用中操作
+- 索引表不保存原文（contentless），结果按 bm25 排序后从 chat_messages 取原文，在 Python 中生成高亮摘要
+
+已有数据库执行迁移时会自动建立索引；索引损坏或需要重建时：
+    python database/chat_search.py rebuild
+"""
+
+import argparse
+import html
+import logging
+import os
+import re
+import sys
+import unicodedata
+
+from sqlalchemy import DateTime, create_engine, text
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = "chat_messages_fts"
+# 摘要的最大长度（字符）
+SNIPPET_CHARS = 80
+# 单次搜索最多的查询词数
+MAX_QUERY_TERMS = 8
+
+# 汉字（含扩展区）和假名
+CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0003134f"
+TOKEN_PATTERN = re.compile(rf"([{CJK_CHARS}]+)|((?:(?![{CJK_CHARS}])[^\W_])+)")
+
+
+def _normalize(content):
+    return unicodedata.normalize("NFKC", content).lower()
+
+
+def _runs(content):
+    """返回 (是否为汉字片段, 片段) 列表"""
+    return [(bool(cjk), cjk or word) for cjk, word in TOKEN_PATTERN.findall(_normalize(content))]
+
+
+def cjk_bigrams(content):
+    """把文本切分为以空格分隔的索引词（SQLite 函数 cjk_bigrams 的实现）"""
+    if not content:
+        return ""
+    tokens = []
+    for is_cjk, run in _runs(content):
+        if is_cjk:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            tokens.append(run[-1])
+        else:
+            tokens.append(run)
+    return " ".join(tokens)
+
+
+def register_functions(dbapi_connection):
+    """在 SQLite 连接上注册索引触发器使用的函数"""
+    dbapi_connection.create_function("cjk_bigrams", 1, cjk_bigrams, deterministic=True)
+
+
+def parse_query(query):
+    """
+    把搜索词转换为 FTS5 MATCH 表达式，返回 (表达式, 用于高亮的片段列表)
+    没有可检索的内容时表达式为 None
+    """
+    clauses = []
+    terms = []
+    for is_cjk, run in _runs(query)[:MAX_QUERY_TERMS]:
+        terms.append(run)
+        if is_cjk and len(run) > 1:
+            clauses.append('"' + " ".join(run[i:i + 2] for i in range(len(run) - 1)) + '"')
+        else:
+            clauses.append(f'"{run}"*')
+    return (" AND ".join(clauses) or None), terms
+
+
+def highlight_snippet(content, terms, max_chars=SNIPPET_CHARS):
+    """截取第一个命中位置附近的片段，HTML 转义后用 <mark> 标出所有命中的查询片段"""
+    lowered = _normalize(content)
+    if len(lowered) != len(content):
+        # NFKC 改变了长度（例如连字），位置无法一一对应，退回只做大小写折叠
+        lowered = content.lower()
+    hits = [m.start() for term in terms for m in [re.search(re.escape(term), lowered)] if m]
+    first = min(hits) if hits else 0
+    start = max(0, min(first - max_chars // 4, len(content) - max_chars))
+    end = min(len(content), start + max_chars)
+
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)))
+    window = lowered[start:end]
+    pieces = []
+    position = 0
+    for match in pattern.finditer(window) if terms else ():
+        pieces.append(html.escape(content[start + position:start + match.start()]))
+        pieces.append(f"<mark>{html.escape(content[start + match.start():start + match.end()])}</mark>")
+        position = match.end()
+    pieces.append(html.escape(content[start + position:end]))
+    return ("…" if start > 0 else "") + "".join(pieces) + ("…" if end < len(content) else "")
+
+
+def create_index(conn):
+    """建立 FTS5 索引表和同步触发器，并为已有消息建立索引（迁移使用）"""
+    if conn.dialect.name != "sqlite":
+        logger.warning("全文搜索需要 SQLite FTS5，当前数据库跳过索引建立")
+        return
+    conn.exec_driver_sql(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(terms, content='', tokenize='unicode61')"
+    )
+    conn.exec_driver_sql(f"""
+        CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, terms) VALUES (new.id, cjk_bigrams(new.content));
+        END""")
+    conn.exec_driver_sql(f"""
+        CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, terms) VALUES ('delete', old.id, cjk_bigrams(old.content));
+        END""")
+    conn.exec_driver_sql(f"""
+        CREATE TRIGGER IF NOT EXISTS chat_messages_fts_update AFTER UPDATE OF content ON chat_messages BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, terms) VALUES ('delete', old.id, cjk_bigrams(old.content));
+            INSERT INTO {FTS_TABLE}(rowid, terms) VALUES (new.id, cjk_bigrams(new.content));
+        END""")
+    rebuild_index(conn)
+
+
+def rebuild_index(conn):
+    """清空并按 chat_messages 的当前内容重建索引"""
+    conn.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('delete-all')")
+    conn.exec_driver_sql(
+        f"INSERT INTO {FTS_TABLE}(rowid, terms) SELECT id, cjk_bigrams(content) FROM chat_messages"
+    )
+    conn.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+
+def search_messages(conn, query, user_id, limit, offset=0):
+    """
+    在 user_id 的活跃会话中搜索消息（user_id 为 None 时为未归属用户的会话），按相关度排序
+    返回 (结果列表, 是否还有下一页)；query 中没有可检索内容时返回空结果
+    """
+    match, terms = parse_query(query)
+    if match is None:
+        return [], False
+    owner_clause = "s.user_id = :user_id" if user_id is not None else "s.user_id IS NULL"
+    rows = conn.execute(text(f"""
+        SELECT m.id, m.session_id, m.role, m.content, m.created_at, s.title, f.rank
+        FROM {FTS_TABLE} AS f
+        JOIN chat_messages AS m ON m.id = f.rowid
+        JOIN chat_sessions AS s ON s.id = m.session_id
+        WHERE {FTS_TABLE} MATCH :match AND s.is_active = 1 AND {owner_clause}
+        ORDER BY f.rank, m.id DESC
+        LIMIT :limit OFFSET :offset
+    """).columns(created_at=DateTime()), {
+        "match": match, "user_id": user_id, "limit": limit + 1, "offset": offset
+    }).fetchall()
+
+    results = [{
+        "message_id": row.id,
+        "session_id": row.session_id,
+        "session_title": row.title,
+        "role": row.role,
+        "created_at": row.created_at.isoformat() if row.created_at is not None else None,
+        "snippet": highlight_snippet(row.content, terms),
+        "score": round(-row.rank, 4)
+    } for row in rows[:limit]]
+    return results, len(rows) > limit
+
+
+def main(argv=None):
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    default_url = os.getenv(
+        "DATABASE_URL", f"sqlite:///{os.path.join(backend_dir, 'database', 'app.db')}"
+    )
+
+    parser = argparse.ArgumentParser(description="聊天记录全文索引")
+    parser.add_argument("--database-url", default=default_url)
+    parser.add_argument("command", choices=["rebuild"])
+    args = parser.parse_args(argv)
+
+    # 导入 sqlite_config 以便为连接设置 PRAGMA 并注册 cjk_bigrams 函数
+    sys.path.append(backend_dir)
+    import database.sqlite_config  # noqa: F401
+
+    engine = create_engine(args.database_url)
+    with engine.begin() as conn:
+        create_index(conn)
+        count = conn.exec_driver_sql("SELECT count(*) FROM chat_messages").scalar()
+    print(f"已为 {count} 条消息重建全文索引")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
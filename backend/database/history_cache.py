@@ -0,0 +1,108 @@
+"""
+进程内的会话历史缓存
+
+按会话缓存token预算内的最近消息，消息以 (role, content, tokens, nbytes) 元组紧凑存储。
+chat() 追加消息时原地更新缓存，活跃会话的多轮对话无需再从 SQLite 读取历史。
+缓存按总字节数做 LRU 淘汰；每个进程独立缓存，TTL 用于限制多进程部署时读到其他进程写入前的旧数据的时间。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from metrics import CACHE_REQUESTS
+
+# 缓存中消息内容的总字节数上限
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# 缓存项自从数据库加载起的有效期（秒），0 表示不过期
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "300"))
+
+
+class SessionHistoryCache:
+    """按会话的 LRU 历史缓存，容量以字节计"""
+
+    def __init__(self, token_budget, count_tokens, max_bytes=HISTORY_CACHE_MAX_BYTES, ttl=HISTORY_CACHE_TTL):
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # 缓存键（由调用方决定，例如 (归属用户, 会话 ID)）-> [加载时间, 消息列表, token总数, 字节总数]
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _make_message(self, role, content):
+        return (role, content, self.count_tokens(content), len(content.encode("utf-8")))
+
+    def _trim(self, entry):
+        """从最早的消息开始丢弃，直到不超过token预算"""
+        messages = entry[1]
+        dropped = 0
+        while messages and entry[2] > self.token_budget:
+            _, _, tokens, nbytes = messages.popleft()
+            entry[2] -= tokens
+            entry[3] -= nbytes
+            dropped += nbytes
+        return dropped
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[3]
+
+    def get(self, session_id):
+        """返回按时间顺序排列的消息字典列表，未命中时返回 None"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and self.ttl and time.monotonic() - entry[0] > self.ttl:
+                self._entries.pop(session_id)
+                self._bytes -= entry[3]
+                entry = None
+            if entry is None:
+                CACHE_REQUESTS.inc(cache="session_history", result="miss")
+                return None
+            self._entries.move_to_end(session_id)
+            CACHE_REQUESTS.inc(cache="session_history", result="hit")
+            return [{"role": role, "content": content} for role, content, _, _ in entry[1]]
+
+    def put(self, session_id, history):
+        """写入从数据库加载的历史（消息字典列表，按时间顺序）"""
+        messages = deque(self._make_message(m["role"], m["content"]) for m in history)
+        entry = [time.monotonic(), messages, sum(m[2] for m in messages), sum(m[3] for m in messages)]
+        self._trim(entry)
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self._bytes -= old[3]
+            self._entries[session_id] = entry
+            self._bytes += entry[3]
+            self._evict()
+
+    def append(self, session_id, messages):
+        """向已缓存的会话追加消息 [(role, content), ...]；会话不在缓存中时忽略"""
+        new_messages = [self._make_message(role, content) for role, content in messages]
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            entry[1].extend(new_messages)
+            added = sum(m[3] for m in new_messages)
+            entry[2] += sum(m[2] for m in new_messages)
+            entry[3] += added
+            self._bytes += added - self._trim(entry)
+            self._entries.move_to_end(session_id)
+            self._evict()
+
+    def invalidate(self, session_id):
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self._bytes -= entry[3]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def size_bytes(self):
+        return self._bytes
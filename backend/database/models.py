@@ -12,6 +12,8 @@ class User(db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
+    # 是否关闭简单查询答案缓存（关闭后该用户的问题既不读取也不写入缓存）
+    answer_cache_opt_out = db.Column(db.Boolean, default=False, nullable=False, server_default=db.false())
 
     def __init__(self, username, password):
         self.username = username
@@ -28,7 +30,8 @@ class User(db.Model):
             'id': self.id,
             'username': self.username,
             'created_at': self.created_at.isoformat() if self.created_at else None,
-            'last_login': self.last_login.isoformat() if self.last_login else None
+            'last_login': self.last_login.isoformat() if self.last_login else None,
+            'answer_cache_opt_out': self.answer_cache_opt_out
         }
 
     def __repr__(self):
@@ -37,6 +40,10 @@ class User(db.Model):
 # 添加聊天会话模型
 class ChatSession(db.Model):
     __tablename__ = 'chat_sessions'
+    __table_args__ = (
+        # 会话列表：按用户过滤活跃会话，并按 (last_activity, id) 倒序游标分页
+        db.Index('ix_chat_sessions_user_id_is_active_last_activity', 'user_id', 'is_active', 'last_activity', 'id'),
+    )
     
     id = db.Column(db.String(36), primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
@@ -64,6 +71,12 @@ class ChatSession(db.Model):
 # 添加聊天消息模型
 class ChatMessage(db.Model):
     __tablename__ = 'chat_messages'
+    __table_args__ = (
+        # 按会话读取最近消息及分页查询使用 (session_id, id) 范围扫描
+        db.Index('ix_chat_messages_session_id_id', 'session_id', 'id'),
+        # 会话标题回填：取每个会话的第一条用户消息
+        db.Index('ix_chat_messages_session_id_role_id', 'session_id', 'role', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(36), db.ForeignKey('chat_sessions.id'), nullable=False)
@@ -85,4 +98,91 @@ class ChatMessage(db.Model):
         }
         
     def __repr__(self):
-        return f'<ChatMessage {self.id}>' 
\ No newline at end of file
+        return f'<ChatMessage {self.id}>' 
+
+# 大模型调用用量记录（只追加）
+class LLMUsage(db.Model):
+    __tablename__ = 'llm_usage'
+    __table_args__ = (
+        # 按时间范围汇总
+        db.Index('ix_llm_usage_created_at', 'created_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # 调用所在的流水线阶段：classify / auxiliary_a / auxiliary_b / easy_answer / r1 / original_api / ner_correction / entity_analysis
+    route = db.Column(db.String(32), nullable=False)
+    model = db.Column(db.String(64), nullable=False)
+    prompt_tokens = db.Column(db.Integer, nullable=False, default=0)
+    completion_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cached_tokens = db.Column(db.Integer, nullable=False, default=0)
+    latency_ms = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='ok')
+    session_id = db.Column(db.String(36), nullable=True)
+    
+    def __repr__(self):
+        return f'<LLMUsage {self.route} {self.model}>'
+
+# NER 文件后台任务（大文件分段处理，每段完成后写入检查点）
+class NerJob(db.Model):
+    __tablename__ = 'ner_jobs'
+    __table_args__ = (
+        # 工作线程按提交顺序领取排队中（或心跳超时）的任务
+        db.Index('ix_ner_jobs_status_created_at', 'status', 'created_at'),
+    )
+    
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    filename = db.Column(db.String(255), nullable=False)
+    model_type = db.Column(db.String(8), nullable=False)
+    enable_llm = db.Column(db.Boolean, nullable=False, default=False)
+    content = db.Column(db.Text, nullable=False)
+    # queued / running / completed / failed
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    error = db.Column(db.Text, nullable=True)
+    total_segments = db.Column(db.Integer, nullable=False)
+    completed_segments = db.Column(db.Integer, nullable=False, default=0)
+    total_chars = db.Column(db.Integer, nullable=False)
+    completed_chars = db.Column(db.Integer, nullable=False, default=0)
+    # 已完成分段的累计处理耗时（秒），用于估算剩余时间
+    processing_seconds = db.Column(db.Float, nullable=False, default=0.0)
+    # 领取任务的工作线程标识及其心跳时间，心跳超时的任务会被其他工作线程接管
+    claim_token = db.Column(db.String(32), nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<NerJob {self.id} {self.status}>'
+
+class NerJobSegment(db.Model):
+    __tablename__ = 'ner_job_segments'
+    
+    job_id = db.Column(db.String(36), db.ForeignKey('ner_jobs.id'), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True)
+    # 分段在原文中的起始位置
+    offset = db.Column(db.Integer, nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    # 逐字的 [标签, 来源] 列表（JSON），为空表示尚未处理
+    labels = db.Column(db.Text, nullable=True)
+    processed_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<NerJobSegment {self.job_id}#{self.seq}>'
+
+# 实体解析词条（与上下文无关的通用解释，由 entity_analysis.py precompute 预先生成）
+class EntityGlossary(db.Model):
+    __tablename__ = 'entity_glossary'
+    
+    model_type = db.Column(db.String(1), primary_key=True)
+    entity_type = db.Column(db.String(8), primary_key=True)
+    entity_text = db.Column(db.String(64), primary_key=True)
+    analysis = db.Column(db.Text, nullable=False)
+    model = db.Column(db.String(64), nullable=False)
+    # 生成词条时该实体在历史识别结果中出现的次数
+    frequency = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f'<EntityGlossary {self.model_type}:{self.entity_type}:{self.entity_text}>'
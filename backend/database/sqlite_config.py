@@ -0,0 +1,38 @@
+import os
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from database.chat_search import register_functions
+
+# SQLite 连接参数，均可通过环境变量调整
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', str(64 * 1024)))
+
+
+def apply_sqlite_pragmas(dbapi_connection):
+    """
+    为SQLite连接设置性能相关的PRAGMA
+    - WAL：读写互不阻塞，多个worker可以并发读
+    - synchronous=NORMAL：WAL模式下只在检查点时fsync，事务提交不再逐次落盘
+    - busy_timeout：写锁冲突时等待而不是立即报 database is locked
+    - mmap_size / cache_size：减少读路径上的系统调用和页缓存未命中
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cursor.close()
+
+
+@event.listens_for(Engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    """对所有SQLite引擎的新连接应用PRAGMA并注册全文索引函数（其他数据库不受影响）"""
+    if type(dbapi_connection).__module__.startswith("sqlite3"):
+        apply_sqlite_pragmas(dbapi_connection)
+        register_functions(dbapi_connection)
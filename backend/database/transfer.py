@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+聊天记录的批量导出与导入（NDJSON，可选 gzip 压缩）
+
+导出文件每行一个 JSON 对象，先输出全部会话，再按 (session_id, id) 顺序输出全部消息：
+    {"type": "session", "id": ..., "username": ..., "title": ..., "created_at": ..., "last_activity": ..., "is_active": ...}
+    {"type": "message", "session_id": ..., "role": ..., "content": ..., "created_at": ..., "routing_info": ...}
+
+- 导出使用流式游标逐行读取、逐行编码，内存占用与记录数无关
+- 导入按批（TRANSFER_BATCH_SIZE 行）用 executemany 插入，每批一个事务，不会长时间占用写锁
+- 会话 ID 原样保留，已存在的会话连同其消息一起跳过，因此重复导入同一文件是安全的；消息 ID 由目标库重新分配
+- 会话归属按用户名对应到目标库的用户，目标库中不存在的用户名导入为未归属会话
+- 会话按用户隔离之前创建的会话都没有归属用户，可用 claim 把它们归属到指定用户
+
+命令行用法：
+    python database/transfer.py export chats.ndjson.gz
+    python database/transfer.py import chats.ndjson.gz
+    python database/transfer.py export - --username alice | gzip > alice.ndjson.gz
+    python database/transfer.py claim alice [--session-id ID ...]
+"""
+
+import argparse
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import zlib
+from datetime import datetime
+
+from sqlalchemy import create_engine, select
+
+logger = logging.getLogger(__name__)
+
+# 导入时每批插入的行数
+TRANSFER_BATCH_SIZE = int(os.getenv("TRANSFER_BATCH_SIZE", "5000"))
+# 导出时游标每次从数据库取出的行数
+TRANSFER_FETCH_SIZE = 1000
+# gzip 压缩级别：导出以吞吐量为主，使用较低的级别
+TRANSFER_GZIP_LEVEL = 3
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def _tables():
+    from database.models import User, ChatSession, ChatMessage
+    return User.__table__, ChatSession.__table__, ChatMessage.__table__
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def iter_export_records(conn, user_id=None):
+    """
+    按导出顺序逐条生成会话和消息记录（dict）
+    user_id 不为 None 时只导出该用户的会话
+    """
+    users, sessions, messages = _tables()
+    stream = conn.execution_options(stream_results=True, yield_per=TRANSFER_FETCH_SIZE)
+
+    session_query = select(
+        sessions.c.id, users.c.username, sessions.c.title, sessions.c.created_at,
+        sessions.c.last_activity, sessions.c.is_active
+    ).select_from(sessions.outerjoin(users, sessions.c.user_id == users.c.id)).order_by(sessions.c.id)
+    message_query = select(
+        messages.c.session_id, messages.c.role, messages.c.content, messages.c.created_at, messages.c.routing_info
+    ).order_by(messages.c.session_id, messages.c.id)
+    if user_id is not None:
+        session_query = session_query.where(sessions.c.user_id == user_id)
+        message_query = message_query.where(messages.c.session_id.in_(
+            select(sessions.c.id).where(sessions.c.user_id == user_id)
+        ))
+
+    for row in stream.execute(session_query):
+        yield {
+            "type": "session",
+            "id": row.id,
+            "username": row.username,
+            "title": row.title,
+            "created_at": _isoformat(row.created_at),
+            "last_activity": _isoformat(row.last_activity),
+            "is_active": row.is_active
+        }
+    for row in stream.execute(message_query):
+        yield {
+            "type": "message",
+            "session_id": row.session_id,
+            "role": row.role,
+            "content": row.content,
+            "created_at": _isoformat(row.created_at),
+            "routing_info": row.routing_info
+        }
+
+
+def iter_export_lines(engine, user_id=None, compress=False):
+    """逐块生成导出文件内容（bytes），compress 为 True 时输出 gzip 格式"""
+    compressor = zlib.compressobj(TRANSFER_GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+    buffer = []
+    buffered = 0
+    with engine.connect() as conn:
+        for record in iter_export_records(conn, user_id):
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            buffer.append(line)
+            buffered += len(line)
+            # 攒到一定大小再输出，减少响应分块和压缩调用的次数
+            if buffered >= 64 * 1024:
+                chunk = b"".join(buffer)
+                buffer, buffered = [], 0
+                yield compressor.compress(chunk) if compressor else chunk
+    chunk = b"".join(buffer)
+    if compressor:
+        yield compressor.compress(chunk) + compressor.flush()
+    elif chunk:
+        yield chunk
+
+
+def open_ndjson(fileobj):
+    """把二进制文件对象包装为按行读取的文本流，自动识别 gzip 压缩"""
+    if not hasattr(fileobj, "peek"):
+        fileobj = io.BufferedReader(fileobj)
+    if fileobj.peek(2)[:2] == GZIP_MAGIC:
+        fileobj = gzip.GzipFile(fileobj=fileobj)
+    return io.TextIOWrapper(fileobj, encoding="utf-8")
+
+
+class TransferFormatError(ValueError):
+    """导入文件格式错误"""
+
+
+class ChatImporter:
+    """按批写入会话和消息；owner_id 不为 None 时所有会话都归属该用户"""
+
+    def __init__(self, engine, owner_id=None, batch_size=TRANSFER_BATCH_SIZE):
+        self.engine = engine
+        self.owner_id = owner_id
+        self.batch_size = batch_size
+        self.stats = {"sessions": 0, "messages": 0, "skipped_sessions": 0, "skipped_messages": 0}
+        self._user_ids = {}  # 用户名 -> 目标库用户 ID（不存在时为 None）
+        self._accepted = set()  # 本次导入新建的会话 ID
+        self._sessions = []
+        self._messages = []
+
+    def _resolve_user(self, conn, username):
+        if self.owner_id is not None:
+            return self.owner_id
+        if not username:
+            return None
+        if username not in self._user_ids:
+            users, _, _ = _tables()
+            self._user_ids[username] = conn.execute(
+                select(users.c.id).where(users.c.username == username)
+            ).scalar()
+        return self._user_ids[username]
+
+    def _flush(self):
+        if not self._sessions and not self._messages:
+            return
+        _, sessions, messages = _tables()
+        with self.engine.begin() as conn:
+            if self._sessions:
+                ids = [row["id"] for row in self._sessions]
+                existing = {row[0] for row in conn.execute(select(sessions.c.id).where(sessions.c.id.in_(ids)))}
+                rows = []
+                for row in self._sessions:
+                    if row["id"] in existing or row["id"] in self._accepted:
+                        self.stats["skipped_sessions"] += 1
+                        continue
+                    self._accepted.add(row["id"])
+                    row["user_id"] = self._resolve_user(conn, row.pop("username"))
+                    rows.append(row)
+                if rows:
+                    conn.execute(sessions.insert(), rows)
+                    self.stats["sessions"] += len(rows)
+            rows = [row for row in self._messages if row["session_id"] in self._accepted]
+            self.stats["skipped_messages"] += len(self._messages) - len(rows)
+            if rows:
+                conn.execute(messages.insert(), rows)
+                self.stats["messages"] += len(rows)
+        self._sessions, self._messages = [], []
+
+    def add(self, record):
+        kind = record.get("type")
+        if kind == "session":
+            self._sessions.append({
+                "id": record["id"],
+                "username": record.get("username"),
+                "title": record.get("title"),
+                "created_at": _parse_datetime(record.get("created_at")) or datetime.utcnow(),
+                "last_activity": _parse_datetime(record.get("last_activity")) or datetime.utcnow(),
+                "is_active": record.get("is_active", True)
+            })
+        elif kind == "message":
+            self._messages.append({
+                "session_id": record["session_id"],
+                "role": record["role"],
+                "content": record["content"],
+                "created_at": _parse_datetime(record.get("created_at")) or datetime.utcnow(),
+                "routing_info": record.get("routing_info")
+            })
+        else:
+            raise TransferFormatError(f"未知的记录类型: {kind}")
+        if len(self._sessions) + len(self._messages) >= self.batch_size:
+            self._flush()
+
+    def import_lines(self, lines):
+        """导入按行读取的 NDJSON 内容，返回统计信息"""
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                self.add(record)
+            except (ValueError, KeyError, TypeError) as e:
+                raise TransferFormatError(f"第 {lineno} 行无效: {e}") from e
+        self._flush()
+        return self.stats
+
+
+def import_ndjson(engine, fileobj, owner_id=None):
+    """从二进制文件对象导入聊天记录（自动识别 gzip），返回统计信息"""
+    try:
+        return ChatImporter(engine, owner_id).import_lines(open_ndjson(fileobj))
+    except (OSError, EOFError, UnicodeDecodeError) as e:
+        # gzip 数据损坏、文件被截断或不是 UTF-8 编码
+        raise TransferFormatError(f"无法读取文件: {e}") from e
+
+
+def claim_sessions(engine, owner_id, session_ids=None):
+    """把未归属任何用户的会话（session_ids 为空时为全部）归属到 owner_id，返回归属的会话数"""
+    _, sessions, _ = _tables()
+    statement = sessions.update().where(sessions.c.user_id.is_(None)).values(user_id=owner_id)
+    if session_ids:
+        statement = statement.where(sessions.c.id.in_(list(session_ids)))
+    with engine.begin() as conn:
+        return conn.execute(statement).rowcount
+
+
+def main(argv=None):
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    default_url = os.getenv(
+        "DATABASE_URL", f"sqlite:///{os.path.join(backend_dir, 'database', 'app.db')}"
+    )
+
+    parser = argparse.ArgumentParser(description="导出或导入聊天记录（NDJSON）")
+    parser.add_argument("--database-url", default=default_url)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="导出聊天记录")
+    export_parser.add_argument("path", help="输出文件，以 .gz 结尾时使用 gzip 压缩；- 表示标准输出")
+    export_parser.add_argument("--username", help="只导出该用户的会话")
+    export_parser.add_argument("--gzip", action="store_true", help="强制使用 gzip 压缩")
+    import_parser = subparsers.add_parser("import", help="导入聊天记录")
+    import_parser.add_argument("path", help="NDJSON 文件（可以是 gzip 压缩的）；- 表示标准输入")
+    import_parser.add_argument("--owner", help="所有会话都归属该用户名，而不是按文件中的用户名对应")
+    claim_parser = subparsers.add_parser("claim", help="把未归属的会话归属到指定用户")
+    claim_parser.add_argument("username", help="会话归属的用户名")
+    claim_parser.add_argument("--session-id", action="append", dest="session_ids",
+                              help="只归属指定的会话，可重复；不指定时归属全部未归属的会话")
+    args = parser.parse_args(argv)
+
+    sys.path.append(backend_dir)
+    import database.sqlite_config  # noqa: F401
+    from database.models import db
+
+    engine = create_engine(args.database_url)
+    users, _, _ = _tables()
+
+    def lookup_user(username):
+        with engine.connect() as conn:
+            user_id = conn.execute(select(users.c.id).where(users.c.username == username)).scalar()
+        if user_id is None:
+            parser.error(f"用户不存在: {username}")
+        return user_id
+
+    if args.command == "export":
+        user_id = lookup_user(args.username) if args.username else None
+        compress = args.gzip or args.path.endswith(".gz")
+        out = sys.stdout.buffer if args.path == "-" else open(args.path, "wb")
+        try:
+            for chunk in iter_export_lines(engine, user_id, compress):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        return 0
+
+    if args.command == "claim":
+        claimed = claim_sessions(engine, lookup_user(args.username), args.session_ids)
+        print(f"已将 {claimed} 个未归属的会话归属到 {args.username}")
+        return 0
+
+    db.metadata.create_all(engine)
+    owner_id = lookup_user(args.owner) if args.owner else None
+    source = sys.stdin.buffer if args.path == "-" else open(args.path, "rb")
+    try:
+        stats = import_ndjson(engine, source, owner_id)
+    except TransferFormatError as e:
+        print(f"导入失败: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+    print(json.dumps(stats, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+聊天记录的写入
+
+一轮对话（可能新建的会话、用户消息、AI回复、会话最后活动时间）作为一个整体在同一事务中写入。
+开启 write-behind（环境变量 CHAT_WRITE_BEHIND=1）后，对话记录交给后台线程，
+将多个并发对话的写入合并为批量事务，数据库写入不再占用响应时间；进程退出时会先把队列中的记录全部落盘。
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import bindparam, select
+
+from database.models import db, ChatSession, ChatMessage
+from metrics import CHAT_STAGE_SECONDS, CHAT_WRITE_DROPPED
+from llm_usage import insert_usage_records
+
+logger = logging.getLogger(__name__)
+
+# 每个批量事务最多包含的对话轮数
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BEHIND_BATCH_SIZE", "100"))
+# 凑批的最长等待时间（秒）
+WRITE_BEHIND_MAX_WAIT = float(os.getenv("CHAT_WRITE_BEHIND_MAX_WAIT", "0.05"))
+# 队列上限，写满后提交方阻塞等待（反压）
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("CHAT_WRITE_BEHIND_MAX_QUEUE", "10000"))
+# 批量事务失败时的重试次数
+WRITE_BEHIND_RETRIES = 3
+
+
+def write_chat_turns(conn, turns):
+    """
+    在给定连接的当前事务中写入若干轮对话
+    每轮对话为 dict：session_id, user_id, create_session, messages, last_activity, usage，
+    messages 中每条为 dict：role, content, routing_info, created_at；usage 为本轮的大模型调用记录
+    """
+    sessions = ChatSession.__table__
+    messages = ChatMessage.__table__
+
+    # 需要新建的会话（同一批中可能有多轮对话属于同一个新会话）
+    new_sessions = {}
+    for turn in turns:
+        if turn["create_session"]:
+            new_sessions.setdefault(turn["session_id"], turn)
+    if new_sessions:
+        existing = {row[0] for row in conn.execute(
+            select(sessions.c.id).where(sessions.c.id.in_(list(new_sessions)))
+        )}
+        rows = [{
+            "id": session_id,
+            "user_id": turn["user_id"],
+            "created_at": turn["messages"][0]["created_at"],
+            "last_activity": turn["last_activity"],
+            "is_active": True
+        } for session_id, turn in new_sessions.items() if session_id not in existing]
+        if rows:
+            conn.execute(sessions.insert(), rows)
+
+    conn.execute(messages.insert(), [
+        dict(message, session_id=turn["session_id"])
+        for turn in turns for message in turn["messages"]
+    ])
+
+    last_activity = {}
+    for turn in turns:
+        current = last_activity.get(turn["session_id"])
+        if current is None or turn["last_activity"] > current:
+            last_activity[turn["session_id"]] = turn["last_activity"]
+    conn.execute(
+        sessions.update().where(sessions.c.id == bindparam("b_id")).values(
+            last_activity=bindparam("b_last_activity")
+        ),
+        [{"b_id": session_id, "b_last_activity": value} for session_id, value in last_activity.items()]
+    )
+
+    insert_usage_records(conn, [
+        dict(record, session_id=turn["session_id"]) for turn in turns for record in turn.get("usage", ())
+    ])
+
+
+class ChatWriteBehind:
+    """对话记录的后台批量写入队列"""
+
+    def __init__(self):
+        self.enabled = False
+        self._app = None
+        self._queue = None
+        self._thread = None
+        self._pending = Counter()
+        self._submitting = 0  # 已通过 enabled 检查、尚未放入队列的提交数
+        self._condition = threading.Condition()
+
+    def init_app(self, app):
+        self.enabled = app.config.get("CHAT_WRITE_BEHIND", False)
+        if not self.enabled or self._thread is not None:
+            return
+        self._app = app
+        self._queue = queue.Queue(maxsize=WRITE_BEHIND_MAX_QUEUE)
+        self._thread = threading.Thread(target=self._run, name="chat-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def submit(self, turn):
+        """提交一轮对话，由后台线程写入；队列已停止时返回 False，由调用方同步写入"""
+        with self._condition:
+            if not self.enabled:
+                return False
+            self._pending[turn["session_id"]] += 1
+            self._submitting += 1
+        try:
+            self._queue.put(turn)
+        finally:
+            with self._condition:
+                self._submitting -= 1
+                self._condition.notify_all()
+        return True
+
+    def flush(self, session_id=None, timeout=10.0):
+        """
+        等待尚未落盘的写入完成；指定 session_id 时只等待该会话
+        没有待写入记录时立即返回，保证随后的读取能看到本进程之前提交的对话
+        """
+        if not self.enabled:
+            return True
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while (self._pending[session_id] if session_id else sum(self._pending.values())) > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning("等待聊天记录落盘超时")
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def shutdown(self):
+        """停止后台线程，并把队列中剩余的记录全部写入数据库"""
+        if self._thread is None:
+            return
+        # 此后提交的对话改为同步写入；等正在入队的对话放入队列后再放入结束标记，保证它们都会被写入
+        with self._condition:
+            self.enabled = False
+            while self._submitting:
+                self._condition.wait()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        logger.info("聊天记录写入队列已清空")
+
+    def _collect_batch(self, first):
+        batch = [first]
+        deadline = time.monotonic() + WRITE_BEHIND_MAX_WAIT
+        while len(batch) < WRITE_BEHIND_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write_batch(self, engine, batch):
+        for attempt in range(1, WRITE_BEHIND_RETRIES + 1):
+            try:
+                with CHAT_STAGE_SECONDS.time(stage="db_write_batch"):
+                    with engine.begin() as conn:
+                        write_chat_turns(conn, batch)
+                return
+            except Exception as e:
+                logger.error(f"批量写入聊天记录失败（第{attempt}次）: {str(e)}")
+                time.sleep(0.1 * attempt)
+        if len(batch) == 1:
+            self._drop(batch[0])
+            return
+        # 批量事务始终失败时逐轮写入，只丢弃本身写不进去的对话
+        for turn in batch:
+            try:
+                with engine.begin() as conn:
+                    write_chat_turns(conn, [turn])
+            except Exception as e:
+                logger.error(f"写入聊天记录失败: {str(e)}")
+                self._drop(turn)
+
+    @staticmethod
+    def _drop(turn):
+        CHAT_WRITE_DROPPED.inc()
+        logger.error(f"放弃写入会话 {turn['session_id']} 的一轮对话")
+
+    def _run(self):
+        with self._app.app_context():
+            engine = db.engine
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stopping = self._collect_batch(first)
+            self._write_batch(engine, batch)
+            with self._condition:
+                for turn in batch:
+                    self._pending[turn["session_id"]] -= 1
+                    if self._pending[turn["session_id"]] <= 0:
+                        del self._pending[turn["session_id"]]
+                self._condition.notify_all()
+
+
+chat_writer = ChatWriteBehind()
+
+
+def persist_chat_turn(turn):
+    """持久化一轮对话：开启 write-behind 时交给后台线程，否则在一个事务中同步写入"""
+    if chat_writer.submit(turn):
+        return
+    write_chat_turns(db.session.connection(), [turn])
+    db.session.commit()
@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# backend/entity_analysis.py
+"""
+实体解析（/api/ner/entity_analysis）的提示词与两级缓存
+
+NER 界面中每点击一次实体就请求一次大模型，而孔子、长安、伤寒论、足三里这类常见实体在相近的上下文中被反复解释。
+
+- 精确缓存：按 (模型类型, 实体类型, 实体文本, 实体前后上下文窗口的摘要) 缓存完整解析，进程内 LRU + TTL
+- 词条：按 (模型类型, 实体类型, 实体文本) 保存与上下文无关的通用解释（entity_glossary 表），
+  精确缓存未命中时可以先返回词条作为即时的初步解释，再按需请求结合上下文的解析
+- 词条由命令行预先生成：统计历史识别结果（NER 后台任务的分段结果，以及 /api/ner/file 下载的结果文件）中
+  出现次数最多的实体，并发请求大模型写入词条表
+
+    python entity_analysis.py precompute --top 200
+    python entity_analysis.py precompute --model-type C --input NER_a_result.txt --min-count 3
+
+整篇文档的批量解析（/api/ner/entity_analysis/batch）先按 (实体类型, 实体文本) 去重并查找两级缓存，
+其余实体按 token 预算合并为多实体提示词，用有界线程池并发请求，结果按完成顺序逐个返回
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import requests
+
+from database.models import db, EntityGlossary, NerJob, NerJobSegment
+from llm_usage import track_llm_call, take_usage_records, insert_usage_records
+from metrics import REGISTRY, CACHE_REQUESTS
+from utils import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# 精确缓存的条目数上限
+ENTITY_CACHE_MAX_ENTRIES = int(os.getenv("ENTITY_CACHE_MAX_ENTRIES", "5000"))
+# 精确缓存的有效期（秒）
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", str(7 * 24 * 3600)))
+# 计算上下文摘要时取实体前后各多少个字
+ENTITY_CONTEXT_WINDOW = int(os.getenv("ENTITY_CONTEXT_WINDOW", "50"))
+# 预生成词条时的并发请求数
+ENTITY_GLOSSARY_CONCURRENCY = int(os.getenv("ENTITY_GLOSSARY_CONCURRENCY", "4"))
+# 批量解析：每个实体附带的上下文（实体前后各多少个字）
+ENTITY_BATCH_CONTEXT_CHARS = int(os.getenv("ENTITY_BATCH_CONTEXT_CHARS", "60"))
+# 批量解析：合并提示词的 token 预算；单个实体的内容超过预算一半时单独请求
+ENTITY_BATCH_PROMPT_TOKENS = int(os.getenv("ENTITY_BATCH_PROMPT_TOKENS", "1500"))
+# 批量解析：一个合并提示词中最多的实体数
+ENTITY_BATCH_GROUP_SIZE = int(os.getenv("ENTITY_BATCH_GROUP_SIZE", "8"))
+# 批量解析：每个请求同时进行的大模型调用数
+ENTITY_BATCH_CONCURRENCY = int(os.getenv("ENTITY_BATCH_CONCURRENCY", "4"))
+# 批量解析：每个请求最多的实体标注数
+ENTITY_BATCH_MAX_SPANS = int(os.getenv("ENTITY_BATCH_MAX_SPANS", "500"))
+
+GLOSSARY_LOOKUPS = REGISTRY.counter(
+    "entity_glossary_lookups_total", "实体解析词条查询次数", ("result",))
+
+# 实体类型的中文描述
+ENTITY_TYPE_DESCRIPTIONS = {
+    "A": {
+        "NR": "人名", "NS": "地名", "NB": "书名",
+        "NO": "官职名", "NG": "国家名", "T": "时间"
+    },
+    "C": {
+        "ZD": "中医疾病", "ZZ": "证候", "ZF": "中药方剂",
+        "ZP": "中药饮片", "ZS": "症状", "ZA": "穴位"
+    }
+}
+
+# 结合上下文的解析提示词
+ANALYSIS_PROMPTS = {
+    # 历史模型的提示词
+    "A": """你是古汉语领域专家，请解释以下古汉语文本中标注的实体。
+文本上下文：{context_text}
+实体：{entity_text}
+实体类型：{entity_type_desc}
+
+请根据实体类型提供详细解释，包括：
+1. 该实体在古汉语中的含义、来源和背景知识
+2. 在文本中的具体作用和意义
+3. 相关历史背景信息
+4. 如有必要，提供现代解释或对应概念
+
+请以学术严谨的态度回答，如果信息不足或有歧义，请明确指出。回答需要全面但简洁，使用通俗易懂的语言。""",
+    # 医疗模型的提示词
+    "C": """你是古代中医文献专家，请解释以下古代中医文本中标注的实体。
+文本上下文：{context_text}
+实体：{entity_text}
+实体类型：{entity_type_desc}
+
+请根据实体类型提供详细解释，包括：
+1. 该实体在中医学中的含义、功效和应用
+2. 在文本中的具体医学意义
+3. 相关中医理论背景
+4. 如有可能，提供现代医学对应的解释
+
+请以专业严谨的态度回答，如果信息不足或有歧义，请明确指出。回答需要专业且易懂，方便理解古代中医知识。"""
+}
+
+# 与上下文无关的词条提示词
+GLOSSARY_PROMPTS = {
+    "A": """你是古汉语领域专家，请为以下实体编写一条简明的词条解释。
+实体：{entity_text}
+实体类型：{entity_type_desc}
+
+请说明该实体的基本含义、来源和相关历史背景；如有多种常见含义请分别列出。
+回答需要学术严谨、简洁易懂，不超过300字。""",
+    "C": """你是古代中医文献专家，请为以下实体编写一条简明的词条解释。
+实体：{entity_text}
+实体类型：{entity_type_desc}
+
+请说明该实体在中医学中的含义、功效或应用，以及相关的中医理论背景；如有多种常见含义请分别列出。
+回答需要专业严谨、简洁易懂，不超过300字。"""
+}
+
+# 批量解析的合并提示词，{entities} 为编号的实体及其上下文片段
+BATCH_PROMPTS = {
+    "A": """你是古汉语领域专家，请逐一解释以下古汉语文本中标注的实体，每个实体附有所在的上下文片段。
+
+{entities}
+
+请简要说明每个实体在古汉语中的含义、来源和在上下文中的作用，每个实体不超过150字；信息不足或有歧义时请明确指出。
+只输出JSON，格式为：{{"results": [{{"id": 实体编号, "analysis": "解释"}}]}}""",
+    "C": """你是古代中医文献专家，请逐一解释以下古代中医文本中标注的实体，每个实体附有所在的上下文片段。
+
+{entities}
+
+请简要说明每个实体在中医学中的含义、功效或应用，以及在上下文中的医学意义，每个实体不超过150字；信息不足或有歧义时请明确指出。
+只输出JSON，格式为：{{"results": [{{"id": 实体编号, "analysis": "解释"}}]}}"""
+}
+
+# /api/ner/file 结果文件中的实体标记：[实体文本]{标签}
+RESULT_ENTITY_PATTERN = re.compile(r"\[([^\[\]]+)\]\{([^{}]+)\}")
+
+
+def base_entity_type(entity_type):
+    """去掉 BIOES 前缀：B-NR -> NR"""
+    return entity_type.rsplit("-", 1)[-1]
+
+
+def entity_type_description(model_type, entity_type):
+    return ENTITY_TYPE_DESCRIPTIONS.get(model_type, {}).get(entity_type, entity_type)
+
+
+def analysis_prompt(model_type, entity_text, entity_type, context_text):
+    return ANALYSIS_PROMPTS[model_type].format(
+        context_text=context_text,
+        entity_text=entity_text,
+        entity_type_desc=entity_type_description(model_type, entity_type)
+    )
+
+
+def glossary_prompt(model_type, entity_text, entity_type):
+    return GLOSSARY_PROMPTS[model_type].format(
+        entity_text=entity_text,
+        entity_type_desc=entity_type_description(model_type, entity_type)
+    )
+
+
+def context_digest(context_text, entity_text, window=ENTITY_CONTEXT_WINDOW):
+    """
+    实体首次出现位置前后各 window 个字（去除空白）的摘要；
+    window 为 None 或上下文中找不到实体时使用整个上下文
+    """
+    position = context_text.find(entity_text)
+    if window is not None and position >= 0:
+        context_text = context_text[max(0, position - window):position + len(entity_text) + window]
+    normalized = re.sub(r"\s+", "", context_text)
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+class EntityAnalysisCache:
+    """
+    结合上下文的实体解析结果缓存（LRU + TTL）
+    缓存键包含提示词类型：single 为单实体接口（上下文为整篇文本），
+    batch 为批量接口（上下文为实际发送的实体片段，回答较短），两者互不复用
+    """
+
+    def __init__(self, max_entries=ENTITY_CACHE_MAX_ENTRIES, ttl=ENTITY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # 缓存键 -> (写入时间, 解析内容)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_type, entity_type, entity_text, context_text, variant="single"):
+        window = ENTITY_CONTEXT_WINDOW if variant == "single" else None
+        return (
+            variant, model_type, base_entity_type(entity_type), entity_text,
+            context_digest(context_text, entity_text, window)
+        )
+
+    def get(self, key):
+        """返回缓存的解析内容，未命中时返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and now - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                CACHE_REQUESTS.inc(cache="entity_analysis", result="miss")
+                return None
+            self._entries.move_to_end(key)
+        CACHE_REQUESTS.inc(cache="entity_analysis", result="hit")
+        return entry[1]
+
+    def put(self, key, analysis):
+        if not analysis or not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), analysis)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+entity_analysis_cache = EntityAnalysisCache()
+
+
+def get_glossary(model_type, entity_type, entity_text):
+    """查询实体的通用词条，不存在时返回 None"""
+    entry = db.session.get(EntityGlossary, (model_type, base_entity_type(entity_type), entity_text))
+    GLOSSARY_LOOKUPS.inc(result="hit" if entry is not None else "miss")
+    return entry
+
+
+def save_glossary(model_type, entity_type, entity_text, analysis, model, frequency=0):
+    """写入或更新词条（在当前会话中，由调用方提交）"""
+    key = (model_type, base_entity_type(entity_type), entity_text)
+    entry = db.session.get(EntityGlossary, key)
+    if entry is None:
+        entry = EntityGlossary(model_type=key[0], entity_type=key[1], entity_text=key[2])
+        db.session.add(entry)
+    entry.analysis = analysis
+    entry.model = model
+    entry.frequency = frequency
+    entry.updated_at = datetime.utcnow()
+    return entry
+
+
+def iter_entities(chars, labels):
+    """
+    按逐字标签切出实体，产生 (实体类型, 实体文本)
+    同时支持 BIOES 标签（B-NR、E-NR 等）和大模型修正后的纯类型标签（NR）
+    """
+    current_type, buffer = None, []
+    for char, label in zip(chars, labels):
+        prefix, _, entity_type = label.rpartition("-")
+        if entity_type in ("", "O"):
+            if buffer:
+                yield current_type, "".join(buffer)
+            current_type, buffer = None, []
+            continue
+        if buffer and entity_type == current_type and prefix not in ("B", "S"):
+            buffer.append(char)
+        else:
+            if buffer:
+                yield current_type, "".join(buffer)
+            current_type, buffer = entity_type, [char]
+        if prefix in ("E", "S"):
+            yield current_type, "".join(buffer)
+            current_type, buffer = None, []
+    if buffer:
+        yield current_type, "".join(buffer)
+
+
+def count_job_entities(model_type, counts):
+    """统计 NER 后台任务分段结果中各实体的出现次数"""
+    rows = db.session.query(NerJobSegment.text, NerJobSegment.labels).join(
+        NerJob, NerJob.id == NerJobSegment.job_id
+    ).filter(
+        NerJob.model_type == model_type, NerJobSegment.labels.isnot(None)
+    ).execution_options(yield_per=500)
+    for row in rows:
+        labels = [label for label, _ in json.loads(row.labels)]
+        counts.update(iter_entities(row.text, labels))
+
+
+def count_result_file_entities(path, counts):
+    """统计 /api/ner/file 结果文件（[实体文本]{标签} 格式）中各实体的出现次数"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            chars, labels = [], []
+            position = 0
+            for match in RESULT_ENTITY_PATTERN.finditer(line):
+                skipped = line[position:match.start()]
+                chars.extend(skipped)
+                labels.extend(["O"] * len(skipped))
+                chars.extend(match.group(1))
+                labels.extend([match.group(2)] * len(match.group(1)))
+                position = match.end()
+            counts.update(iter_entities(chars, labels))
+
+
+def request_completion(api, route, prompt):
+    """发起一次非流式的大模型调用并返回回答文本，api 为 (接口地址, API 密钥, 模型名, 超时秒数)"""
+    endpoint, api_key, model_name, timeout = api
+    with track_llm_call(route, model_name) as call:
+        response = requests.post(
+            endpoint,
+            headers={"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"},
+            json={
+                "model": model_name,
+                "messages": [{"role": "user", "content": prompt}],
+                "stream": False
+            },
+            timeout=timeout
+        )
+        response.raise_for_status()
+        response_json = response.json()
+        call.record(response_json.get("usage"))
+    return response_json.get("choices", [{}])[0].get("message", {}).get("content", "")
+
+
+def request_glossary(api, model_type, entity_type, entity_text):
+    """请求大模型生成一条词条"""
+    return request_completion(api, "entity_glossary", glossary_prompt(model_type, entity_text, entity_type))
+
+
+def entity_context(document, start, end, window=ENTITY_BATCH_CONTEXT_CHARS):
+    """实体（end 为最后一个字的位置）前后各 window 个字的上下文片段"""
+    return document[max(0, start - window):end + 1 + window]
+
+
+def batch_prompt(model_type, items):
+    """由若干实体（dict：entity_text、entity_type、context）生成合并提示词，实体从 1 开始编号"""
+    entities = "\n\n".join(
+        f"[{i}] 实体：{item['entity_text']}（{entity_type_description(model_type, item['entity_type'])}）\n"
+        f"上下文：{item['context']}"
+        for i, item in enumerate(items, 1)
+    )
+    return BATCH_PROMPTS[model_type].format(entities=entities)
+
+
+def parse_batch_response(content):
+    """解析合并提示词的回答，返回 {实体编号: 解释}；格式不对时返回空字典"""
+    start, end = content.find("{"), content.rfind("}")
+    try:
+        results = json.loads(content[start:end + 1]).get("results", [])
+        return {int(r["id"]): str(r["analysis"]) for r in results if r.get("analysis")}
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return {}
+
+
+def plan_batches(items, budget=ENTITY_BATCH_PROMPT_TOKENS, group_size=ENTITY_BATCH_GROUP_SIZE):
+    """
+    把待解析的实体按 token 预算分组：内容较少的实体合并到同一个提示词中，
+    超过预算一半的实体单独成组（使用完整的单实体提示词）
+    """
+    groups, current, used = [], [], 0
+    for item in items:
+        tokens = estimate_tokens(item["entity_text"] + item["context"])
+        if tokens * 2 > budget:
+            groups.append([item])
+            continue
+        if current and (used + tokens > budget or len(current) >= group_size):
+            groups.append(current)
+            current, used = [], 0
+        current.append(item)
+        used += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def analyze_group(app, api, model_type, group):
+    """
+    解析一组实体（在工作线程中执行），返回 ([(实体, 解释, 错误)], 用量记录)
+    合并回答中缺失的实体改用单实体提示词逐个请求
+    """
+    def single(item):
+        return request_completion(api, "entity_analysis", analysis_prompt(
+            model_type, item["entity_text"], item["entity_type"], item["context"]
+        ))
+
+    with app.app_context():
+        analyses = {}
+        if len(group) > 1:
+            try:
+                parsed = parse_batch_response(request_completion(
+                    api, "entity_analysis_batch", batch_prompt(model_type, group)
+                ))
+                analyses = {i: parsed.get(i + 1) for i in range(len(group))}
+            except Exception as e:
+                logger.warning(f"合并实体解析失败，改为逐个请求: {str(e)}")
+        results = []
+        for i, item in enumerate(group):
+            analysis, error = analyses.get(i), None
+            if not analysis:
+                try:
+                    analysis = single(item)
+                    if not analysis:
+                        error = "大模型返回内容为空"
+                except Exception as e:
+                    error = str(e)
+            results.append((item, analysis, error))
+        return results, take_usage_records()
+
+
+def run_batches(app, api, model_type, groups, concurrency=ENTITY_BATCH_CONCURRENCY):
+    """
+    用有界线程池并发解析各组实体，按完成顺序逐组产生 (结果列表, 用量记录)
+    调用方提前停止迭代（例如客户端断开）时取消尚未开始的分组
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="entity-batch")
+    try:
+        futures = [executor.submit(analyze_group, app, api, model_type, group) for group in groups]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def precompute_glossary(app, api, model_type, counts, top, min_count=1, refresh=False,
+                        concurrency=ENTITY_GLOSSARY_CONCURRENCY):
+    """为出现次数最多的 top 个实体生成词条，返回 (生成数, 跳过数, 失败数)"""
+    ranked = [(key, n) for key, n in counts.most_common(top) if n >= min_count]
+    candidates = ranked
+    if not refresh:
+        with app.app_context():
+            existing = {
+                (row.entity_type, row.entity_text)
+                for row in db.session.query(EntityGlossary.entity_type, EntityGlossary.entity_text).filter(
+                    EntityGlossary.model_type == model_type
+                )
+            }
+        candidates = [(key, n) for key, n in ranked if key not in existing]
+    skipped = len(ranked) - len(candidates)
+
+    def generate(entity_type, entity_text, frequency):
+        # 每个线程使用自己的应用上下文，词条与本次调用的用量记录在同一事务中写入
+        with app.app_context():
+            analysis = request_glossary(api, model_type, entity_type, entity_text)
+            if not analysis:
+                raise ValueError("大模型返回内容为空")
+            save_glossary(model_type, entity_type, entity_text, analysis, api[2], frequency)
+            insert_usage_records(db.session.connection(), take_usage_records())
+            db.session.commit()
+
+    created = failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(generate, entity_type, entity_text, n): entity_text
+            for (entity_type, entity_text), n in candidates
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+                created += 1
+            except Exception as e:
+                failed += 1
+                logger.warning(f"生成词条失败 {futures[future]}: {str(e)}")
+    return created, skipped, failed
+
+
+def main(argv=None):
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    default_url = os.getenv(
+        "DATABASE_URL", f"sqlite:///{os.path.join(backend_dir, 'database', 'app.db')}"
+    )
+
+    parser = argparse.ArgumentParser(description="预先生成实体解析词条")
+    parser.add_argument("--database-url", default=default_url)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    precompute = subparsers.add_parser("precompute", help="为历史识别结果中最常见的实体生成词条")
+    precompute.add_argument("--model-type", choices=["A", "C"], default="A")
+    precompute.add_argument("--top", type=int, default=200, help="最多生成多少个实体的词条")
+    precompute.add_argument("--min-count", type=int, default=2, help="实体至少出现的次数")
+    precompute.add_argument("--input", action="append", default=[], help="额外统计的 /api/ner/file 结果文件，可重复")
+    precompute.add_argument("--refresh", action="store_true", help="重新生成已有的词条")
+    precompute.add_argument("--concurrency", type=int, default=ENTITY_GLOSSARY_CONCURRENCY)
+    args = parser.parse_args(argv)
+
+    from flask import Flask
+    import database.sqlite_config  # noqa: F401
+    # 大模型接口配置与 NER 接口一致（环境变量和 config.ini）
+    from routes.ner_routes import config
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = args.database_url
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+
+    counts = Counter()
+    with app.app_context():
+        db.create_all()
+        count_job_entities(args.model_type, counts)
+    for path in args.input:
+        count_result_file_entities(path, counts)
+    print(f"历史识别结果中共有 {len(counts)} 个不同的实体")
+
+    api = (config.api_endpoint, config.api_key, config.selected_model_name, config.request_timeout)
+    created, skipped, failed = precompute_glossary(
+        app, api, args.model_type, counts, args.top, args.min_count, args.refresh, args.concurrency
+    )
+    print(f"生成词条 {created} 个，已存在跳过 {skipped} 个，失败 {failed} 个")
+    return 0 if not failed else 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
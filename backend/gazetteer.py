@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# backend/gazetteer.py
+"""
+词典预标注：用 Aho-Corasick 自动机在原文中一次线性扫描匹配整理好的实体词典
+
+词典按模型类型和实体类型存放，每行一个词条（空行和 # 开头的行忽略）：
+
+    lexicons/A/NR.txt  lexicons/A/NS.txt  lexicons/A/NB.txt  lexicons/A/NO.txt  lexicons/A/NG.txt  lexicons/A/T.txt
+    lexicons/C/ZD.txt  lexicons/C/ZZ.txt  lexicons/C/ZF.txt  lexicons/C/ZP.txt  lexicons/C/ZS.txt  lexicons/C/ZA.txt
+
+- 每个模型类型的全部词典编译为一个自动机，序列化到 lexicons/<模型类型>.gaz，之后启动时直接加载；
+  词典文件有改动（增删文件或修改时间变化）时自动重新编译
+- 同一词条出现在多个实体类型的词典中时，以实体类型在上面列表中的顺序靠前者为准
+- 匹配时一次扫描取出全部命中，再按"最左最长"选出互不重叠的实体，来源标记为 lexicon
+- 编译结果用 pickle 保存，只应加载本机生成的文件（与模型权重文件相同）
+
+命令行编译或检查词典：
+    python gazetteer.py build                       # 编译全部模型类型
+    python gazetteer.py build --model-type C
+    python gazetteer.py match --model-type A 孔子适卫见卫灵公
+"""
+import argparse
+import logging
+import os
+import pickle
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+
+from entity_analysis import ENTITY_TYPE_DESCRIPTIONS
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# 词典目录
+GAZETTEER_DIR = os.getenv(
+    "GAZETTEER_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "lexicons")
+)
+# 参与匹配的最短词条长度：单字词条在古文中歧义太大
+GAZETTEER_MIN_LENGTH = int(os.getenv("GAZETTEER_MIN_LENGTH", "2"))
+
+GAZETTEER_FORMAT_VERSION = 1
+# 转移表的键为 状态 * CHAR_RANGE + 字符码位，整张表是一个 int -> int 字典，序列化和加载都很快
+CHAR_RANGE = 0x110000
+
+GAZETTEER_HITS = REGISTRY.counter(
+    "gazetteer_hits_total", "词典预标注选出的实体数", ("model_type",))
+
+
+class Gazetteer:
+    """单个模型类型的 Aho-Corasick 自动机"""
+
+    def __init__(self, model_type, types, goto, fail, out_link, terminal, sources=None):
+        self.model_type = model_type
+        self.types = types  # 实体类型列表，terminal 中保存其下标
+        self.goto = goto  # 状态 * CHAR_RANGE + 码位 -> 下一状态
+        self.fail = fail  # 失配时跳转的状态
+        self.out_link = out_link  # 沿失配链最近的词条结束状态（0 表示没有）
+        self.terminal = terminal  # 词条结束状态 -> (词条长度, 实体类型下标)
+        self.sources = sources or {}  # 编译时各词典文件的修改时间
+
+    @classmethod
+    def build(cls, model_type, entries, sources=None):
+        """由 (词条, 实体类型) 序列编译自动机；同一词条只保留第一次出现的实体类型"""
+        types = list(ENTITY_TYPE_DESCRIPTIONS[model_type])
+        type_index = {entity_type: i for i, entity_type in enumerate(types)}
+        goto = {}
+        fail = array("i", [0])
+        terminal = {}
+        children = [[]]
+
+        for word, entity_type in entries:
+            state = 0
+            for char in word:
+                key = state * CHAR_RANGE + ord(char)
+                target = goto.get(key)
+                if target is None:
+                    target = len(fail)
+                    goto[key] = target
+                    fail.append(0)
+                    children.append([])
+                    children[state].append((ord(char), target))
+                state = target
+            terminal.setdefault(state, (len(word), type_index[entity_type]))
+
+        # 按广度优先顺序计算失配链
+        out_link = array("i", [0]) * len(fail)
+        queue = deque(target for _, target in children[0])
+        while queue:
+            state = queue.popleft()
+            for code, target in children[state]:
+                link = fail[state]
+                while link and link * CHAR_RANGE + code not in goto:
+                    link = fail[link]
+                link = goto.get(link * CHAR_RANGE + code, 0)
+                fail[target] = link
+                out_link[target] = link if link in terminal else out_link[link]
+                queue.append(target)
+        return cls(model_type, types, goto, fail, out_link, terminal, sources)
+
+    @property
+    def size(self):
+        return len(self.terminal)
+
+    def iter_matches(self, text):
+        """一次扫描产生全部命中 (起始位置, 结束位置, 实体类型)，结束位置为最后一个字的位置"""
+        goto, fail, out_link, terminal = self.goto, self.fail, self.out_link, self.terminal
+        state = 0
+        for i, char in enumerate(text):
+            code = ord(char)
+            while state and state * CHAR_RANGE + code not in goto:
+                state = fail[state]
+            state = goto.get(state * CHAR_RANGE + code, 0)
+            match = state if state in terminal else out_link[state]
+            while match:
+                length, type_id = terminal[match]
+                yield i - length + 1, i, self.types[type_id]
+                match = out_link[match]
+
+    def find_entities(self, text):
+        """按最左最长原则选出互不重叠的词典实体，格式与基础模型的实体相同"""
+        matches = sorted(self.iter_matches(text), key=lambda m: (m[0], -m[1]))
+        entities = []
+        last_end = -1
+        for start, end, entity_type in matches:
+            if start > last_end:
+                entities.append({
+                    "start": start,
+                    "end": end,
+                    "type": entity_type,
+                    "text": text[start:end + 1],
+                    "source": "lexicon"
+                })
+                last_end = end
+        GAZETTEER_HITS.inc(len(entities), model_type=self.model_type)
+        return entities
+
+    def save(self, path):
+        data = {
+            "version": GAZETTEER_FORMAT_VERSION,
+            "model_type": self.model_type,
+            "types": self.types,
+            "goto": self.goto,
+            "fail": self.fail,
+            "out_link": self.out_link,
+            "terminal": self.terminal,
+            "sources": self.sources
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """加载编译结果；格式版本不符时返回 None"""
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("version") != GAZETTEER_FORMAT_VERSION:
+            return None
+        return cls(
+            data["model_type"], data["types"], data["goto"], data["fail"],
+            data["out_link"], data["terminal"], data["sources"]
+        )
+
+
+def lexicon_files(model_type, directory=GAZETTEER_DIR):
+    """返回该模型类型已存在的词典文件 {文件路径: 实体类型}，按实体类型的固定顺序"""
+    files = {}
+    for entity_type in ENTITY_TYPE_DESCRIPTIONS[model_type]:
+        path = os.path.join(directory, model_type, f"{entity_type}.txt")
+        if os.path.isfile(path):
+            files[path] = entity_type
+    return files
+
+
+def read_lexicon(path, min_length=GAZETTEER_MIN_LENGTH):
+    with open(path, encoding="utf-8-sig") as f:
+        for line in f:
+            word = line.strip()
+            if word and not word.startswith("#") and len(word) >= min_length:
+                yield word
+
+
+def compile_lexicons(model_type, directory=GAZETTEER_DIR):
+    """编译该模型类型的全部词典并写入 <目录>/<模型类型>.gaz；没有词典时返回 None"""
+    files = lexicon_files(model_type, directory)
+    if not files:
+        return None
+    started = time.perf_counter()
+    sources = {os.path.basename(path): os.path.getmtime(path) for path in files}
+    entries = ((word, entity_type) for path, entity_type in files.items() for word in read_lexicon(path))
+    gazetteer = Gazetteer.build(model_type, entries, sources)
+    gazetteer.save(os.path.join(directory, f"{model_type}.gaz"))
+    logger.info(
+        f"已编译模型 {model_type} 的词典：{gazetteer.size} 个词条，"
+        f"耗时 {time.perf_counter() - started:.2f} 秒"
+    )
+    return gazetteer
+
+
+class GazetteerRegistry:
+    """按模型类型懒加载词典自动机；词典文件有变化时重新编译"""
+
+    def __init__(self, directory=GAZETTEER_DIR):
+        self.directory = directory
+        self._gazetteers = {}
+        self._lock = threading.Lock()
+
+    def _is_current(self, gazetteer, files):
+        sources = {os.path.basename(path): os.path.getmtime(path) for path in files}
+        return gazetteer is not None and gazetteer.sources == sources
+
+    def _load(self, model_type):
+        files = lexicon_files(model_type, self.directory)
+        if not files:
+            return None
+        path = os.path.join(self.directory, f"{model_type}.gaz")
+        gazetteer = None
+        if os.path.isfile(path):
+            try:
+                gazetteer = Gazetteer.load(path)
+            except Exception as e:
+                logger.warning(f"加载词典编译结果失败，重新编译: {str(e)}")
+        if self._is_current(gazetteer, files):
+            return gazetteer
+        return compile_lexicons(model_type, self.directory)
+
+    def get(self, model_type):
+        """返回模型类型的词典自动机，没有词典时返回 None"""
+        if model_type in self._gazetteers:
+            return self._gazetteers[model_type]
+        with self._lock:
+            if model_type not in self._gazetteers:
+                try:
+                    self._gazetteers[model_type] = self._load(model_type)
+                except Exception as e:
+                    logger.error(f"加载模型 {model_type} 的词典失败: {str(e)}")
+                    self._gazetteers[model_type] = None
+            return self._gazetteers[model_type]
+
+    def reload(self, model_type=None):
+        """丢弃已加载的自动机，下次使用时重新加载"""
+        with self._lock:
+            if model_type is None:
+                self._gazetteers.clear()
+            else:
+                self._gazetteers.pop(model_type, None)
+
+
+gazetteers = GazetteerRegistry()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="编译或测试实体词典")
+    parser.add_argument("--directory", default=GAZETTEER_DIR, help="词典目录")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="编译词典")
+    build.add_argument("--model-type", choices=list(ENTITY_TYPE_DESCRIPTIONS), action="append")
+    match = subparsers.add_parser("match", help="用词典匹配一段文本")
+    match.add_argument("--model-type", choices=list(ENTITY_TYPE_DESCRIPTIONS), default="A")
+    match.add_argument("text")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        for model_type in args.model_type or list(ENTITY_TYPE_DESCRIPTIONS):
+            gazetteer = compile_lexicons(model_type, args.directory)
+            if gazetteer is None:
+                print(f"模型 {model_type}：没有词典文件")
+            else:
+                print(f"模型 {model_type}：{gazetteer.size} 个词条")
+        return 0
+
+    gazetteer = GazetteerRegistry(args.directory).get(args.model_type)
+    if gazetteer is None:
+        print(f"模型 {args.model_type}：没有词典文件", file=sys.stderr)
+        return 1
+    for entity in gazetteer.find_entities(args.text):
+        print(f"{entity['start']}\t{entity['end']}\t{entity['type']}\t{entity['text']}")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,158 @@
+# backend/llm_correction.py
+"""
+大模型 NER 修正的选择性策略
+
+开启 enable_llm 时原本把整篇文本和全部实体交给大模型修正，而 BERT+CRF 对大部分句子的判断都很有把握。
+这里只挑出可能需要修正的句子：
+
+- 含有置信度低于 LLM_CORRECTION_CONFIDENCE 的模型实体
+- 含有罕见类型（LLM_CORRECTION_RARE_TYPES，默认时间 T、书名 NB）的实体，这些类型模型的召回率最低
+- 含有预测标签边缘概率低于阈值的非实体字：模型拿不准这里是否有实体或实体边界是否该延伸到这里
+- 超出模型输入长度（约 510 字）、没有模型预测的部分：原本只有整篇发送的大模型结果覆盖这里
+
+每个选中的句子前后各带 LLM_CORRECTION_CONTEXT_CHARS 个字的上下文，相互重叠的片段合并。
+提示词模板本身就有上千 token，因此各片段以换行连接成不超过 LLM_CORRECTION_BATCH_CHARS 字的摘录，
+每份摘录一次调用（多份时并发）。大模型返回的实体从摘录内偏移换算回文档偏移，
+只保留落在选中句子内的实体（上下文部分仍以模型结果为准）。
+选中的片段合计超过全文的 LLM_CORRECTION_FULL_RATIO 时直接整篇发送。
+"""
+import os
+import re
+
+from metrics import REGISTRY
+
+# selective：只发送不确定的句子；full：整篇发送（原有行为）
+LLM_CORRECTION_MODE = os.getenv("LLM_CORRECTION_MODE", "selective")
+# 置信度阈值：低于该值的实体或字所在的句子交给大模型
+LLM_CORRECTION_CONFIDENCE = float(os.getenv("LLM_CORRECTION_CONFIDENCE", "0.9"))
+# 总是交给大模型检查的罕见实体类型
+LLM_CORRECTION_RARE_TYPES = frozenset(
+    t.strip() for t in os.getenv("LLM_CORRECTION_RARE_TYPES", "T,NB").split(",") if t.strip()
+)
+# 选中句子前后附带的上下文字数
+LLM_CORRECTION_CONTEXT_CHARS = int(os.getenv("LLM_CORRECTION_CONTEXT_CHARS", "40"))
+# 超过该长度的句子再按逗号等切分
+LLM_CORRECTION_MAX_SENTENCE_CHARS = int(os.getenv("LLM_CORRECTION_MAX_SENTENCE_CHARS", "100"))
+# 选中片段合计超过全文该比例时整篇发送
+LLM_CORRECTION_FULL_RATIO = float(os.getenv("LLM_CORRECTION_FULL_RATIO", "0.6"))
+# 每次调用发送的摘录最多字数（单个片段超过时单独发送）
+LLM_CORRECTION_BATCH_CHARS = int(os.getenv("LLM_CORRECTION_BATCH_CHARS", "1500"))
+# 同一篇文本的各份摘录同时进行的大模型调用数
+LLM_CORRECTION_CONCURRENCY = int(os.getenv("LLM_CORRECTION_CONCURRENCY", "4"))
+
+LLM_CORRECTION_CHARS = REGISTRY.counter(
+    "ner_llm_correction_chars_total", "开启大模型增强的 NER 文本字数（是否发送给大模型）", ("model_type", "sent"))
+
+SENTENCE_END_PATTERN = re.compile(r"[。！？；!?;\n]+")
+CLAUSE_END_PATTERN = re.compile(r"[，,：:、]+")
+
+
+def _split(text, start, end, pattern):
+    """按分隔符切分 text[start:end]，分隔符归入前一段，返回 [(起始, 结束)]（结束不含）"""
+    spans = []
+    position = start
+    for match in pattern.finditer(text, start, end):
+        spans.append((position, match.end()))
+        position = match.end()
+    if position < end:
+        spans.append((position, end))
+    return spans
+
+
+def split_sentences(text, max_chars=LLM_CORRECTION_MAX_SENTENCE_CHARS):
+    """切分句子；过长的句子再按分句标点切分，仍过长时按长度硬切"""
+    sentences = []
+    for start, end in _split(text, 0, len(text), SENTENCE_END_PATTERN):
+        if end - start <= max_chars:
+            sentences.append((start, end))
+            continue
+        for clause_start, clause_end in _split(text, start, end, CLAUSE_END_PATTERN):
+            sentences.extend(
+                (s, min(s + max_chars, clause_end)) for s in range(clause_start, clause_end, max_chars)
+            )
+    return sentences
+
+
+def uncertain_positions(text_length, base_entities, tag_confidence, threshold=LLM_CORRECTION_CONFIDENCE,
+                        rare_types=LLM_CORRECTION_RARE_TYPES):
+    """返回需要大模型检查的字的位置集合；tag_confidence 未覆盖的位置（模型输入被截断）都需要检查"""
+    positions = set(range(len(tag_confidence), text_length))
+    for entity in base_entities:
+        confidence = entity.get("confidence")
+        if entity["type"] in rare_types or (confidence is not None and confidence < threshold):
+            positions.update(range(entity["start"], entity["end"] + 1))
+    positions.update(i for i, confidence in enumerate(tag_confidence) if confidence < threshold)
+    return positions
+
+
+def plan_regions(text, base_entities, tag_confidence, mode=LLM_CORRECTION_MODE):
+    """
+    规划需要发送给大模型的片段，返回 [{"start", "end", "cores": [(起始, 结束)]}]（结束不含），
+    cores 为片段中选中的句子；返回 None 表示整篇发送
+    """
+    if mode != "selective" or not tag_confidence:
+        return None
+    positions = uncertain_positions(len(text), base_entities, tag_confidence)
+    cores = [
+        (start, end) for start, end in split_sentences(text)
+        if any(i in positions for i in range(start, end))
+    ]
+
+    regions = []
+    for start, end in cores:
+        region_start = max(0, start - LLM_CORRECTION_CONTEXT_CHARS)
+        region_end = min(len(text), end + LLM_CORRECTION_CONTEXT_CHARS)
+        if regions and region_start <= regions[-1]["end"]:
+            regions[-1]["end"] = region_end
+            regions[-1]["cores"].append((start, end))
+        else:
+            regions.append({"start": region_start, "end": region_end, "cores": [(start, end)]})
+
+    if sum(region["end"] - region["start"] for region in regions) >= LLM_CORRECTION_FULL_RATIO * len(text):
+        return None
+    return regions
+
+
+def pack_regions(text, base_entities, regions, max_chars=LLM_CORRECTION_BATCH_CHARS):
+    """
+    把片段以换行连接成摘录，返回 [{"text", "entities", "parts": [(片段, 片段在摘录中的偏移)]}]
+    entities 为摘录内的模型实体（偏移已换算为摘录内偏移）
+    """
+    batches = []
+    for region in regions:
+        length = region["end"] - region["start"]
+        batch = batches[-1] if batches else None
+        if batch is None or len(batch["text"]) + 1 + length > max_chars:
+            batch = {"text": "", "entities": [], "parts": []}
+            batches.append(batch)
+        elif batch["text"]:
+            batch["text"] += "\n"
+        offset = len(batch["text"])
+        batch["text"] += text[region["start"]:region["end"]]
+        batch["parts"].append((region, offset))
+        batch["entities"].extend(
+            dict(entity, start=entity["start"] - region["start"] + offset, end=entity["end"] - region["start"] + offset)
+            for entity in base_entities
+            if region["start"] <= entity["start"] and entity["end"] < region["end"]
+        )
+    return batches
+
+
+def remap_entities(llm_entities, batch):
+    """把大模型返回的摘录内实体换算回文档偏移，只保留完全落在选中句子内的实体"""
+    remapped = []
+    for entity in llm_entities:
+        for region, offset in batch["parts"]:
+            start = entity["start"] - offset + region["start"]
+            end = entity["end"] - offset + region["start"]
+            if any(core_start <= start and end < core_end for core_start, core_end in region["cores"]):
+                remapped.append(dict(entity, start=start, end=end))
+                break
+    return remapped
+
+
+def record_plan(text, regions, model_type):
+    """记录发送给大模型和跳过的字数"""
+    sent = len(text) if regions is None else sum(region["end"] - region["start"] for region in regions)
+    LLM_CORRECTION_CHARS.inc(sent, model_type=model_type, sent="true")
+    LLM_CORRECTION_CHARS.inc(len(text) - sent, model_type=model_type, sent="false")
@@ -0,0 +1,144 @@
+# backend/llm_usage.py
+"""
+大模型调用的用量与耗时记录
+
+每次 DeepSeek 调用用 track_llm_call 包裹，记录路由、模型、响应 usage 中的 prompt/completion/缓存命中 token 数和耗时：
+- 同时累加到 Prometheus 指标（llm_tokens_total、llm_call_duration_seconds）
+- 请求内的调用记录暂存在 flask.g 中，问答接口随对话一起写入 llm_usage 表，其余接口在请求结束时写入；
+  NER 后台任务随每个分段的检查点写入
+"""
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import g, has_app_context
+
+from database.models import db, LLMUsage
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+LLM_CALL_SECONDS = REGISTRY.histogram(
+    "llm_call_duration_seconds", "大模型调用耗时", ("route", "model", "status"))
+LLM_TOKENS = REGISTRY.counter(
+    "llm_tokens_total", "大模型调用消耗的token数", ("route", "model", "kind"))
+
+# 每百万token的价格（美元）：缓存命中输入、缓存未命中输入、输出；可通过 LLM_PRICES 环境变量（JSON）覆盖
+DEFAULT_LLM_PRICES = {
+    "deepseek-chat": {"input_cache_hit": 0.07, "input_cache_miss": 0.27, "output": 1.10},
+    "deepseek-reasoner": {"input_cache_hit": 0.14, "input_cache_miss": 0.55, "output": 2.19},
+}
+LLM_PRICES = {**DEFAULT_LLM_PRICES, **json.loads(os.getenv("LLM_PRICES", "{}"))}
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens):
+    """按价格表估算费用（美元），未知模型返回 0"""
+    prices = LLM_PRICES.get(model)
+    if not prices:
+        return 0.0
+    return (
+        cached_tokens * prices["input_cache_hit"]
+        + (prompt_tokens - cached_tokens) * prices["input_cache_miss"]
+        + completion_tokens * prices["output"]
+    ) / 1_000_000
+
+
+def _usage_fields(usage):
+    """从响应的 usage（OpenAI SDK 对象或 JSON 字典）中取出 prompt/completion/缓存命中 token 数"""
+    if usage is None:
+        return 0, 0, 0
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else vars(usage)
+    cached = usage.get("prompt_cache_hit_tokens")
+    if cached is None:
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    return usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0, cached
+
+
+class LLMCall:
+    """一次大模型调用；调用方拿到响应后通过 record() 提交 usage"""
+
+    def __init__(self, route, model):
+        self.route = route
+        self.model = model
+        self.usage = None
+        self.status = "ok"
+
+    def record(self, usage):
+        self.usage = usage
+
+
+@contextmanager
+def track_llm_call(route, model):
+    """记录代码块内一次大模型调用的耗时和 token 用量，代码块抛出异常时记为 error"""
+    call = LLMCall(route, model)
+    started = time.perf_counter()
+    try:
+        yield call
+    except Exception:
+        call.status = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        prompt_tokens, completion_tokens, cached_tokens = _usage_fields(call.usage)
+        LLM_CALL_SECONDS.observe(elapsed, route=route, model=call.model, status=call.status)
+        LLM_TOKENS.inc(prompt_tokens, route=route, model=call.model, kind="prompt")
+        LLM_TOKENS.inc(completion_tokens, route=route, model=call.model, kind="completion")
+        LLM_TOKENS.inc(cached_tokens, route=route, model=call.model, kind="cached")
+        if has_app_context():
+            g.setdefault("llm_usage", []).append({
+                "created_at": datetime.utcnow(),
+                "route": route,
+                "model": call.model,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "cached_tokens": cached_tokens,
+                "latency_ms": int(elapsed * 1000),
+                "status": call.status
+            })
+
+
+def take_usage_records():
+    """取出当前请求（或后台任务的应用上下文）中尚未写入的调用记录"""
+    if not has_app_context():
+        return []
+    return g.pop("llm_usage", None) or []
+
+
+def summarize_usage(records):
+    """汇总一组调用记录，附在消息的 routing_info 中"""
+    return {
+        "calls": len(records),
+        "prompt_tokens": sum(r["prompt_tokens"] for r in records),
+        "completion_tokens": sum(r["completion_tokens"] for r in records),
+        "cached_tokens": sum(r["cached_tokens"] for r in records),
+        "latency_ms": sum(r["latency_ms"] for r in records),
+        "cost_usd": round(sum(
+            estimate_cost(r["model"], r["prompt_tokens"], r["completion_tokens"], r["cached_tokens"])
+            for r in records
+        ), 6)
+    }
+
+
+def insert_usage_records(conn, records, session_id=None):
+    """在给定连接的当前事务中追加调用记录"""
+    if records:
+        conn.execute(LLMUsage.__table__.insert(), [
+            dict(record, session_id=record.get("session_id", session_id)) for record in records
+        ])
+
+
+def persist_pending_usage():
+    """请求结束时写入尚未随对话写入的调用记录"""
+    records = take_usage_records()
+    if not records:
+        return
+    try:
+        insert_usage_records(db.session.connection(), records)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"写入大模型用量记录失败: {str(e)}")
@@ -0,0 +1,191 @@
+# backend/metrics.py
+"""
+轻量级指标采集：计数器与直方图，以 Prometheus 文本格式在 /metrics 输出
+
+热路径上的开销仅为一次加锁的累加（直方图额外一次二分查找），不依赖第三方库。
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# 默认直方图分桶（秒），覆盖毫秒级的分词到分钟级的 R1 推理
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+# 线程局部的耗时区间监听器（请求级性能分析时用于生成时间线）
+_local = threading.local()
+
+
+def set_span_listener(listener):
+    """为当前线程设置耗时区间监听器，listener(name, labels, started, ended)；传入 None 取消"""
+    _local.span_listener = listener
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    """指标基类：按标签值组合维护子序列"""
+
+    metric_type = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            series = sorted(self._series.items())
+            lines.extend(self._render_series(series))
+        return "\n".join(lines)
+
+    def _render_series(self, series):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+    def _render_series(self, series):
+        for key, value in series:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    """累积分桶直方图"""
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._series.get(key)
+            if state is None:
+                # [各分桶计数..., +Inf 计数, 总和]
+                state = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """统计代码块耗时"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            ended = time.perf_counter()
+            self.observe(ended - started, **labels)
+            listener = getattr(_local, "span_listener", None)
+            if listener is not None:
+                listener(self.name, labels, started, ended)
+
+    def _render_series(self, series):
+        for key, state in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(state[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                return self._metrics[metric.name]
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# Prometheus 文本格式的 Content-Type
+CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+# HTTP 请求
+HTTP_REQUESTS = REGISTRY.counter(
+    "http_requests_total", "HTTP 请求数", ("endpoint", "method", "status"))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds", "HTTP 请求耗时", ("endpoint", "method"))
+
+# NER 流水线各阶段：tokenize / encoder_forward / crf_decode / tags_to_entities / llm_correction / merge / serialize
+NER_STAGE_SECONDS = REGISTRY.histogram(
+    "ner_stage_duration_seconds", "NER 流水线各阶段耗时", ("stage", "model_type"))
+NER_MODEL_LOAD_SECONDS = REGISTRY.histogram(
+    "ner_model_load_duration_seconds", "NER 模型加载耗时", ("model_type",))
+
+# 问答流水线各阶段：classify / easy_answer / auxiliary_a / auxiliary_b / r1 / original_api / db_read / db_write
+CHAT_STAGE_SECONDS = REGISTRY.histogram(
+    "chat_stage_duration_seconds", "问答流水线各阶段耗时", ("stage",))
+CHAT_ROUTES = REGISTRY.counter(
+    "chat_routes_total", "动态路由结果计数", ("complexity",))
+# write-behind 队列中重试后仍写入失败而被丢弃的对话轮数
+CHAT_WRITE_DROPPED = REGISTRY.counter(
+    "chat_write_dropped_total", "丢弃的聊天记录轮数", ())
+
+# 各类缓存的命中情况（result 为 hit 或 miss）
+CACHE_REQUESTS = REGISTRY.counter(
+    "cache_requests_total", "缓存查询次数", ("cache", "result"))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+带版本号的数据库迁移
+
+- 每个迁移有唯一的递增版本号，已执行的版本记录在 schema_migrations 表中
+- 应用启动时（db.create_all() 之后）自动执行尚未执行的迁移
+- 每个迁移本身都是幂等的，多个 worker 同时启动时重复执行也不会出错
+- 新增迁移时在 MIGRATIONS 末尾追加即可，不要修改或删除已发布的版本
+
+也可以单独运行：
+    python migrations/runner.py
+    python migrations/runner.py --database-url sqlite:////path/to/app.db
+"""
+
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+
+def _add_session_title(conn):
+    """为chat_sessions表添加title字段（原 add_session_title.py）"""
+    columns = [col["name"] for col in inspect(conn).get_columns("chat_sessions")]
+    if "title" in columns:
+        return
+    conn.exec_driver_sql("ALTER TABLE chat_sessions ADD COLUMN title TEXT")
+    conn.exec_driver_sql(
+        "UPDATE chat_sessions SET title = 'Chat ' || strftime('%Y-%m-%d %H:%M', created_at)"
+    )
+
+
+def _add_answer_cache_opt_out(conn):
+    """为users表添加answer_cache_opt_out字段"""
+    columns = [col["name"] for col in inspect(conn).get_columns("users")]
+    if "answer_cache_opt_out" not in columns:
+        conn.exec_driver_sql("ALTER TABLE users ADD COLUMN answer_cache_opt_out BOOLEAN NOT NULL DEFAULT 0")
+
+
+def _create_chat_search_index(conn):
+    """为chat_messages建立FTS5全文索引和同步触发器（见 database/chat_search.py）"""
+    from database.chat_search import create_index
+    create_index(conn)
+
+
+def _create_index(name, table, columns):
+    def migrate(conn):
+        conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+    migrate.__doc__ = f"为{table}表创建 ({', '.join(columns)}) 复合索引"
+    return migrate
+
+
+def _drop_index(name):
+    def migrate(conn):
+        conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+    migrate.__doc__ = f"删除索引 {name}"
+    return migrate
+
+
+# (版本号, 名称, 迁移函数)
+MIGRATIONS = [
+    (1, "add_session_title", _add_session_title),
+    # 按会话读取最近消息、历史分页
+    (2, "index_chat_messages_session_id_id",
+     _create_index("ix_chat_messages_session_id_id", "chat_messages", ["session_id", "id"])),
+    # 按会话过滤并按时间排序
+    (3, "index_chat_messages_session_id_created_at",
+     _create_index("ix_chat_messages_session_id_created_at", "chat_messages", ["session_id", "created_at"])),
+    # 会话标题回填：每个会话的第一条用户消息
+    (4, "index_chat_messages_session_id_role_id",
+     _create_index("ix_chat_messages_session_id_role_id", "chat_messages", ["session_id", "role", "id"])),
+    # 会话列表：按用户过滤活跃会话，按 (last_activity, id) 倒序游标分页
+    (5, "index_chat_sessions_user_active_activity",
+     _create_index("ix_chat_sessions_user_id_is_active_last_activity", "chat_sessions",
+                   ["user_id", "is_active", "last_activity", "id"])),
+    (6, "add_user_answer_cache_opt_out", _add_answer_cache_opt_out),
+    (7, "create_chat_messages_fts", _create_chat_search_index),
+    # 消息查询都按 id 排序，(session_id, created_at) 索引从未被使用，只增加写入开销
+    (8, "drop_index_chat_messages_session_id_created_at", _drop_index("ix_chat_messages_session_id_created_at")),
+]
+
+
+def _ensure_version_table(conn):
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, "
+        "name VARCHAR(100) NOT NULL, "
+        "applied_at DATETIME NOT NULL)"
+    )
+
+
+def applied_versions(engine):
+    """返回已执行的迁移版本号集合"""
+    with engine.begin() as conn:
+        _ensure_version_table(conn)
+        return {row[0] for row in conn.exec_driver_sql("SELECT version FROM schema_migrations")}
+
+
+def run_migrations(engine, migrations=MIGRATIONS):
+    """执行尚未执行的迁移，返回本次执行的版本号列表"""
+    done = applied_versions(engine)
+    applied = []
+    for version, name, migrate in migrations:
+        if version in done:
+            continue
+        try:
+            # 迁移与版本记录在同一事务中，失败时整体回滚
+            with engine.begin() as conn:
+                migrate(conn)
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, :t)"),
+                    {"v": version, "n": name, "t": datetime.utcnow()}
+                )
+            applied.append(version)
+            logger.info(f"已执行数据库迁移 {version}: {name}")
+        except IntegrityError:
+            # 其他 worker 已经执行了同一版本
+            logger.info(f"数据库迁移 {version}: {name} 已由其他进程执行")
+
+    # 更新查询规划器的统计信息，使新索引能被正确选用
+    if applied and engine.dialect.name == "sqlite":
+        with engine.begin() as conn:
+            conn.exec_driver_sql("PRAGMA optimize")
+    return applied
+
+
+def main(argv=None):
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    default_url = os.getenv(
+        "DATABASE_URL", f"sqlite:///{os.path.join(backend_dir, 'database', 'app.db')}"
+    )
+
+    parser = argparse.ArgumentParser(description="执行数据库迁移")
+    parser.add_argument("--database-url", default=default_url)
+    parser.add_argument("--status", action="store_true", help="只显示迁移状态，不执行")
+    args = parser.parse_args(argv)
+
+    # 导入 sqlite_config 以便为连接设置 PRAGMA
+    sys.path.append(backend_dir)
+    import database.sqlite_config  # noqa: F401
+    from database.models import db
+
+    engine = create_engine(args.database_url)
+    if args.status:
+        done = applied_versions(engine)
+        for version, name, _ in MIGRATIONS:
+            print(f"{'[x]' if version in done else '[ ]'} {version:04d} {name}")
+        return 0
+
+    # 与应用启动时一致：先补建缺失的表，再执行迁移
+    db.metadata.create_all(engine)
+    applied = run_migrations(engine)
+    print(f"执行了 {len(applied)} 个迁移" if applied else "数据库已是最新版本")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
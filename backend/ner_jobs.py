@@ -0,0 +1,352 @@
+# backend/ner_jobs.py
+"""
+NER 文件后台任务
+
+大文件（尤其开启大模型增强时）放在一次 HTTP 请求中处理会持续很久，遇到代理超时就会中断并从头再来。
+后台任务模式下：
+
+- 提交时把文件按行、按句切分为不超过 NER_JOB_SEGMENT_CHARS 个字符的分段，任务和分段写入数据库后立即返回任务 ID
+- 本进程的工作线程按提交顺序领取任务，逐段识别；每段完成后在同一事务中保存该段结果、进度和大模型用量（检查点）
+- 领取任务的工作线程定期刷新心跳；进程退出或崩溃后，心跳超时的任务会被重新领取，并从第一个未完成的分段继续
+- 多个 worker 进程共用同一个数据库，领取任务使用单条条件 UPDATE，同一任务只会被一个工作线程领取
+- 剩余时间按已完成分段的每字符平均耗时估算
+"""
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, select
+
+from database.models import db, NerJob, NerJobSegment
+from llm_usage import take_usage_records, insert_usage_records
+from metrics import REGISTRY
+from rate_limit import limiter, AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+NER_JOBS = REGISTRY.counter("ner_jobs_total", "NER 后台任务数", ("event",))
+NER_JOB_SEGMENT_SECONDS = REGISTRY.histogram("ner_job_segment_seconds", "NER 后台任务单个分段的处理耗时", ("enable_llm",))
+
+# 每个进程的工作线程数
+NER_JOB_WORKERS = int(os.getenv("NER_JOB_WORKERS", "1"))
+# 单个分段的最大字符数（BERT 输入上限为 512 个 token，含 [CLS] 和 [SEP]）
+NER_JOB_SEGMENT_CHARS = int(os.getenv("NER_JOB_SEGMENT_CHARS", "500"))
+# 空闲时查询新任务的间隔（秒）
+NER_JOB_POLL_INTERVAL = float(os.getenv("NER_JOB_POLL_INTERVAL", "2"))
+# 心跳间隔（秒）
+NER_JOB_HEARTBEAT_INTERVAL = float(os.getenv("NER_JOB_HEARTBEAT_INTERVAL", "15"))
+# 超过这么久没有心跳的运行中任务视为中断，可被重新领取（秒）
+NER_JOB_STALE_SECONDS = float(os.getenv("NER_JOB_STALE_SECONDS", "90"))
+
+# 句末标点，超长的行在这些位置之后切分
+SENTENCE_PATTERN = re.compile(r"[^。！？；!?;]*[。！？；!?;]+[”’」』）)]*|[^。！？；!?;]+")
+
+
+class LostClaim(Exception):
+    """任务已被其他工作线程接管（本线程心跳超时）"""
+
+
+def split_segments(content, max_chars=NER_JOB_SEGMENT_CHARS):
+    """
+    把文本切分为 (起始位置, 分段文本) 列表
+    按行切分，去掉首尾空白；超长的行在句末标点处切分后合并为不超过 max_chars 的分段，
+    没有标点的超长句子按 max_chars 硬切
+    """
+    segments = []
+    for line in re.finditer(r"[^\n]+", content):
+        text = line.group().strip()
+        if not text:
+            continue
+        offset = line.start() + line.group().index(text)
+        if len(text) <= max_chars:
+            segments.append((offset, text))
+            continue
+
+        start = end = 0
+        for sentence in SENTENCE_PATTERN.finditer(text):
+            if sentence.end() - start > max_chars and end > start:
+                segments.append((offset + start, text[start:end]))
+                start = end
+            while sentence.end() - start > max_chars:
+                segments.append((offset + start, text[start:start + max_chars]))
+                start += max_chars
+            end = sentence.end()
+        if end > start:
+            segments.append((offset + start, text[start:end]))
+    return segments
+
+
+def create_job(filename, content, model_type, enable_llm, user_id=None):
+    """创建任务及其分段，返回任务 ID 和分段数"""
+    segments = split_segments(content)
+    job_id = str(uuid.uuid4())
+    db.session.add(NerJob(
+        id=job_id,
+        user_id=user_id,
+        filename=filename,
+        model_type=model_type,
+        enable_llm=enable_llm,
+        content=content,
+        status="queued" if segments else "completed",
+        total_segments=len(segments),
+        total_chars=sum(len(text) for _, text in segments),
+        finished_at=None if segments else datetime.utcnow()
+    ))
+    db.session.flush()
+    if segments:
+        db.session.execute(NerJobSegment.__table__.insert(), [
+            {"job_id": job_id, "seq": seq, "offset": offset, "text": text}
+            for seq, (offset, text) in enumerate(segments)
+        ])
+    db.session.commit()
+    NER_JOBS.inc(event="submitted")
+    ner_job_queue.notify()
+    return job_id, len(segments)
+
+
+def job_status(job):
+    """任务状态、进度和预计剩余时间"""
+    eta_seconds = None
+    if job.status in ("queued", "running") and job.completed_chars:
+        remaining_chars = job.total_chars - job.completed_chars
+        eta_seconds = round(job.processing_seconds / job.completed_chars * remaining_chars, 1)
+    return {
+        "job_id": job.id,
+        "filename": job.filename,
+        "model_type": job.model_type,
+        "enable_llm": job.enable_llm,
+        "status": job.status,
+        "error": job.error,
+        "progress": {
+            "completed_segments": job.completed_segments,
+            "total_segments": job.total_segments,
+            "completed_chars": job.completed_chars,
+            "total_chars": job.total_chars,
+            "percent": round(job.completed_chars / job.total_chars * 100, 1) if job.total_chars else 100.0
+        },
+        "eta_seconds": eta_seconds,
+        "created_at": job.created_at.isoformat(),
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None
+    }
+
+
+def assemble_result(job):
+    """拼接各分段的识别结果，返回与原文逐字对齐的标注列表（分段之间的换行和空白标为 O）"""
+    token_label_pairs = [{"char": char, "label": "O", "source": "bert"} for char in job.content]
+    rows = db.session.query(NerJobSegment.offset, NerJobSegment.labels).filter(
+        NerJobSegment.job_id == job.id
+    ).order_by(NerJobSegment.seq).execution_options(yield_per=500)
+    for row in rows:
+        for i, (label, source) in enumerate(json.loads(row.labels or "[]")):
+            pair = token_label_pairs[row.offset + i]
+            pair["label"] = label
+            pair["source"] = source
+    return token_label_pairs
+
+
+class NerJobQueue:
+    """本进程的 NER 后台任务工作线程"""
+
+    def __init__(self):
+        self.workers = NER_JOB_WORKERS
+        self._app = None
+        self._process = None
+        self._threads = []
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self._claims = set()
+        self._claims_lock = threading.Lock()
+
+    def init_app(self, app, process):
+        """
+        启动工作线程
+        process(text, enable_llm, model_type) -> (token_label_pairs, error)，与 process_text 相同
+        """
+        self.workers = app.config.get("NER_JOB_WORKERS", self.workers)
+        if self._threads or self.workers <= 0:
+            return
+        self._app = app
+        self._process = process
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"ner-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat, name="ner-job-heartbeat", daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        atexit.register(self.shutdown)
+
+    def notify(self):
+        """有新任务提交，唤醒空闲的工作线程"""
+        self._wakeup.set()
+
+    def shutdown(self, timeout=10.0):
+        """
+        停止工作线程：正在处理的分段完成后把任务放回队列
+        超时仍未停止的线程不再等待，其任务在心跳超时后由其他工作线程接管
+        """
+        if not self._threads:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+    def _run(self):
+        with self._app.app_context():
+            engine = db.engine
+            while not self._stopping.is_set():
+                try:
+                    claimed = self._claim(engine)
+                except Exception as e:
+                    logger.error(f"领取 NER 任务失败: {str(e)}")
+                    claimed = None
+                if claimed is None:
+                    self._wakeup.wait(NER_JOB_POLL_INTERVAL)
+                    self._wakeup.clear()
+                    continue
+                job_id, token = claimed
+                try:
+                    self._process_job(engine, job_id, token)
+                except LostClaim:
+                    logger.warning(f"NER 任务 {job_id} 已被其他工作线程接管")
+                except Exception as e:
+                    logger.error(f"NER 任务 {job_id} 处理失败: {str(e)}")
+                    self._finish(engine, job_id, token, "failed", str(e))
+                finally:
+                    with self._claims_lock:
+                        self._claims.discard(token)
+                    take_usage_records()
+
+    def _claim(self, engine):
+        """领取最早提交的排队中或心跳超时的任务，返回 (任务ID, 领取标识) 或 None"""
+        jobs = NerJob.__table__
+        token = uuid.uuid4().hex
+        now = datetime.utcnow()
+        claimable = or_(
+            jobs.c.status == "queued",
+            and_(jobs.c.status == "running", jobs.c.heartbeat_at < now - timedelta(seconds=NER_JOB_STALE_SECONDS))
+        )
+        next_job = select(jobs.c.id).where(claimable).order_by(jobs.c.created_at).limit(1).scalar_subquery()
+        with engine.begin() as conn:
+            # 单条条件 UPDATE，多个工作线程/进程同时领取时只有一个成功
+            result = conn.execute(jobs.update().where(jobs.c.id == next_job, claimable).values(
+                status="running", claim_token=token, heartbeat_at=now
+            ))
+            if result.rowcount == 0:
+                return None
+            job_id = conn.execute(select(jobs.c.id).where(jobs.c.claim_token == token)).scalar_one()
+            conn.execute(jobs.update().where(jobs.c.id == job_id, jobs.c.started_at.is_(None)).values(started_at=now))
+        with self._claims_lock:
+            self._claims.add(token)
+        NER_JOBS.inc(event="claimed")
+        logger.info(f"开始处理 NER 任务 {job_id}")
+        return job_id, token
+
+    def _process_job(self, engine, job_id, token):
+        jobs = NerJob.__table__
+        segments = NerJobSegment.__table__
+        with engine.connect() as conn:
+            job = conn.execute(select(jobs.c.model_type, jobs.c.enable_llm).where(jobs.c.id == job_id)).one()
+            pending = conn.execute(
+                select(segments.c.seq, segments.c.text)
+                .where(segments.c.job_id == job_id, segments.c.labels.is_(None))
+                .order_by(segments.c.seq)
+            ).all()
+
+        for seq, text in pending:
+            if self._stopping.is_set():
+                # 放回队列，由下次启动（或其他进程）从该分段继续
+                self._finish(engine, job_id, token, "queued")
+                NER_JOBS.inc(event="requeued")
+                return
+            started = time.perf_counter()
+            result = self._process_segment(text, job.enable_llm, job.model_type)
+            if result is None:
+                self._finish(engine, job_id, token, "queued")
+                NER_JOBS.inc(event="requeued")
+                return
+            token_label_pairs, error = result
+            if error:
+                self._finish(engine, job_id, token, "failed", f"第 {seq + 1} 段处理失败: {error}")
+                return
+            elapsed = time.perf_counter() - started
+            NER_JOB_SEGMENT_SECONDS.observe(elapsed, enable_llm=str(bool(job.enable_llm)).lower())
+
+            # 检查点：分段结果、进度和本段的大模型用量在同一事务中写入
+            with engine.begin() as conn:
+                updated = conn.execute(jobs.update().where(
+                    jobs.c.id == job_id, jobs.c.claim_token == token
+                ).values(
+                    completed_segments=jobs.c.completed_segments + 1,
+                    completed_chars=jobs.c.completed_chars + len(text),
+                    processing_seconds=jobs.c.processing_seconds + elapsed,
+                    heartbeat_at=datetime.utcnow()
+                ))
+                if updated.rowcount == 0:
+                    raise LostClaim(job_id)
+                conn.execute(segments.update().where(
+                    segments.c.job_id == job_id, segments.c.seq == seq
+                ).values(
+                    labels=json.dumps([[p["label"], p["source"]] for p in token_label_pairs], ensure_ascii=False),
+                    processed_at=datetime.utcnow()
+                ))
+                insert_usage_records(conn, take_usage_records())
+
+        self._finish(engine, job_id, token, "completed")
+        logger.info(f"NER 任务 {job_id} 已完成")
+
+    def _process_segment(self, text, enable_llm, model_type):
+        """
+        处理一个分段；大模型增强与在线请求共用准入名额，名额已满时等待后重试
+        等待期间进程开始停止时返回 None
+        """
+        while True:
+            try:
+                with limiter.admit("llm_ner") if enable_llm else nullcontext():
+                    return self._process(text, enable_llm, model_type)
+            except AdmissionRejected as e:
+                if self._stopping.wait(e.retry_after):
+                    return None
+
+    def _finish(self, engine, job_id, token, status, error=None):
+        jobs = NerJob.__table__
+        values = {"status": status, "claim_token": None, "error": error}
+        if status in ("completed", "failed"):
+            values["finished_at"] = datetime.utcnow()
+        with engine.begin() as conn:
+            conn.execute(jobs.update().where(jobs.c.id == job_id, jobs.c.claim_token == token).values(**values))
+        if status != "queued":
+            NER_JOBS.inc(event=status)
+
+    def _heartbeat(self):
+        """定期刷新本进程正在处理的任务的心跳"""
+        with self._app.app_context():
+            engine = db.engine
+        jobs = NerJob.__table__
+        while not self._stopping.wait(NER_JOB_HEARTBEAT_INTERVAL):
+            with self._claims_lock:
+                tokens = list(self._claims)
+            if not tokens:
+                continue
+            try:
+                with engine.begin() as conn:
+                    conn.execute(jobs.update().where(jobs.c.claim_token.in_(tokens)).values(
+                        heartbeat_at=datetime.utcnow()
+                    ))
+            except Exception as e:
+                logger.warning(f"刷新 NER 任务心跳失败: {str(e)}")
+
+
+ner_job_queue = NerJobQueue()
@@ -0,0 +1,235 @@
+# backend/profiling.py
+"""
+按需的请求级性能分析
+
+- 管理员在请求头携带 X-Profile: 1（或查询参数 profile=1）即可对单个请求开启分析
+- 设置环境变量 PROFILE_SAMPLE_EVERY=N 后，每 N 个请求自动分析一次
+- 整个请求由 cProfile 包裹；模型推理阶段额外使用 torch.profiler
+- 分析结果按请求 ID 保存，可通过 /api/profiles/<profile_id>/<artifact> 下载：
+    profile.pstats    cProfile 统计数据（python -m pstats 或 snakeviz 查看）
+    trace.json        各流水线阶段的时间线（Chrome trace 格式，chrome://tracing 或 Perfetto 查看）
+    torch_trace.json  模型阶段的 torch.profiler 时间线（仅在有模型推理时生成）
+"""
+import cProfile
+import itertools
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from functools import wraps
+
+from flask import Blueprint, request, jsonify, send_file, make_response, g, has_request_context
+
+from metrics import set_span_listener
+from routes.auth_routes import get_current_user, is_admin, admin_required
+
+logger = logging.getLogger(__name__)
+
+profile_bp = Blueprint("profiling", __name__)
+
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+)
+# 每 N 个请求自动分析一次，0 表示关闭采样
+PROFILE_SAMPLE_EVERY = int(os.getenv("PROFILE_SAMPLE_EVERY", "0"))
+# 最多保留的分析结果数量，超出后删除最旧的
+PROFILE_MAX_KEEP = int(os.getenv("PROFILE_MAX_KEEP", "200"))
+
+ARTIFACTS = {
+    "profile.pstats": "application/octet-stream",
+    "trace.json": "application/json",
+    "torch_trace.json": "application/json",
+    "meta.json": "application/json",
+}
+PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+_request_counter = itertools.count(1)
+_counter_lock = threading.Lock()
+
+
+class RequestProfiler:
+    """单个请求的性能分析器"""
+
+    def __init__(self, endpoint, sampled=False, user=None):
+        self.profile_id = uuid.uuid4().hex
+        self.endpoint = endpoint
+        self.sampled = sampled
+        self.username = user.username if user else None
+        self.output_dir = os.path.join(PROFILE_DIR, self.profile_id)
+        self._profile = cProfile.Profile()
+        self._spans = []
+        self._torch_traces = []
+        self._started = None
+
+    def _on_span(self, name, labels, started, ended):
+        self._spans.append((name, labels, started, ended))
+
+    def __enter__(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        g.request_profiler = self
+        set_span_listener(self._on_span)
+        self._started = time.perf_counter()
+        self._profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._profile.disable()
+        duration = time.perf_counter() - self._started
+        set_span_listener(None)
+        g.pop("request_profiler", None)
+        try:
+            self._save(duration)
+        except Exception as e:
+            logger.error(f"保存性能分析结果失败: {str(e)}")
+        return False
+
+    @contextmanager
+    def torch_stage(self, stage):
+        """对模型阶段使用 torch.profiler"""
+        try:
+            import torch
+            from torch.profiler import profile, ProfilerActivity
+        except ImportError:
+            yield
+            return
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        with profile(activities=activities, record_shapes=True) as prof:
+            yield
+        path = os.path.join(self.output_dir, f"torch_trace_{len(self._torch_traces)}_{stage}.json")
+        prof.export_chrome_trace(path)
+        self._torch_traces.append(path)
+
+    def _save(self, duration):
+        self._profile.dump_stats(os.path.join(self.output_dir, "profile.pstats"))
+
+        # 阶段时间线（Chrome trace 事件格式，时间单位为微秒）
+        events = [{
+            "name": self.endpoint, "cat": "request", "ph": "X",
+            "ts": 0, "dur": duration * 1e6, "pid": 0, "tid": 0
+        }]
+        for name, labels, started, ended in self._spans:
+            stage = labels.get("stage") or name
+            events.append({
+                "name": stage, "cat": name, "ph": "X",
+                "ts": (started - self._started) * 1e6, "dur": (ended - started) * 1e6,
+                "pid": 0, "tid": 0, "args": labels
+            })
+        with open(os.path.join(self.output_dir, "trace.json"), "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+        # 合并多个模型阶段的 torch 时间线
+        if self._torch_traces:
+            merged = []
+            for path in self._torch_traces:
+                with open(path, "r", encoding="utf-8") as f:
+                    merged.extend(json.load(f).get("traceEvents", []))
+                os.remove(path)
+            with open(os.path.join(self.output_dir, "torch_trace.json"), "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": merged}, f)
+
+        with open(os.path.join(self.output_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "profile_id": self.profile_id,
+                "endpoint": self.endpoint,
+                "user": self.username,
+                "sampled": self.sampled,
+                "duration_ms": duration * 1000,
+                "created_at": datetime.now().isoformat(),
+                "artifacts": sorted(n for n in os.listdir(self.output_dir) if n in ARTIFACTS)
+            }, f, ensure_ascii=False, indent=2)
+
+        _prune_profiles()
+
+
+def _prune_profiles():
+    """只保留最近的 PROFILE_MAX_KEEP 个分析结果"""
+    try:
+        entries = [os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR)
+                   if PROFILE_ID_PATTERN.match(name)]
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:-PROFILE_MAX_KEEP] if PROFILE_MAX_KEEP > 0 else []:
+            shutil.rmtree(path, ignore_errors=True)
+    except OSError as e:
+        logger.warning(f"清理性能分析结果失败: {str(e)}")
+
+
+def _profile_requested():
+    flag = request.headers.get("X-Profile") or request.args.get("profile")
+    return str(flag).lower() in ("1", "true", "yes")
+
+
+def _sample_hit():
+    if PROFILE_SAMPLE_EVERY <= 0:
+        return False
+    with _counter_lock:
+        return next(_request_counter) % PROFILE_SAMPLE_EVERY == 0
+
+
+def profiled(f):
+    """为视图函数加上按需/采样的性能分析"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        user = None
+        if _profile_requested():
+            user = get_current_user()
+            if not is_admin(user):
+                return jsonify({"message": "仅管理员可以开启性能分析"}), 403
+            sampled = False
+        elif _sample_hit():
+            sampled = True
+        else:
+            return f(*args, **kwargs)
+
+        with RequestProfiler(request.path, sampled=sampled, user=user) as profiler:
+            response = make_response(f(*args, **kwargs))
+        response.headers["X-Profile-Id"] = profiler.profile_id
+        return response
+    return decorated
+
+
+def model_stage_profile(stage):
+    """模型阶段的 torch.profiler 上下文；当前请求未开启分析时为空操作"""
+    profiler = g.get("request_profiler") if has_request_context() else None
+    return profiler.torch_stage(stage) if profiler else nullcontext()
+
+
+@profile_bp.route("/profiles", methods=["GET"])
+@admin_required
+def list_profiles(current_user):
+    """列出已保存的性能分析结果"""
+    profiles = []
+    if os.path.isdir(PROFILE_DIR):
+        for name in os.listdir(PROFILE_DIR):
+            meta_path = os.path.join(PROFILE_DIR, name, "meta.json")
+            if PROFILE_ID_PATTERN.match(name) and os.path.exists(meta_path):
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    profiles.append(json.load(f))
+    profiles.sort(key=lambda p: p["created_at"], reverse=True)
+    return jsonify({"success": True, "profiles": profiles})
+
+
+@profile_bp.route("/profiles/<profile_id>/<artifact>", methods=["GET"])
+@admin_required
+def download_profile(current_user, profile_id, artifact):
+    """下载性能分析结果文件"""
+    if not PROFILE_ID_PATTERN.match(profile_id) or artifact not in ARTIFACTS:
+        return jsonify({"success": False, "message": "无效的分析结果"}), 400
+    path = os.path.join(PROFILE_DIR, profile_id, artifact)
+    if not os.path.exists(path):
+        return jsonify({"success": False, "message": "分析结果不存在"}), 404
+    return send_file(
+        path,
+        as_attachment=True,
+        download_name=f"{profile_id}_{artifact}",
+        mimetype=ARTIFACTS[artifact]
+    )
@@ -0,0 +1,353 @@
+# backend/rate_limit.py
+"""
+限流与准入控制
+
+- 令牌桶限流：按登录用户（未登录时按 IP）和接口分别计数，容量为每个周期的请求数，令牌匀速补充
+- 准入控制：全局限制复杂问题路由、带大模型增强的 NER 等高开销请求的并发数，
+  超出时排队等待空位，等待超时返回 429 和 Retry-After
+- 状态保存在本地 SQLite 文件中，同一台机器上的多个 worker 进程共享；
+  准入名额带租约，进程异常退出后名额会在租约到期时自动释放
+- 存储出错时放行请求（fail open），避免限流组件故障影响正常服务
+"""
+import asyncio
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from functools import wraps
+
+from flask import request, jsonify, make_response
+
+from database.sqlite_config import apply_sqlite_pragmas
+from metrics import REGISTRY
+from routes.auth_routes import get_current_user
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_DECISIONS = REGISTRY.counter(
+    "rate_limit_decisions_total", "限流判定次数", ("scope", "result"))
+ADMISSION_DECISIONS = REGISTRY.counter(
+    "admission_decisions_total", "准入控制判定次数（admitted 为直接获得名额，queued 为排队后获得）", ("pool", "result"))
+
+DEFAULT_STORAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database", "rate_limits.db")
+
+# 各准入池的全局并发上限
+DEFAULT_ADMISSION_POOLS = {
+    "hard_route": int(os.getenv("ADMISSION_MAX_HARD_ROUTE", "8")),
+    "llm_ner": int(os.getenv("ADMISSION_MAX_LLM_NER", "4")),
+}
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+class AdmissionRejected(Exception):
+    """排队超时仍未获得准入名额"""
+
+    def __init__(self, pool, retry_after):
+        super().__init__(f"{pool} 并发已满")
+        self.pool = pool
+        self.retry_after = retry_after
+
+
+def parse_rate(rate):
+    """解析 "10 per minute" 形式的限额，返回 (桶容量, 每秒补充的令牌数)"""
+    count, _, period = rate.strip().split()
+    period = period.rstrip("s")
+    if period not in PERIODS:
+        raise ValueError(f"无效的限额: {rate}")
+    count = int(count)
+    return count, count / PERIODS[period]
+
+
+class MemoryStore:
+    """进程内存储（单进程部署或测试使用）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._slots = {}
+
+    def take_token(self, key, capacity, rate, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def acquire_slot(self, pool, holder, capacity, lease, now):
+        with self._lock:
+            slots = self._slots.setdefault(pool, {})
+            for expired in [h for h, expires in slots.items() if expires < now]:
+                del slots[expired]
+            if len(slots) >= capacity:
+                return False
+            slots[holder] = now + lease
+            return True
+
+    def release_slot(self, pool, holder):
+        with self._lock:
+            self._slots.get(pool, {}).pop(holder, None)
+
+
+class SQLiteStore:
+    """本地 SQLite 文件存储，同一台机器上的多个进程共享"""
+
+    # 每执行这么多次取令牌操作清理一次长期未使用的令牌桶
+    PRUNE_EVERY = 1000
+    # 超过这么久未使用的令牌桶会被清理（秒）
+    BUCKET_IDLE_SECONDS = 86400
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._ops = 0
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS token_buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS admission_slots ("
+            "holder TEXT PRIMARY KEY, pool TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_admission_slots_pool ON admission_slots (pool)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None：由下面的 BEGIN IMMEDIATE 显式控制事务
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            apply_sqlite_pragmas(conn)
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def take_token(self, key, capacity, rate, now):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT tokens, updated_at FROM token_buckets WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute(
+                "INSERT INTO token_buckets (key, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (key, tokens, now)
+            )
+            self._ops += 1
+            if self._ops % self.PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM token_buckets WHERE updated_at < ?", (now - self.BUCKET_IDLE_SECONDS,))
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def acquire_slot(self, pool, holder, capacity, lease, now):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM admission_slots WHERE expires_at < ?", (now,))
+            in_flight = conn.execute("SELECT count(*) FROM admission_slots WHERE pool = ?", (pool,)).fetchone()[0]
+            if in_flight >= capacity:
+                return False
+            conn.execute(
+                "INSERT INTO admission_slots (holder, pool, expires_at) VALUES (?, ?, ?)",
+                (holder, pool, now + lease)
+            )
+            return True
+
+    def release_slot(self, pool, holder):
+        self._connection().execute("DELETE FROM admission_slots WHERE holder = ?", (holder,))
+
+
+def _rate_limit_key():
+    """登录用户按用户ID计数，未登录时按IP"""
+    user = get_current_user()
+    if user is not None:
+        return f"user:{user.id}"
+    return f"ip:{request.remote_addr or '127.0.0.1'}"
+
+
+class RateLimiter:
+    """令牌桶限流 + 准入控制"""
+
+    def __init__(self):
+        self.enabled = os.getenv("RATE_LIMIT_ENABLED", "1").lower() in ("1", "true", "yes")
+        self.storage = os.getenv("RATE_LIMIT_STORAGE", DEFAULT_STORAGE)
+        self.admission_pools = dict(DEFAULT_ADMISSION_POOLS)
+        # 排队等待准入名额的最长时间（秒）
+        self.queue_timeout = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "20"))
+        # 拒绝时建议客户端的重试间隔（秒）
+        self.retry_after = int(os.getenv("ADMISSION_RETRY_AFTER", "15"))
+        # 准入名额的租约（秒），需长于最慢请求的耗时
+        self.lease = float(os.getenv("ADMISSION_LEASE", "900"))
+        self._store = None
+        self._store_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config.get("RATE_LIMIT_ENABLED", self.enabled)
+        self.storage = app.config.get("RATE_LIMIT_STORAGE", self.storage)
+        self.admission_pools.update(app.config.get("ADMISSION_POOLS", {}))
+        self._store = None
+
+    @property
+    def store(self):
+        if self._store is None:
+            with self._store_lock:
+                if self._store is None:
+                    self._store = MemoryStore() if self.storage == "memory" else SQLiteStore(self.storage)
+        return self._store
+
+    def check(self, rate, scope, error_field="error"):
+        """从当前请求的令牌桶中取一个令牌；超出限额时返回 429 响应，否则返回 None"""
+        if not self.enabled:
+            return None
+        capacity, refill_rate = parse_rate(rate)
+        try:
+            allowed, retry_after = self.store.take_token(
+                f"{scope}:{_rate_limit_key()}", capacity, refill_rate, time.time()
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"限流存储出错，放行请求: {str(e)}")
+            allowed, retry_after = True, 0.0
+        RATE_LIMIT_DECISIONS.inc(scope=scope, result="allowed" if allowed else "limited")
+        if allowed:
+            return None
+        retry_after = max(1, math.ceil(retry_after))
+        response = make_response(jsonify({
+            error_field: f"请求过于频繁，请 {retry_after} 秒后重试",
+            "retry_after": retry_after
+        }), 429)
+        response.headers["Retry-After"] = str(retry_after)
+        return response
+
+    def limit(self, rate, scope=None, error_field="error"):
+        """按令牌桶限制视图函数的调用频率，rate 形如 "10 per minute" """
+        parse_rate(rate)
+
+        def decorator(f):
+            limit_scope = scope or f.__name__
+
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                limited = self.check(rate, limit_scope, error_field)
+                if limited is not None:
+                    return limited
+                return f(*args, **kwargs)
+            # 供异步服务（async_server.py）对同一接口使用相同的限额
+            decorated.rate_limit = {"rate": rate, "scope": limit_scope, "error_field": error_field}
+            return decorated
+        return decorator
+
+    def _try_acquire(self, store, pool, holder):
+        """尝试获取一个准入名额；存储出错时返回 None，由调用方放行"""
+        try:
+            return store.acquire_slot(pool, holder, self.admission_pools[pool], self.lease, time.time())
+        except sqlite3.Error as e:
+            logger.warning(f"准入控制存储出错，放行请求: {str(e)}")
+            return None
+
+    def _release(self, store, pool, holder):
+        try:
+            store.release_slot(pool, holder)
+        except sqlite3.Error as e:
+            logger.warning(f"释放准入名额失败，将在租约到期后释放: {str(e)}")
+
+    @contextmanager
+    def admit(self, pool):
+        """在全局并发上限内执行代码块；名额已满时排队等待，超时抛出 AdmissionRejected"""
+        if not self.enabled:
+            yield
+            return
+        store = self.store
+        holder = uuid.uuid4().hex
+        deadline = time.monotonic() + self.queue_timeout
+        delay = 0.05
+        queued = False
+        while True:
+            acquired = self._try_acquire(store, pool, holder)
+            if acquired is None:
+                ADMISSION_DECISIONS.inc(pool=pool, result="admitted")
+                yield
+                return
+            if acquired:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                ADMISSION_DECISIONS.inc(pool=pool, result="rejected")
+                raise AdmissionRejected(pool, self.retry_after)
+            queued = True
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
+
+        ADMISSION_DECISIONS.inc(pool=pool, result="queued" if queued else "admitted")
+        try:
+            yield
+        finally:
+            self._release(store, pool, holder)
+
+    async def _try_acquire_async(self, store, pool, holder):
+        """在线程池中尝试获取名额；等待期间被取消时归还可能已经取得的名额"""
+        future = asyncio.ensure_future(asyncio.to_thread(self._try_acquire, store, pool, holder))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if await future:
+                await asyncio.to_thread(self._release, store, pool, holder)
+            raise
+
+    @asynccontextmanager
+    async def admit_async(self, pool):
+        """admit 的协程版本：排队时让出事件循环，存储读写在线程池中执行"""
+        if not self.enabled:
+            yield
+            return
+        store = self.store
+        holder = uuid.uuid4().hex
+        deadline = time.monotonic() + self.queue_timeout
+        delay = 0.05
+        queued = False
+        while True:
+            acquired = await self._try_acquire_async(store, pool, holder)
+            if acquired is None:
+                ADMISSION_DECISIONS.inc(pool=pool, result="admitted")
+                yield
+                return
+            if acquired:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                ADMISSION_DECISIONS.inc(pool=pool, result="rejected")
+                raise AdmissionRejected(pool, self.retry_after)
+            queued = True
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
+
+        ADMISSION_DECISIONS.inc(pool=pool, result="queued" if queued else "admitted")
+        try:
+            yield
+        finally:
+            # 请求被取消（客户端断开）时同样归还名额
+            await asyncio.shield(asyncio.to_thread(self._release, store, pool, holder))
+
+
+def admission_rejected_response(error, error_field="error", message="当前请求较多，请稍后重试"):
+    """准入被拒绝时的 429 响应"""
+    response = make_response(jsonify({error_field: message, "retry_after": error.retry_after}), 429)
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+limiter = RateLimiter()
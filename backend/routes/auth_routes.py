@@ -4,7 +4,9 @@ import datetime
 print(jwt.__file__) # 打印 jwt 模块的加载路径
 from functools import wraps
 from database.models import User, db
+from auth_cache import token_cache, user_cache
 import logging
+import os
 # 移除这个导入，因为我们不需要在蓝图级别设置 CORS
 # from flask_cors import CORS
 
@@ -20,6 +22,9 @@ auth_bp = Blueprint('auth', __name__)
 JWT_SECRET_KEY = 'your-secret-key'  # 在生产环境中应该使用环境变量存储
 JWT_EXPIRATION_HOURS = 24
 
+# 管理员用户名列表，逗号分隔（用于性能分析等运维功能）
+ADMIN_USERNAMES = {name.strip() for name in os.getenv('ADMIN_USERNAMES', '').split(',') if name.strip()}
+
 def create_token(user_id):
     """创建JWT token"""
     try:
@@ -36,6 +41,16 @@ def create_token(user_id):
         logger.error(f"创建token时出错: {str(e)}")
         raise
 
+def load_user_from_token(token):
+    """校验token并返回对应的用户（用户不存在时返回None）
+    校验结果和用户记录均有进程内缓存（见 auth_cache.py）；token无效或过期时抛出 jwt 异常"""
+    user_id = token_cache.get(token)
+    if user_id is None:
+        data = jwt.decode(token, JWT_SECRET_KEY, algorithms=['HS256'])
+        user_id = data['user_id']
+        token_cache.put(token, user_id, data.get('exp'))
+    return user_cache.load(user_id)
+
 def token_required(f):
     """验证token的装饰器"""
     @wraps(f)
@@ -45,8 +60,7 @@ def token_required(f):
             return jsonify({'message': '缺少token'}), 401
         try:
             token = token.split(' ')[1]  # Bearer token
-            data = jwt.decode(token, JWT_SECRET_KEY, algorithms=['HS256'])
-            current_user = User.query.get(data['user_id'])
+            current_user = load_user_from_token(token)
             if not current_user:
                 return jsonify({'message': '无效的token'}), 401
         except jwt.ExpiredSignatureError:
@@ -57,6 +71,31 @@ def token_required(f):
         return f(current_user, *args, **kwargs)
     return decorated
 
+def get_current_user():
+    """从请求头解析当前用户，未携带或token无效时返回None"""
+    token = request.headers.get('Authorization')
+    if not token:
+        return None
+    try:
+        token = token.split(' ')[1]  # Bearer token
+        return load_user_from_token(token)
+    except Exception:
+        return None
+
+def is_admin(user):
+    """判断用户是否为管理员"""
+    return user is not None and user.username in ADMIN_USERNAMES
+
+def admin_required(f):
+    """验证管理员身份的装饰器"""
+    @wraps(f)
+    @token_required
+    def decorated(current_user, *args, **kwargs):
+        if not is_admin(current_user):
+            return jsonify({'message': '需要管理员权限'}), 403
+        return f(current_user, *args, **kwargs)
+    return decorated
+
 @auth_bp.route('/login', methods=['POST'])
 def login():
     try:
@@ -168,4 +207,20 @@ def register():
 @auth_bp.route('/user', methods=['GET'])
 @token_required
 def get_user(current_user):
-    return jsonify(current_user.to_dict()), 200
\ No newline at end of file
+    return jsonify(current_user.to_dict()), 200
+
+@auth_bp.route('/preferences', methods=['PUT'])
+@token_required
+def update_preferences(current_user):
+    """更新用户偏好设置，目前支持 answer_cache（是否使用简单查询答案缓存）"""
+    data = request.get_json()
+    if not data or 'answer_cache' not in data:
+        return jsonify({'message': '无效的请求数据'}), 400
+    try:
+        current_user.answer_cache_opt_out = not bool(data['answer_cache'])
+        db.session.commit()
+        return jsonify(current_user.to_dict()), 200
+    except Exception as e:
+        logger.error(f"更新偏好设置时出错: {str(e)}")
+        db.session.rollback()
+        return jsonify({'message': '更新偏好设置失败'}), 500
@@ -1,23 +1,40 @@
-from flask import Blueprint, request, jsonify, session
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from flask import Blueprint, request, jsonify, session, Response
 import requests
+import httpx
+import asyncio
 import os
 from uuid import uuid4
 import bleach
 from dotenv import load_dotenv
 import json
+import logging
 from utils import (
     deepseek_client,
     DEEPSEEK_AVAILABLE,
+    DEEPSEEK_BASE_URL,
     classify_input_complexity,
     process_with_traditional_culture_view,
     process_with_deepseek,
-    create_combined_prompt
+    create_combined_prompt,
+    estimate_tokens
 )
 # 导入数据库模型
 from database.models import db, ChatSession, ChatMessage
+from database.write_behind import chat_writer, persist_chat_turn
+from database.history_cache import SessionHistoryCache
+from database.chat_search import search_messages
+from database.transfer import iter_export_lines, import_ndjson, TransferFormatError
+from answer_cache import answer_cache
+from llm_usage import track_llm_call, take_usage_records, summarize_usage
 from datetime import datetime
+from metrics import CHAT_STAGE_SECONDS, CHAT_ROUTES
+from profiling import profiled
+from routes.auth_routes import get_current_user, is_admin, admin_required
+from rate_limit import limiter, AdmissionRejected, admission_rejected_response
+import async_llm
+from async_server import run_sync
+
+logger = logging.getLogger(__name__)
 
 # 加载环境变量
 load_dotenv()
@@ -25,31 +42,98 @@ load_dotenv()
 # 创建蓝图
 chat_bp = Blueprint("chat", __name__)
 
-# 速率限制器
-limiter = Limiter(key_func=get_remote_address, default_limits=["200 per day", "50 per hour"])
-
 # 配置API密钥
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
+# 原有API方案（未使用动态路由）的系统提示词
+SYSTEM_PROMPT = "你是一个古汉语知识助手，请根据提问进行回答。"
+# 每轮对话携带的历史消息token预算
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "4000"))
+# 按预算加载历史时每次查询的消息条数
+HISTORY_FETCH_SIZE = 20
+# /api/history 单页最大条数
+HISTORY_MAX_PAGE_SIZE = 200
+# /api/sessions 单页最大条数
+SESSIONS_MAX_PAGE_SIZE = 200
+# /api/history/search 单页最大条数
+SEARCH_MAX_PAGE_SIZE = 50
+# 由首条用户消息生成的备选标题的最大长度
+FALLBACK_TITLE_LENGTH = 30
+
+# 活跃会话的最近历史缓存
+session_history_cache = SessionHistoryCache(CHAT_HISTORY_TOKEN_BUDGET, estimate_tokens)
+
 # 导入OpenAI客户端 - 必要时使用
 try:
     from openai import OpenAI
     # 配置DeepSeek客户端
-    deepseek_client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com", timeout=150)
-    deepseek_r1_client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com", timeout=150)
+    deepseek_client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL, timeout=150)
+    deepseek_r1_client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL, timeout=150)
     DEEPSEEK_AVAILABLE = True
 except (ImportError, Exception) as e:
-    print(f"DeepSeek客户端初始化失败: {str(e)}")
+    logger.error(f"DeepSeek客户端初始化失败: {str(e)}")
     DEEPSEEK_AVAILABLE = False
 
+def current_owner_id():
+    """当前请求对应的会话归属：登录用户的 ID，未登录时为 None（未归属任何用户的会话）"""
+    current_user = get_current_user()
+    return current_user.id if current_user else None
+
+def find_session(session_id, owner_id):
+    """
+    查找会话，返回 (会话, 是否可访问)；会话不存在时返回 (None, True)
+    会话只能由其归属用户访问，未归属的会话只能由未登录用户访问
+    """
+    session = db.session.get(ChatSession, session_id)
+    return session, session is None or session.user_id == owner_id
+
+def session_not_found():
+    # 属于其他用户的会话同样返回 404，不暴露会话是否存在
+    return jsonify({"success": False, "message": "会话不存在"}), 404
+
+def load_recent_history(session_id, token_budget=CHAT_HISTORY_TOKEN_BUDGET):
+    """
+    加载会话中最近的、总量不超过token预算的消息（按时间顺序返回）
+    使用 (session_id, id) 索引自新向旧分批范围查询，开销与会话总长度无关
+    """
+    history = []
+    used_tokens = 0
+    before_id = None
+    while True:
+        query = db.session.query(ChatMessage.id, ChatMessage.role, ChatMessage.content).filter(
+            ChatMessage.session_id == session_id
+        )
+        if before_id is not None:
+            query = query.filter(ChatMessage.id < before_id)
+        rows = query.order_by(ChatMessage.id.desc()).limit(HISTORY_FETCH_SIZE).all()
+        
+        for row in rows:
+            used_tokens += estimate_tokens(row.content)
+            if used_tokens > token_budget:
+                history.reverse()
+                return history
+            history.append({"role": row.role, "content": row.content})
+            
+        if len(rows) < HISTORY_FETCH_SIZE:
+            break
+        before_id = rows[-1].id
+        
+    history.reverse()
+    return history
+
 @chat_bp.route("/session", methods=["GET"])
 def create_session():
     """生成新的会话 ID 并在数据库中创建会话记录"""
     session_id = str(uuid4())
     
-    # 在数据库中创建新会话，使用默认标题
+    # 在数据库中创建新会话，使用默认标题，登录用户的会话归属于该用户
     default_title = f"会话 {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-    new_session = ChatSession(id=session_id, title=default_title)
+    current_user = get_current_user()
+    new_session = ChatSession(
+        id=session_id,
+        title=default_title,
+        user_id=current_user.id if current_user else None
+    )
     db.session.add(new_session)
     
     try:
@@ -59,165 +143,345 @@ def create_session():
         db.session.rollback()
         return jsonify({"error": f"创建会话失败: {str(e)}"}), 500
 
-@chat_bp.route("/chat", methods=["POST"])
-@limiter.limit("10 per minute")
-def chat():
-    try:
-        # 确保请求使用UTF-8编码解析
-        request.charset = 'utf-8'
-        data = request.get_json(force=True)  # 强制使用UTF-8解析
-        
-        if not data or "query" not in data or "session_id" not in data:
-            return jsonify({"reply": "请求数据无效，请提供 query 和 session_id。"}), 400
+def prepare_chat_turn():
+    """
+    解析 /api/chat 请求并加载会话历史（调用大模型之前的阻塞部分）
+    返回 (本轮对话状态, None)，请求无效时返回 (None, 错误响应)
+    """
+    # 确保请求使用UTF-8编码解析
+    request.charset = 'utf-8'
+    data = request.get_json(force=True)  # 强制使用UTF-8解析
+    
+    if not data or "query" not in data or "session_id" not in data:
+        return None, (jsonify({"reply": "请求数据无效，请提供 query 和 session_id。"}), 400)
 
-        # 确保输入是UTF-8编码
-        user_input = bleach.clean(str(data["query"]).encode('utf-8').decode('utf-8'))
-        session_id = str(data["session_id"]).encode('utf-8').decode('utf-8')
+    # 确保输入是UTF-8编码
+    user_input = bleach.clean(str(data["query"]).encode('utf-8').decode('utf-8'))
+    session_id = str(data["session_id"]).encode('utf-8').decode('utf-8')
+    
+    # 是否使用简单查询答案缓存 (可选参数；登录用户也可以在偏好设置中关闭)
+    current_user = get_current_user()
+    use_answer_cache = data.get("use_answer_cache", True) and not (
+        current_user and current_user.answer_cache_opt_out
+    )
+
+    # 验证输入长度
+    if not (1 <= len(user_input) <= 500):
+        return None, (jsonify({"reply": "输入无效，请输入1-500字符的问题。"}), 400)
+
+    # 优先使用缓存的历史；缓存按 (归属用户, 会话) 存储，命中说明会话已存在且属于当前用户，无需访问数据库
+    owner_id = current_user.id if current_user else None
+    cache_key = (owner_id, session_id)
+    chat_history = session_history_cache.get(cache_key)
+    session_exists = chat_history is not None
+    if chat_history is None:
+        # 本进程中该会话还有尚未落盘的对话时先等待写入完成，保证读到最新的历史
+        chat_writer.flush(session_id)
         
+        # 从数据库获取会话，并加载token预算内的最近历史消息
+        with CHAT_STAGE_SECONDS.time(stage="db_read"):
+            session, allowed = find_session(session_id, owner_id)
+            if not allowed:
+                db.session.close()
+                return None, (jsonify({"reply": "会话不存在。"}), 404)
+            session_exists = session is not None
+            chat_history = load_recent_history(session_id)
+        # 归还数据库连接，避免在等待大模型回复期间占用连接池
+        db.session.close()
+        session_history_cache.put(cache_key, chat_history)
+    
+    # 更新内存中的聊天历史用于API调用
+    chat_history.append({"role": "user", "content": user_input})
+    
+    return {
+        "query": user_input,
+        "session_id": session_id,
+        "user_id": owner_id,
+        "session_exists": session_exists,
+        "chat_history": chat_history,
+        "user_sent_at": datetime.utcnow(),
         # 是否使用动态路由 (可选参数)
-        use_dynamic_routing = data.get("use_dynamic_routing", True)
+        "use_dynamic_routing": data.get("use_dynamic_routing", True) and DEEPSEEK_AVAILABLE,
         # 是否使用流式输出 (可选参数)
-        use_streaming = data.get("streaming", False)
-
-        # 验证输入长度
-        if not (1 <= len(user_input) <= 500):
-            return jsonify({"reply": "输入无效，请输入1-500字符的问题。"}), 400
-
-        # 从数据库获取会话
-        chat_session = ChatSession.query.get(session_id)
-        if not chat_session:
-            # 如果会话不存在，创建新会话
-            chat_session = ChatSession(id=session_id)
-            db.session.add(chat_session)
-            db.session.commit()
-        
-        # 从数据库加载历史消息
-        chat_history = []
-        db_messages = ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.created_at).all()
-        for msg in db_messages:
-            chat_history.append({"role": msg.role, "content": msg.content})
-        
-        # 添加用户消息到数据库
-        user_message = ChatMessage(
-            session_id=session_id,
-            role="user",
-            content=user_input
-        )
-        db.session.add(user_message)
-        db.session.commit()
-        
-        # 更新内存中的聊天历史用于API调用
-        chat_history.append({"role": "user", "content": user_input})
+        "streaming": data.get("streaming", False),
+        "use_answer_cache": use_answer_cache
+    }, None
+
+def finish_chat_turn(turn, reply_text, routing_info):
+    """保存本轮对话并构建响应（得到大模型回复之后的阻塞部分）"""
+    session_id = turn["session_id"]
+    user_input = turn["query"]
+    
+    # 本轮对话的大模型调用用量，随消息一起保存
+    usage_records = take_usage_records()
+    if routing_info is not None:
+        routing_info["usage"] = summarize_usage(usage_records)
+    
+    # 会话（如不存在则新建）、用户消息、AI回复、最后活动时间和用量记录作为一个整体写入
+    replied_at = datetime.utcnow()
+    with CHAT_STAGE_SECONDS.time(stage="db_write"):
+        persist_chat_turn({
+            "session_id": session_id,
+            "user_id": turn["user_id"],
+            "create_session": not turn["session_exists"],
+            "messages": [
+                {"role": "user", "content": user_input, "routing_info": None, "created_at": turn["user_sent_at"]},
+                {"role": "assistant", "content": reply_text, "routing_info": routing_info,
+                 "created_at": replied_at}
+            ],
+            "last_activity": replied_at,
+            "usage": usage_records
+        })
+    session_history_cache.append((turn["user_id"], session_id), [("user", user_input), ("assistant", reply_text)])
+    
+    # 构建响应
+    response_data = {
+        "reply": reply_text.encode('utf-8').decode('utf-8')  # 确保Unicode编码
+    }
+    
+    # 如果使用了动态路由，添加路由信息
+    if routing_info:
+        response_data["routing_info"] = routing_info
         
-        # 系统提示词
-        system_prompt = "你是一个古汉语知识助手，请根据提问进行回答。"
+    # 设置UTF-8编码的响应头
+    response = jsonify(response_data)
+    response.headers['Content-Type'] = 'application/json; charset=utf-8'
+    return response
+
+def chat_error_response(e):
+    """/api/chat 处理过程中出现异常时的响应"""
+    if isinstance(e, AdmissionRejected):
+        # 复杂问题路由并发已满，本轮对话不写入，由客户端稍后重试
+        return admission_rejected_response(e, "reply", "当前复杂问题较多，请稍后重试。")
+    import traceback
+    traceback.print_exception(e)
+    db.session.rollback()
+    return jsonify({"reply": f"服务器错误: {str(e)}"}), 500
+
+@chat_bp.route("/chat", methods=["POST"])
+@limiter.limit("10 per minute", scope="chat", error_field="reply")
+@profiled
+def chat():
+    try:
+        turn, error_response = prepare_chat_turn()
+        if error_response is not None:
+            return error_response
         
         # 判断是否使用动态路由
         routing_info = None
-        if use_dynamic_routing and DEEPSEEK_AVAILABLE:
+        if turn["use_dynamic_routing"]:
             # 使用动态路由机制
-            reply_text, routing_info = process_with_dynamic_routing(user_input, chat_history, use_streaming)
+            reply_text, routing_info = process_with_dynamic_routing(
+                turn["query"], turn["chat_history"], turn["streaming"], turn["use_answer_cache"]
+            )
         else:
             # 使用原有API（默认方案）
-            reply_text = process_with_original_api(user_input, chat_history, system_prompt)
+            reply_text = process_with_original_api(turn["query"], turn["chat_history"], SYSTEM_PROMPT)
             
-        # 添加AI回复到数据库
-        assistant_message = ChatMessage(
-            session_id=session_id,
-            role="assistant",
-            content=reply_text,
-            routing_info=routing_info
-        )
-        db.session.add(assistant_message)
-        
-        # 更新会话的最后活动时间
-        chat_session.last_activity = db.func.current_timestamp()
-        db.session.commit()
-        
-        # 构建响应
-        response_data = {
-            "reply": reply_text.encode('utf-8').decode('utf-8')  # 确保Unicode编码
-        }
+        return finish_chat_turn(turn, reply_text, routing_info)
+
+    except Exception as e:
+        return chat_error_response(e)
+
+async def chat_async():
+    """
+    /api/chat 的协程版本（异步服务模式，见 async_server.py）
+    数据库读写在线程池中执行，等待大模型回复期间不占用线程
+    """
+    try:
+        turn, error_response = await run_sync(prepare_chat_turn)
+        if error_response is not None:
+            return error_response
         
-        # 如果使用了动态路由，添加路由信息
-        if routing_info:
-            response_data["routing_info"] = routing_info
+        routing_info = None
+        if turn["use_dynamic_routing"]:
+            reply_text, routing_info = await process_with_dynamic_routing_async(
+                turn["query"], turn["chat_history"], turn["streaming"], turn["use_answer_cache"]
+            )
+        else:
+            reply_text = await process_with_original_api_async(turn["query"], turn["chat_history"], SYSTEM_PROMPT)
             
-        # 设置UTF-8编码的响应头
-        response = jsonify(response_data)
-        response.headers['Content-Type'] = 'application/json; charset=utf-8'
-        return response
+        return await run_sync(finish_chat_turn, turn, reply_text, routing_info)
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        db.session.rollback()
-        return jsonify({"reply": f"服务器错误: {str(e)}"}), 500
+        return await run_sync(chat_error_response, e)
+
+def cached_easy_answer(query):
+    """命中简单查询答案缓存时返回 (答案, 路由信息)，否则返回 None"""
+    cached = answer_cache.get(query)
+    if not cached:
+        return None
+    answer, model_used, similarity = cached
+    return answer, {
+        "complexity": "easy",
+        "model_used": model_used,
+        "cached": True,
+        "similarity": round(similarity, 3)
+    }
+
+def start_routing(complexity):
+    """记录分类结果并返回路由信息"""
+    logger.info(f"查询复杂度: {complexity}")
+    CHAT_ROUTES.inc(complexity=complexity)
+    return {
+        "complexity": complexity,
+        "model_used": "deepseek-reasoner" if complexity == "hard" else "deepseek-v3",
+        "cached": False
+    }
+
+def easy_answer_messages(query):
+    """简单查询直接作答的消息列表"""
+    return [
+        {"role": "system", "content": "你是一个专注于古汉语和中国传统文化的AI助手"},
+        {"role": "user", "content": query}
+    ]
 
-def process_with_dynamic_routing(query, chat_history, streaming=False):
+def format_r1_answer(final_response):
+    """拼接 DeepSeek-R1 的最终答案和推理过程"""
+    reasoning = final_response.reasoning_content if hasattr(final_response, 'reasoning_content') else ""
+    answer = final_response.content
+    return f"{answer}\n\n推理过程：\n{reasoning}" if reasoning else answer
+
+def process_with_dynamic_routing(query, chat_history, streaming=False, use_answer_cache=True):
     """
     使用动态路由机制处理查询
+    简单查询的答案只取决于问题本身，命中答案缓存时直接返回，不调用任何API
     返回: (回复文本, 路由信息)
     """
     try:
+        cached = cached_easy_answer(query) if use_answer_cache else None
+        if cached:
+            return cached
+        
         # 使用 DeepSeek-V3 判断查询复杂度
         complexity = classify_input_complexity(query)
-        print(f"查询复杂度: {complexity}")
         
         # 准备路由信息
-        routing_info = {
-            "complexity": complexity,
-            "model_used": "deepseek-reasoner" if complexity == "hard" else "deepseek-v3"
-        }
+        routing_info = start_routing(complexity)
         
         if complexity == "easy":
             # 简单查询直接使用 DeepSeek-V3 处理
-            print("使用 DeepSeek-V3 直接回答")
-            response = deepseek_client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[
-                    {"role": "system", "content": "你是一个专注于古汉语和中国传统文化的AI助手"},
-                    {"role": "user", "content": query}
-                ],
-                temperature=0.7,
-                max_tokens=1000,
-                stream=False
-            )
-            return response.choices[0].message.content, routing_info
+            logger.debug("使用 DeepSeek-V3 直接回答")
+            with CHAT_STAGE_SECONDS.time(stage="easy_answer"), track_llm_call("easy_answer", "deepseek-chat") as call:
+                response = deepseek_client.chat.completions.create(
+                    model="deepseek-chat",
+                    messages=easy_answer_messages(query),
+                    temperature=0.7,
+                    max_tokens=1000,
+                    stream=False
+                )
+                call.record(response.usage)
+            answer = response.choices[0].message.content
+            if use_answer_cache:
+                answer_cache.put(query, answer, routing_info["model_used"])
+            return answer, routing_info
             
         else:
             # 复杂查询使用多模型协作
-            print("使用复合模型处理复杂查询")
+            logger.debug("使用复合模型处理复杂查询")
             
-            # 1. 传统文化视角处理
-            traditional_culture_response = process_with_traditional_culture_view(query)
+            # 复杂查询一次会发起三个大模型调用，受全局并发上限约束
+            with limiter.admit("hard_route"):
+                # 1. 传统文化视角处理
+                traditional_culture_response = process_with_traditional_culture_view(query)
+                
+                # 2. DeepSeek-V3 逻辑分析视角处理
+                deepseek_response = process_with_deepseek(query)
+                
+                # 3. 使用 DeepSeek-R1 作为主力模型
+                combined_prompt = create_combined_prompt(query, traditional_culture_response, deepseek_response)
+                
+                with CHAT_STAGE_SECONDS.time(stage="r1"), track_llm_call("r1", "deepseek-reasoner") as call:
+                    response = deepseek_client.chat.completions.create(
+                        model="deepseek-reasoner",
+                        messages=[{"role": "user", "content": combined_prompt}],
+                        temperature=0.7,
+                        max_tokens=2000,
+                        stream=False
+                    )
+                    call.record(response.usage)
             
-            # 2. DeepSeek-V3 逻辑分析视角处理
-            deepseek_response = process_with_deepseek(query)
+            # 获取推理过程和最终答案，返回完整回答
+            return format_r1_answer(response.choices[0].message), routing_info
             
-            # 3. 使用 DeepSeek-R1 作为主力模型
-            combined_prompt = create_combined_prompt(query, traditional_culture_response, deepseek_response)
-            
-            response = deepseek_client.chat.completions.create(
-                model="deepseek-reasoner",
-                messages=[{"role": "user", "content": combined_prompt}],
-                temperature=0.7,
-                max_tokens=2000,
-                stream=False
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logger.error(f"动态路由处理错误: {str(e)}")
+        # 出错时，返回没有路由信息的结果
+        return process_with_original_api(query, chat_history, SYSTEM_PROMPT), None
+
+async def process_with_dynamic_routing_async(query, chat_history, streaming=False, use_answer_cache=True):
+    """
+    process_with_dynamic_routing 的协程版本
+    复杂查询的两个辅助视角互不依赖，在这里并发请求
+    """
+    try:
+        cached = cached_easy_answer(query) if use_answer_cache else None
+        if cached:
+            return cached
+        
+        complexity = await async_llm.classify_input_complexity(query)
+        routing_info = start_routing(complexity)
+        
+        if complexity == "easy":
+            response = await async_llm.create_chat_completion(
+                "easy_answer", "easy_answer", "deepseek-chat", easy_answer_messages(query),
+                temperature=0.7, max_tokens=1000, stream=False
             )
+            answer = response.choices[0].message.content
+            if use_answer_cache:
+                answer_cache.put(query, answer, routing_info["model_used"])
+            return answer, routing_info
             
-            # 获取推理过程和最终答案
-            final_response = response.choices[0].message
-            reasoning = final_response.reasoning_content if hasattr(final_response, 'reasoning_content') else ""
-            answer = final_response.content
-            
-            # 返回完整回答
-            return (f"{answer}\n\n推理过程：\n{reasoning}" if reasoning else answer), routing_info
+        else:
+            async with limiter.admit_async("hard_route"):
+                traditional_culture_response, deepseek_response = await asyncio.gather(
+                    async_llm.process_with_traditional_culture_view(query),
+                    async_llm.process_with_deepseek(query)
+                )
+                combined_prompt = create_combined_prompt(query, traditional_culture_response, deepseek_response)
+                response = await async_llm.create_chat_completion(
+                    "r1", "r1", "deepseek-reasoner", [{"role": "user", "content": combined_prompt}],
+                    temperature=0.7, max_tokens=2000, stream=False
+                )
+            return format_r1_answer(response.choices[0].message), routing_info
             
+    except AdmissionRejected:
+        raise
     except Exception as e:
-        print(f"动态路由处理错误: {str(e)}")
-        # 出错时，返回没有路由信息的结果
-        return process_with_original_api(query, chat_history, "你是一个古汉语知识助手，请根据提问进行回答。"), None
+        logger.error(f"动态路由处理错误: {str(e)}")
+        return await process_with_original_api_async(query, chat_history, SYSTEM_PROMPT), None
+
+def original_api_request(chat_history, system_prompt):
+    """构建原有API方案的请求头和请求体"""
+    messages = [{"role": "system", "content": system_prompt}] + chat_history
+    
+    headers = {
+        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+        "Content-Type": "application/json; charset=utf-8",
+        "User-Agent": "ClassicalChineseAssistant/1.0",
+        "Accept": "application/json; charset=utf-8",
+        "Accept-Charset": "utf-8"
+    }
+
+    payload = {
+        "model": "deepseek-chat",  # 使用最新的 DeepSeek-V3
+        "messages": messages,
+        "stream": False,
+        "temperature": 0.7,
+        "max_tokens": 1000
+    }
+    return headers, payload
+
+def original_api_error_reply(error_msg):
+    """原有API请求失败时返回给用户的提示"""
+    if "401" in error_msg:
+        return "API 认证失败，请检查 API 密钥是否正确"
+    elif "timeout" in error_msg.lower():
+        return "请求超时，请稍后重试"
+    else:
+        return f"API 请求错误: {error_msg}"
 
 def process_with_original_api(query, chat_history, system_prompt):
     """
@@ -227,47 +491,60 @@ def process_with_original_api(query, chat_history, system_prompt):
         if not DEEPSEEK_API_KEY:
             return "API 密钥未配置，请检查 .env 文件"
             
-        messages = [{"role": "system", "content": system_prompt}] + chat_history
-        
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json; charset=utf-8",
-            "User-Agent": "ClassicalChineseAssistant/1.0",
-            "Accept": "application/json; charset=utf-8",
-            "Accept-Charset": "utf-8"
-        }
-
-        payload = {
-            "model": "deepseek-chat",  # 使用最新的 DeepSeek-V3
-            "messages": messages,
-            "stream": False,
-            "temperature": 0.7,
-            "max_tokens": 1000
-        }
-
-        response = requests.post(
-            "https://api.deepseek.com/v1/chat/completions",  # 使用 v1 路径
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+        headers, payload = original_api_request(chat_history, system_prompt)
+
+        with CHAT_STAGE_SECONDS.time(stage="original_api"), track_llm_call("original_api", payload["model"]) as call:
+            response = requests.post(
+                f"{DEEPSEEK_BASE_URL}/chat/completions",  # 默认使用 v1 路径
+                headers=headers,
+                json=payload,
+                timeout=30
+            )
+            if response.ok:
+                data = response.json()
+                call.record(data.get("usage"))
+            else:
+                call.status = "error"
         
         if response.status_code == 401:
             return "API 认证失败，请检查 API 密钥是否正确"
         
         response.raise_for_status()
-        data = response.json()
         content = data.get("choices", [{}])[0].get("message", {}).get("content", "无有效回复")
         return content.encode('utf-8').decode('utf-8')
         
     except requests.exceptions.RequestException as e:
-        error_msg = str(e)
-        if "401" in error_msg:
+        return original_api_error_reply(str(e))
+    except Exception as e:
+        return f"处理请求时发生错误: {str(e)}"
+
+async def process_with_original_api_async(query, chat_history, system_prompt):
+    """process_with_original_api 的协程版本"""
+    try:
+        if not DEEPSEEK_API_KEY:
+            return "API 密钥未配置，请检查 .env 文件"
+            
+        headers, payload = original_api_request(chat_history, system_prompt)
+
+        with CHAT_STAGE_SECONDS.time(stage="original_api"), track_llm_call("original_api", payload["model"]) as call:
+            response = await async_llm.post_json(
+                f"{DEEPSEEK_BASE_URL}/chat/completions", headers, payload, timeout=30
+            )
+            if response.is_success:
+                data = response.json()
+                call.record(data.get("usage"))
+            else:
+                call.status = "error"
+        
+        if response.status_code == 401:
             return "API 认证失败，请检查 API 密钥是否正确"
-        elif "timeout" in error_msg.lower():
-            return "请求超时，请稍后重试"
-        else:
-            return f"API 请求错误: {error_msg}"
+        
+        response.raise_for_status()
+        content = data.get("choices", [{}])[0].get("message", {}).get("content", "无有效回复")
+        return content.encode('utf-8').decode('utf-8')
+        
+    except httpx.HTTPError as e:
+        return original_api_error_reply(f"{type(e).__name__}: {e}")
     except Exception as e:
         return f"处理请求时发生错误: {str(e)}"
 
@@ -291,9 +568,16 @@ def clear_history():
     session_id = data["session_id"]
     
     try:
+        # 先等待该会话尚未落盘的对话写入，避免清空后又被写回
+        chat_writer.flush(session_id)
+        owner_id = current_owner_id()
+        _, allowed = find_session(session_id, owner_id)
+        if not allowed:
+            return session_not_found()
         # 从数据库中删除会话消息
         ChatMessage.query.filter_by(session_id=session_id).delete()
         db.session.commit()
+        session_history_cache.invalidate((owner_id, session_id))
         return jsonify({"success": True, "message": "会话历史已清空"})
     except Exception as e:
         db.session.rollback()
@@ -302,66 +586,234 @@ def clear_history():
 # 添加获取历史记录的接口
 @chat_bp.route("/history", methods=["GET"])
 def get_history():
-    """获取指定会话的历史记录"""
+    """
+    获取指定会话的历史记录（只能获取当前用户的会话，未登录时为未归属的会话）
+    支持游标分页：before_id 为上一页返回的 next_before_id，limit 为每页条数；
+    不传 limit 时返回全部历史
+    """
     session_id = request.args.get("session_id")
     if not session_id:
         return jsonify({"success": False, "message": "请求数据无效，请提供session_id。"}), 400
     
     try:
-        # 从数据库中查询会话消息
-        messages = ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.created_at).all()
+        before_id = request.args.get("before_id", type=int)
+        limit = request.args.get("limit", type=int)
+        if limit is not None:
+            limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+        chat_writer.flush(session_id)
+        _, allowed = find_session(session_id, current_owner_id())
+        if not allowed:
+            return session_not_found()
+        
+        # 从数据库中自新向旧查询会话消息（多取一条用于判断是否还有更早的消息）
+        query = ChatMessage.query.filter(ChatMessage.session_id == session_id)
+        if before_id is not None:
+            query = query.filter(ChatMessage.id < before_id)
+        query = query.order_by(ChatMessage.id.desc())
+        if limit is not None:
+            query = query.limit(limit + 1)
+        messages = query.all()
+        
+        has_more = limit is not None and len(messages) > limit
+        messages = messages[:limit] if limit is not None else messages
+        messages.reverse()
         
         # 转换为前端所需格式
         history = []
         for msg in messages:
             message_data = {
+                "id": msg.id,
                 "role": msg.role,
                 "content": msg.content
             }
             if msg.routing_info:
                 message_data["routingInfo"] = {
                     "complexity": msg.routing_info.get("complexity", ""),
-                    "model_used": msg.routing_info.get("model_used", "")
+                    "model_used": msg.routing_info.get("model_used", ""),
+                    "cached": msg.routing_info.get("cached", False)
                 }
             history.append(message_data)
             
-        return jsonify({"success": True, "history": history})
+        return jsonify({
+            "success": True,
+            "history": history,
+            "has_more": has_more,
+            "next_before_id": messages[0].id if has_more else None
+        })
     except Exception as e:
         return jsonify({"success": False, "message": f"获取历史记录失败: {str(e)}"}), 500
 
+@chat_bp.route("/history/search", methods=["GET"])
+def search_history():
+    """
+    全文搜索当前用户（未登录时为未归属任何用户的会话）的聊天记录，按相关度排序
+    参数：q 为搜索词（空格分隔的多个词需同时出现），page 从 1 开始，page_size 为每页条数
+    返回的 snippet 为 HTML 转义后的摘要，命中部分以 <mark> 标出
+    """
+    query = (request.args.get("q") or "").strip()
+    if not query:
+        return jsonify({"success": False, "message": "请提供搜索词 q"}), 400
+    page = max(1, request.args.get("page", 1, type=int))
+    page_size = max(1, min(request.args.get("page_size", 20, type=int), SEARCH_MAX_PAGE_SIZE))
+
+    try:
+        chat_writer.flush()
+        current_user = get_current_user()
+        results, has_more = search_messages(
+            db.session.connection(), query, current_user.id if current_user else None,
+            page_size, (page - 1) * page_size
+        )
+        return jsonify({"success": True, "results": results, "page": page, "has_more": has_more})
+    except Exception as e:
+        logger.error(f"搜索聊天记录失败: {str(e)}")
+        return jsonify({"success": False, "message": f"搜索失败: {str(e)}"}), 500
+
 # 添加会话列表接口（可选，用于管理多个会话）
 @chat_bp.route("/sessions", methods=["GET"])
 def get_sessions():
-    """获取所有会话列表"""
+    """
+    获取当前用户的会话列表（未登录时为未归属任何用户的会话），按最后活动时间倒序
+    支持游标分页：cursor 为上一页返回的 next_cursor，limit 为每页条数；不传 limit 时返回全部会话
+    """
     try:
-        # 查询活跃的会话
-        sessions = ChatSession.query.filter_by(is_active=True).order_by(ChatSession.last_activity.desc()).all()
+        limit = request.args.get("limit", type=int)
+        if limit is not None:
+            limit = max(1, min(limit, SESSIONS_MAX_PAGE_SIZE))
+        cursor = request.args.get("cursor")
+        # 等待本进程尚未落盘的对话写入，使新会话和最后活动时间反映在列表中
+        chat_writer.flush()
         
-        # 转换为前端所需格式
+        # 查询当前用户活跃的会话
+        current_user = get_current_user()
+        query = ChatSession.query.filter(
+            ChatSession.is_active == True,
+            (ChatSession.user_id == current_user.id) if current_user else ChatSession.user_id.is_(None)
+        )
+        
+        # 游标格式：<last_activity ISO时间>|<会话ID>
+        if cursor:
+            try:
+                cursor_activity, cursor_id = cursor.split("|", 1)
+                cursor_activity = datetime.fromisoformat(cursor_activity)
+            except ValueError:
+                return jsonify({"success": False, "message": "无效的分页游标"}), 400
+            query = query.filter(db.or_(
+                ChatSession.last_activity < cursor_activity,
+                db.and_(ChatSession.last_activity == cursor_activity, ChatSession.id < cursor_id)
+            ))
+        
+        query = query.order_by(ChatSession.last_activity.desc(), ChatSession.id.desc())
+        if limit is not None:
+            query = query.limit(limit + 1)
+        sessions = query.all()
+        
+        has_more = limit is not None and len(sessions) > limit
+        sessions = sessions[:limit] if limit is not None else sessions
+        
+        # 为没有标题的会话生成备选标题：一次查询取出各会话的第一条用户消息
+        untitled_ids = [session.id for session in sessions if not session.title]
+        fallback_titles = _derive_fallback_titles(untitled_ids) if untitled_ids else {}
+        
+        # 转换为前端所需格式（在提交前完成，避免提交后逐个刷新过期的对象）
         session_list = []
         for session in sessions:
-            # 使用会话的标题字段
-            title = session.title
-            
-            # 如果没有标题，则使用第一条用户消息作为备选标题
-            if not title:
-                first_message = ChatMessage.query.filter_by(session_id=session.id, role="user").order_by(ChatMessage.created_at).first()
-                title = first_message.content[:30] + "..." if first_message and len(first_message.content) > 30 else "新会话"
-                # 更新会话标题
-                session.title = title
-                db.session.commit()
-            
             session_list.append({
                 "id": session.id,
-                "title": title,
+                "title": session.title or fallback_titles[session.id],
                 "created_at": session.created_at.isoformat(),
                 "last_activity": session.last_activity.isoformat()
             })
+        
+        next_cursor = None
+        if has_more:
+            last = sessions[-1]
+            next_cursor = f"{last.last_activity.isoformat()}|{last.id}"
+        
+        # 一次批量更新写回备选标题（显式带上 last_activity，避免 onupdate 改变会话排序）
+        if fallback_titles:
+            db.session.bulk_update_mappings(ChatSession, [
+                {"id": session.id, "title": fallback_titles[session.id], "last_activity": session.last_activity}
+                for session in sessions if session.id in fallback_titles
+            ])
+            db.session.commit()
             
-        return jsonify({"success": True, "sessions": session_list})
+        return jsonify({"success": True, "sessions": session_list, "has_more": has_more, "next_cursor": next_cursor})
     except Exception as e:
+        db.session.rollback()
         return jsonify({"success": False, "message": f"获取会话列表失败: {str(e)}"}), 500
 
+def _derive_fallback_titles(session_ids):
+    """使用窗口函数一次查出每个会话的第一条用户消息，生成备选标题"""
+    ranked = db.session.query(
+        ChatMessage.session_id.label("session_id"),
+        ChatMessage.content.label("content"),
+        db.func.row_number().over(
+            partition_by=ChatMessage.session_id,
+            order_by=ChatMessage.id
+        ).label("rn")
+    ).filter(
+        ChatMessage.session_id.in_(session_ids),
+        ChatMessage.role == "user"
+    ).subquery()
+    
+    first_messages = dict(
+        db.session.query(ranked.c.session_id, ranked.c.content).filter(ranked.c.rn == 1).all()
+    )
+    
+    titles = {}
+    for session_id in session_ids:
+        content = first_messages.get(session_id)
+        if not content:
+            titles[session_id] = "新会话"
+        elif len(content) > FALLBACK_TITLE_LENGTH:
+            titles[session_id] = content[:FALLBACK_TITLE_LENGTH] + "..."
+        else:
+            titles[session_id] = content
+    return titles
+
+@chat_bp.route("/sessions/export", methods=["GET"])
+@limiter.limit("5 per minute", scope="sessions_export")
+def export_sessions():
+    """
+    以 NDJSON 流式导出当前用户的会话和消息（格式见 database/transfer.py）
+    参数：gzip=1 时输出 gzip 压缩文件；管理员传入 all=1 时导出全部会话
+    """
+    current_user = get_current_user()
+    if current_user is None:
+        return jsonify({"success": False, "message": "请先登录"}), 401
+    export_all = request.args.get("all") == "1"
+    if export_all and not is_admin(current_user):
+        return jsonify({"success": False, "message": "需要管理员权限"}), 403
+    compress = request.args.get("gzip") == "1"
+
+    chat_writer.flush()
+    # 导出在响应流中逐块进行，使用独立的数据库连接，不依赖请求上下文
+    chunks = iter_export_lines(db.engine, None if export_all else current_user.id, compress)
+    filename = "chat_sessions.ndjson.gz" if compress else "chat_sessions.ndjson"
+    return Response(
+        chunks,
+        mimetype="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+@chat_bp.route("/sessions/import", methods=["POST"])
+@admin_required
+def import_sessions(current_user):
+    """
+    导入 /api/sessions/export 导出的 NDJSON（请求体为文件内容，可以是 gzip 压缩的）
+    会话按用户名归属到本实例的用户；传入 owner=me 时全部归属当前管理员
+    """
+    owner_id = current_user.id if request.args.get("owner") == "me" else None
+    try:
+        stats = import_ndjson(db.engine, request.stream, owner_id)
+    except TransferFormatError as e:
+        return jsonify({"success": False, "message": f"导入失败: {str(e)}"}), 400
+    except Exception as e:
+        logger.error(f"导入聊天记录失败: {str(e)}")
+        return jsonify({"success": False, "message": f"导入失败: {str(e)}"}), 500
+    logger.info(f"导入聊天记录: {stats}")
+    return jsonify({"success": True, **stats})
+
 # 添加删除会话的接口
 @chat_bp.route("/delete_session", methods=["POST"])
 def delete_session():
@@ -373,14 +825,17 @@ def delete_session():
     session_id = data["session_id"]
     
     try:
+        chat_writer.flush(session_id)
         # 从数据库中查找会话
-        session = ChatSession.query.get(session_id)
-        if not session:
-            return jsonify({"success": False, "message": "会话不存在"}), 404
+        owner_id = current_owner_id()
+        session, allowed = find_session(session_id, owner_id)
+        if not session or not allowed:
+            return session_not_found()
             
         # 删除会话及其所有消息（级联删除）
         db.session.delete(session)
         db.session.commit()
+        session_history_cache.invalidate((owner_id, session_id))
         return jsonify({"success": True, "message": "会话已删除"})
     except Exception as e:
         db.session.rollback()
@@ -401,14 +856,17 @@ def rename_session():
         return jsonify({"success": False, "message": "标题不能为空"}), 400
     
     try:
+        chat_writer.flush(session_id)
         # 从数据库中查找会话
-        session = ChatSession.query.get(session_id)
-        if not session:
-            return jsonify({"success": False, "message": "会话不存在"}), 404
+        owner_id = current_owner_id()
+        session, allowed = find_session(session_id, owner_id)
+        if not session or not allowed:
+            return session_not_found()
         
         # 直接更新会话标题
         session.title = new_title
         db.session.commit()
+        session_history_cache.invalidate((owner_id, session_id))
         return jsonify({"success": True, "message": "会话已重命名"})
     except Exception as e:
         db.session.rollback()
@@ -1,9 +1,38 @@
 # backend/routes/ner_routes.py
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, jsonify, send_file, Response, current_app, stream_with_context
 import torch
 from transformers import BertTokenizerFast
 from bert_crf_model import BERT_CRF
+from text_alignment import TextAlignmentIndex
+from gazetteer import gazetteers
+from llm_correction import LLM_CORRECTION_CONCURRENCY, plan_regions, pack_regions, remap_entities, record_plan
+from metrics import NER_STAGE_SECONDS, NER_MODEL_LOAD_SECONDS, CACHE_REQUESTS
+from profiling import profiled, model_stage_profile
+from llm_usage import track_llm_call, take_usage_records, insert_usage_records, persist_pending_usage
+from rate_limit import limiter, AdmissionRejected, admission_rejected_response
+from routes.auth_routes import get_current_user, is_admin
+from database.models import db, NerJob
+from ner_jobs import create_job, job_status, assemble_result
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
 import requests
+import httpx
+import async_llm
+from async_server import run_sync
+from entity_analysis import (
+    ENTITY_BATCH_MAX_SPANS,
+    analysis_prompt,
+    base_entity_type,
+    entity_type_description,
+    entity_analysis_cache,
+    get_glossary,
+    entity_context,
+    plan_batches,
+    run_batches
+)
+import time
 import json
 import logging
 import traceback
@@ -12,7 +41,6 @@ from werkzeug.utils import secure_filename
 from io import BytesIO
 import configparser
 from pathlib import Path
-import re
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -20,6 +48,7 @@ load_dotenv()
 
 # 配置API密钥
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
 
 # 配置日志
 logging.basicConfig(
@@ -45,7 +74,7 @@ class Config:
         self.tokenizer_c_path = "../models/ner_model_c"
         
         # 大模型配置
-        self.api_endpoint = "https://api.deepseek.com/v1/chat/completions"
+        self.api_endpoint = f"{DEEPSEEK_BASE_URL}/chat/completions"
         self.api_key = DEEPSEEK_API_KEY
         self.selected_model_name = "deepseek-chat"
         self.request_timeout = 3600  # 秒
@@ -120,6 +149,10 @@ id2label_c = {
 VALID_ENTITY_TYPES_A = {'NR', 'NS', 'NB', 'NO', 'NG', 'T'}
 VALID_ENTITY_TYPES_C = {'ZD', 'ZZ', 'ZF', 'ZP', 'ZS', 'ZA'}
 
+# 异步服务模式下执行 BERT 推理的线程数；PyTorch 算子内部已多线程并行，线程过多只会互相争抢
+NER_INFERENCE_WORKERS = int(os.getenv("NER_INFERENCE_WORKERS", "2"))
+inference_executor = ThreadPoolExecutor(max_workers=NER_INFERENCE_WORKERS, thread_name_prefix="ner-inference")
+
 # 全局模型和分词器字典
 ner_models = {}
 ner_tokenizers = {}
@@ -129,8 +162,10 @@ def load_model(model_type):
     """根据模型类型加载对应的模型和分词器"""
     try:
         if model_type in ner_models and model_type in ner_tokenizers:
-            logger.info(f"使用缓存的模型 {model_type}")
+            CACHE_REQUESTS.inc(cache="ner_model", result="hit")
+            logger.debug(f"使用缓存的模型 {model_type}")
             return ner_models[model_type], ner_tokenizers[model_type]
+        CACHE_REQUESTS.inc(cache="ner_model", result="miss")
         
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         
@@ -143,9 +178,10 @@ def load_model(model_type):
         else:
             raise ValueError(f"不支持的模型类型: {model_type}")
             
-        model = BERT_CRF.from_pretrained(model_path)
-        model.to(device)
-        tokenizer = BertTokenizerFast.from_pretrained(tokenizer_path)
+        with NER_MODEL_LOAD_SECONDS.time(model_type=model_type):
+            model = BERT_CRF.from_pretrained(model_path)
+            model.to(device)
+            tokenizer = BertTokenizerFast.from_pretrained(tokenizer_path)
         
         # 缓存模型和分词器
         ner_models[model_type] = model
@@ -205,19 +241,16 @@ class LLMIntegrationHandler:
 返回格式：JSON列表
 """
 
-    def call_llm_api(self, text, entities):
-        """发起同步API调用，包含重试和超时处理"""
-        max_retries = 3
-        timeout = self.timeout
-        
+    def _build_request(self, text, entities, model_type):
+        """构建实体修正请求的请求头和请求体"""
         # 准备实体数据
         entities_json = json.dumps(
             [{"text": e["text"], "type": e["type"], "start": e["start"], "end": e["end"]} for e in entities],
             ensure_ascii=False
         )
     
-        # 根据当前模型类型选择提示词
-        if config.current_model_type == "C":
+        # 根据模型类型选择提示词
+        if model_type == "C":
             prompt = self.entity_prompt_c.format(text=text, entities=entities_json)
         else:
             prompt = self.entity_prompt_a.format(text=text, entities=entities_json)
@@ -232,22 +265,33 @@ class LLMIntegrationHandler:
             "messages": [{"role": "user", "content": prompt}],
             "stream": False
         }
+        return headers, payload
+
+    def call_llm_api(self, text, entities, model_type=None):
+        """发起同步API调用，包含重试和超时处理"""
+        max_retries = 3
+        timeout = self.timeout
+        model_type = model_type or config.current_model_type
+        headers, payload = self._build_request(text, entities, model_type)
 
         # 发起请求，包含重试逻辑
         for attempt in range(max_retries):
             try:
-                response = requests.post(
-                    self.api_endpoint,
-                    headers=headers,
-                    json=payload,
-                    timeout=timeout
-                )
-                response.raise_for_status()
+                with track_llm_call("ner_correction", self.model_name) as call:
+                    response = requests.post(
+                        self.api_endpoint,
+                        headers=headers,
+                        json=payload,
+                        timeout=timeout
+                    )
+                    response.raise_for_status()
+                    response_json = response.json()
+                    call.record(response_json.get("usage"))
                 
-                # 记录大模型返回的原始响应到日志
-                logger.info(f"大模型返回的原始JSON: {response.text}")
+                # 记录大模型返回的原始响应到日志（体积较大，仅在调试级别输出）
+                logger.debug(f"大模型返回的原始JSON: {response.text}")
                 
-                return self.parse_api_response(response.json(), text)
+                return self.parse_api_response(response_json, text, model_type)
             except requests.exceptions.Timeout:
                 logger.warning(f"API请求超时 (尝试 {attempt + 1}/{max_retries})")
                 if attempt == max_retries - 1:
@@ -259,7 +303,35 @@ class LLMIntegrationHandler:
         
         return []
 
-    def parse_api_response(self, response, original_text):
+    async def call_llm_api_async(self, text, entities, model_type=None):
+        """call_llm_api 的协程版本，等待大模型回复期间不占用线程"""
+        max_retries = 3
+        model_type = model_type or config.current_model_type
+        headers, payload = self._build_request(text, entities, model_type)
+
+        for attempt in range(max_retries):
+            try:
+                with track_llm_call("ner_correction", self.model_name) as call:
+                    response = await async_llm.post_json(self.api_endpoint, headers, payload, self.timeout)
+                    response.raise_for_status()
+                    response_json = response.json()
+                    call.record(response_json.get("usage"))
+                
+                logger.debug(f"大模型返回的原始JSON: {response.text}")
+                
+                return self.parse_api_response(response_json, text, model_type)
+            except httpx.TimeoutException:
+                logger.warning(f"API请求超时 (尝试 {attempt + 1}/{max_retries})")
+                if attempt == max_retries - 1:
+                    raise
+            except Exception as e:
+                logger.error(f"API调用失败: {traceback.format_exc()}")
+                if attempt == max_retries - 1:
+                    return []
+        
+        return []
+
+    def parse_api_response(self, response, original_text, model_type=None):
         """解析并验证API响应，确保实体对齐"""
         validated_entities = []
         
@@ -279,14 +351,17 @@ class LLMIntegrationHandler:
                 content = content.replace("'", '"')
                 entities = json.loads(content)
             
+            # 为整篇文档构建一次对齐索引，供所有实体复用
+            alignment_index = TextAlignmentIndex(original_text)
+            
             # 验证和修复每个实体
             for ent in entities:
                 # 验证实体基本属性
-                if not self._validate_entity_basics(ent):
+                if not self._validate_entity_basics(ent, model_type):
                     continue
                 
                 # 验证和修正实体位置
-                fixed_entity = self._fix_entity_boundaries(ent, original_text)
+                fixed_entity = self._fix_entity_boundaries(ent, original_text, alignment_index)
                 if fixed_entity:
                     validated_entities.append(fixed_entity)
                 
@@ -297,7 +372,7 @@ class LLMIntegrationHandler:
             logger.error(f"响应解析失败: {traceback.format_exc()}")
             return []
     
-    def _validate_entity_basics(self, entity):
+    def _validate_entity_basics(self, entity, model_type=None):
         """验证实体的基本属性"""
         # 检查必要字段
         if not all(k in entity for k in ['text', 'type', 'start', 'end']):
@@ -309,8 +384,9 @@ class LLMIntegrationHandler:
             logger.warning(f"实体文本为空: {entity}")
             return False
             
-        # 根据当前模型类型选择有效实体类型集合
-        valid_entity_types = VALID_ENTITY_TYPES_C if config.current_model_type == "C" else VALID_ENTITY_TYPES_A
+        # 根据模型类型选择有效实体类型集合
+        model_type = model_type or config.current_model_type
+        valid_entity_types = VALID_ENTITY_TYPES_C if model_type == "C" else VALID_ENTITY_TYPES_A
         
         # 检查实体类型
         if entity.get('type') not in valid_entity_types:
@@ -319,22 +395,25 @@ class LLMIntegrationHandler:
             
         return True
         
-    def _fix_entity_boundaries(self, entity, text):
+    def _fix_entity_boundaries(self, entity, text, alignment_index=None):
         """修正实体边界，确保位置准确"""
         start = entity.get('start', 0)
         end = entity.get('end', 0)
         entity_text = entity.get('text', '')
         
+        # 同一篇文档的对齐索引只构建一次，由调用方传入复用
+        if alignment_index is None:
+            alignment_index = TextAlignmentIndex(text)
+        
         # 基本范围检查
         if not (0 <= start <= end < len(text)):
             # 尝试在文本中找到实体位置
-            new_start = self._find_exact_position(text, entity_text, 0)
-            if new_start == -1:
+            span = alignment_index.locate(entity_text, 0)
+            if span is None:
                 logger.warning(f"无法找到实体位置: '{entity_text}'")
                 return None
                 
-            # 计算正确的end位置（最后一个字符的位置）
-            new_end = new_start + len(entity_text.strip()) - 1
+            new_start, new_end = span
             logger.info(f"已修正实体位置: '{entity_text}' 从 [{start},{end}] 到 [{new_start},{new_end}]")
             start = new_start
             end = new_end
@@ -342,11 +421,10 @@ class LLMIntegrationHandler:
             # 验证当前位置的文本是否匹配
             actual_text = text[start:end+1]
             if actual_text.strip() != entity_text.strip():
-                # 尝试在附近找到精确匹配
-                new_start = self._find_exact_position(text, entity_text, start)
-                if new_start != -1 and new_start != start:
-                    # 计算正确的end位置（最后一个字符的位置）
-                    new_end = new_start + len(entity_text.strip()) - 1
+                # 尝试在附近找到精确匹配（多处出现时取距离原位置最近的一处）
+                span = alignment_index.locate(entity_text, start)
+                if span is not None and span[0] != start:
+                    new_start, new_end = span
                     logger.info(f"调整实体位置: '{entity_text}' 从 [{start},{end}] 到 [{new_start},{new_end}]")
                     start = new_start
                     end = new_end
@@ -360,74 +438,22 @@ class LLMIntegrationHandler:
             "source": "llm"
         }
 
-    def _find_exact_position(self, text, target, start_hint):
+    def _find_exact_position(self, text, target, start_hint, alignment_index=None):
         """在文本中找到目标字符串的确切位置，考虑空格和标点符号的差异"""
-        if not target:
-            return -1
-            
-        # 清理文本和目标，去除标点和空白字符
-        def clean_text(s):
-            return re.sub(r'[\s,.，。、；！？:;!?]', '', s)
-            
-        cleaned_target = clean_text(target)
-        
-        # 如果清理后目标为空，返回失败
-        if not cleaned_target:
-            return -1
-            
-        # 首先尝试在原文中直接查找（精确匹配）
-        # 在指定的开始位置附近搜索
-        search_range = text[max(0, start_hint - 10):min(len(text), start_hint + len(target) + 10)]
-        pos = search_range.find(target)
-        if pos != -1:
-            return max(0, start_hint - 10) + pos
-            
-        # 在全文中搜索
-        pos = text.find(target)
-        if pos != -1:
-            return pos
-            
-        # 如果精确匹配失败，尝试清理后匹配
-        # 这种情况下我们需要逐字符扫描文本
-        cleaned_text = clean_text(text)
-        target_len = len(cleaned_target)
-        
-        # 从提示位置附近开始搜索
-        hint_index = min(max(0, start_hint), len(text) - 1)
-        
-        # 将原始文本位置映射到清理后的文本位置
-        cleaned_index = len(clean_text(text[:hint_index]))
-        
-        # 在清理后的文本中查找目标
-        pos = cleaned_text.find(cleaned_target, cleaned_index)
-        if pos == -1:
-            # 如果从提示位置开始找不到，尝试从头开始
-            pos = cleaned_text.find(cleaned_target)
-            
-        if pos == -1:
-            return -1
-            
-        # 找到匹配后，我们需要将清理后的位置映射回原始文本位置
-        # 计算原始文本中对应的开始位置
-        original_pos = 0
-        cleaned_pos = 0
-        
-        for i, char in enumerate(text):
-            if cleaned_pos == pos:
-                original_pos = i
-                break
-                
-            if not re.match(r'[\s,.，。、；！？:;!?]', char):
-                cleaned_pos += 1
-                
-        return original_pos
+        if alignment_index is None:
+            alignment_index = TextAlignmentIndex(text)
+        span = alignment_index.locate(target, start_hint)
+        return span[0] if span is not None else -1
 
 # 创建LLM处理器实例
 llm_handler = LLMIntegrationHandler()
 
 # 辅助函数
-def _convert_tags_to_entities(pred_tags, text):
-    """将预测标签转换为实体字典"""
+def _convert_tags_to_entities(pred_tags, text, tag_confidence=None):
+    """
+    将预测标签转换为实体字典
+    传入 tag_confidence（逐字预测标签的边缘概率）时，实体的 confidence 为其范围内各字的最小值
+    """
     entities = []
     current_entity = None
     tokens = list(text)
@@ -476,6 +502,10 @@ def _convert_tags_to_entities(pred_tags, text):
     # 处理最后一个可能未闭合的实体        
     if current_entity:
         entities.append(current_entity)
+    
+    if tag_confidence is not None:
+        for entity in entities:
+            entity['confidence'] = round(min(tag_confidence[entity['start']:entity['end'] + 1]), 4)
         
     return entities
 
@@ -512,6 +542,37 @@ def _merge_entities(base_ents, llm_ents):
             
     return unique_merged
 
+def _merge_lexicon_entities(base_ents, lexicon_ents):
+    """
+    合并词典命中：词典只补充基础模型没有识别的位置。与基础实体不重叠的命中直接加入；
+    完整覆盖一个或多个同类型基础实体的更长命中视为边界修正，替换被覆盖的基础实体；其余重叠的命中丢弃
+    """
+    if not lexicon_ents:
+        return base_ents
+        
+    merged = list(base_ents)
+    for hit in lexicon_ents:
+        overlapping = [
+            i for i, ent in enumerate(merged)
+            if ent['start'] <= hit['end'] and hit['start'] <= ent['end']
+        ]
+        if all(
+            merged[i]['type'] == hit['type'] and hit['start'] <= merged[i]['start'] and merged[i]['end'] <= hit['end']
+            for i in overlapping
+        ):
+            merged = [ent for i, ent in enumerate(merged) if i not in overlapping]
+            merged.append(hit)
+    
+    return sorted(merged, key=lambda x: (x['start'], -x['end']))
+
+def apply_lexicon(text, base_entities, model_type, enable_lexicon=True):
+    """用模型类型的词典预标注原文并合并到基础实体中；没有词典或未启用时原样返回"""
+    gazetteer = gazetteers.get(model_type) if enable_lexicon else None
+    if gazetteer is None:
+        return base_entities
+    with NER_STAGE_SECONDS.time(stage="lexicon_match", model_type=model_type):
+        return _merge_lexicon_entities(base_entities, gazetteer.find_entities(text))
+
 def format_result_text(token_label_pairs):
     """将实体识别结果格式化为带标记的文本"""
     result_text = ""
@@ -545,25 +606,19 @@ def format_result_text(token_label_pairs):
         
     return result_text
 
-def process_text(text, enable_llm=False, model_type=None):
-    """处理文本并返回实体识别结果"""
-    # 参数校验
-    if not text:
-        return None, "输入文本不能为空"
-        
-    # 如果指定了模型类型，则临时切换配置
-    original_model_type = config.current_model_type
-    if model_type and model_type in ["A", "C"]:
-        config.current_model_type = model_type
-        
-    try:
-        # 根据当前模型类型获取模型和分词器
-        current_model, current_tokenizer = load_model(config.current_model_type)
-        
-        # 获取当前标签映射
-        current_id2label = id2label_c if config.current_model_type == "C" else id2label_a
-        
-        # 准备输入数据
+def run_bert_inference(text, model_type):
+    """
+    BERT+CRF 推理，返回 (逐字标签, 基础实体, 逐字预测标签的边缘概率)
+    CPU/GPU 密集，异步服务模式下在推理线程池中执行
+    """
+    # 根据模型类型获取模型和分词器
+    current_model, current_tokenizer = load_model(model_type)
+    
+    # 获取当前标签映射
+    current_id2label = id2label_c if model_type == "C" else id2label_a
+    
+    # 准备输入数据
+    with NER_STAGE_SECONDS.time(stage="tokenize", model_type=model_type):
         inputs = current_tokenizer(
             list(text), 
             is_split_into_words=True, 
@@ -573,42 +628,69 @@ def process_text(text, enable_llm=False, model_type=None):
             return_tensors="pt"
         )
 
-        # 移除不需要的字段
-        if "token_type_ids" in inputs:
-            del inputs["token_type_ids"]
+    # 移除不需要的字段
+    if "token_type_ids" in inputs:
+        del inputs["token_type_ids"]
 
-        # 转移到正确设备
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        inputs = {k: v.to(device) for k, v in inputs.items()}
-        
-        # 模型推理
-        with torch.no_grad():
-            outputs = current_model(**inputs)
+    # 转移到正确设备
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+    
+    # 模型推理（分别统计编码器和CRF解码耗时）
+    with torch.no_grad(), model_stage_profile("ner_inference"):
+        with NER_STAGE_SECONDS.time(stage="encoder_forward", model_type=model_type):
+            emissions = current_model.compute_emissions(**inputs)
+            if device.type == "cuda":
+                # CUDA 异步执行，同步后计时才准确
+                torch.cuda.synchronize()
+        with NER_STAGE_SECONDS.time(stage="crf_decode", model_type=model_type):
+            tags = current_model.decode(emissions, mask=inputs["attention_mask"].bool())
+        # 前向-后向算法计算各位置标签的边缘概率，取维特比路径上每个标签的概率作为置信度
+        with NER_STAGE_SECONDS.time(stage="crf_marginals", model_type=model_type):
+            marginals = current_model.marginals(emissions, mask=inputs["attention_mask"].bool())
+            path = torch.tensor(tags[0], device=marginals.device)
+            path_probs = marginals[0, torch.arange(len(tags[0]), device=marginals.device), path].tolist()
 
-        # 获取预测结果
-        predictions = outputs["predictions"][0]
-        
-        # 将预测ID转换为标签（跳过CLS和SEP标记）
-        pred_tags = []
-        for i, pred in enumerate(predictions):
-            if i == 0 or i == len(predictions) - 1:
-                continue
-            pred_tags.append(current_id2label[pred])
+    # 获取预测结果
+    predictions = tags[0]
+    
+    # 将预测ID转换为标签（跳过CLS和SEP标记）
+    pred_tags = []
+    for i, pred in enumerate(predictions):
+        if i == 0 or i == len(predictions) - 1:
+            continue
+        pred_tags.append(current_id2label[pred])
+    tag_confidence = path_probs[1:-1]
 
-        # 将标签转换为实体
-        base_entities = _convert_tags_to_entities(pred_tags, text)
-        
-        # 根据设置决定是否使用LLM增强
-        if enable_llm:
-            try:
-                # 调用LLM进行实体修正和补充
-                llm_entities = llm_handler.call_llm_api(text, base_entities)
-                
+    # 将标签转换为实体
+    with NER_STAGE_SECONDS.time(stage="tags_to_entities", model_type=model_type):
+        base_entities = _convert_tags_to_entities(pred_tags, text, tag_confidence)
+    
+    return pred_tags, base_entities, tag_confidence
+
+def build_token_label_pairs(text, pred_tags, base_entities, llm_entities, model_type, tag_confidence=None):
+    """
+    生成逐字标注结果
+    llm_entities 为 None（未启用或调用失败）且没有词典命中时直接使用基础模型的结果
+    每个字附带 confidence（BERT+CRF 对该字预测标签的边缘概率）和 entity_confidence（所在基础模型实体的置信度），
+    标签来自词典或大模型的字两者均为 None
+    """
+    tag_confidence = tag_confidence or []
+    def confidence_at(i):
+        return round(tag_confidence[i], 4) if i < len(tag_confidence) else None
+    
+    has_lexicon = any(entity.get('source') == 'lexicon' for entity in base_entities)
+    if llm_entities is not None or has_lexicon:
+        try:
+            with NER_STAGE_SECONDS.time(stage="merge", model_type=model_type):
                 # 合并实体
-                merged_entities = _merge_entities(base_entities, llm_entities)
+                merged_entities = _merge_entities(base_entities, llm_entities or [])
                 
                 # 创建结果
-                token_label_pairs = [{"char": char, "label": "O", "source": "bert"} for char in text]
+                token_label_pairs = [
+                    {"char": char, "label": "O", "source": "bert", "confidence": confidence_at(i), "entity_confidence": None}
+                    for i, char in enumerate(text)
+                ]
                 
                 # 更新标签
                 for entity in merged_entities:
@@ -618,130 +700,355 @@ def process_text(text, enable_llm=False, model_type=None):
                         if 0 <= i < len(token_label_pairs):
                             token_label_pairs[i]["label"] = entity_type
                             token_label_pairs[i]["source"] = source
-                
+                            if source == 'bert':
+                                token_label_pairs[i]["entity_confidence"] = entity.get('confidence')
+                            else:
+                                token_label_pairs[i]["confidence"] = None
+            return token_label_pairs
+        except Exception as e:
+            # 失败时退回到使用基础模型结果
+            logger.error(f"大模型处理失败: {str(e)}")
+    
+    entity_confidence = {}
+    for entity in base_entities:
+        for i in range(entity['start'], entity['end'] + 1):
+            entity_confidence[i] = entity.get('confidence')
+    return [
+        {"char": char, "label": label, "source": "bert", "confidence": confidence_at(i), "entity_confidence": entity_confidence.get(i)}
+        for i, (char, label) in enumerate(zip(list(text), pred_tags))
+    ]
+
+def _combine_batch_results(batches, results):
+    """汇总各份摘录的修正结果：失败的摘录沿用模型结果，全部失败时返回 None（与整篇调用失败相同）"""
+    llm_entities = []
+    failed = 0
+    for batch, result in zip(batches, results):
+        if isinstance(result, BaseException):
+            failed += 1
+            logger.error(f"大模型修正摘录（{len(batch['parts'])} 个片段）失败: {str(result)}")
+            continue
+        llm_entities.extend(remap_entities(result, batch))
+    if batches and failed == len(batches):
+        return None
+    return llm_entities
+
+def correct_entities(text, base_entities, tag_confidence, model_type):
+    """大模型修正：只把不确定的句子（带上下文）交给大模型，多份摘录并发调用（策略见 llm_correction.py）"""
+    regions = plan_regions(text, base_entities, tag_confidence)
+    record_plan(text, regions, model_type)
+    if regions is None:
+        return llm_handler.call_llm_api(text, base_entities, model_type)
+    batches = pack_regions(text, base_entities, regions)
+    if len(batches) == 1:
+        return _combine_batch_results(batches, [llm_handler.call_llm_api(batches[0]["text"], batches[0]["entities"], model_type)])
+    
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, LLM_CORRECTION_CONCURRENCY)) as executor:
+        # 复制上下文，调用记录照常写入当前请求的 g
+        futures = [
+            executor.submit(contextvars.copy_context().run, llm_handler.call_llm_api, batch["text"], batch["entities"], model_type)
+            for batch in batches
+        ]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+    return _combine_batch_results(batches, results)
+
+async def correct_entities_async(text, base_entities, tag_confidence, model_type):
+    """correct_entities 的协程版本"""
+    regions = plan_regions(text, base_entities, tag_confidence)
+    record_plan(text, regions, model_type)
+    if regions is None:
+        return await llm_handler.call_llm_api_async(text, base_entities, model_type)
+    batches = pack_regions(text, base_entities, regions)
+    
+    semaphore = asyncio.Semaphore(max(1, LLM_CORRECTION_CONCURRENCY))
+    async def correct(batch):
+        async with semaphore:
+            return await llm_handler.call_llm_api_async(batch["text"], batch["entities"], model_type)
+    
+    results = await asyncio.gather(*(correct(batch) for batch in batches), return_exceptions=True)
+    return _combine_batch_results(batches, results)
+
+def process_text(text, enable_llm=False, model_type=None, enable_lexicon=True):
+    """处理文本并返回实体识别结果；词典命中合并到基础实体中，一并交给大模型修正"""
+    # 参数校验
+    if not text:
+        return None, "输入文本不能为空"
+        
+    # 未指定模型类型时使用当前默认模型
+    if model_type not in ["A", "C"]:
+        model_type = config.current_model_type
+        
+    try:
+        pred_tags, base_entities, tag_confidence = run_bert_inference(text, model_type)
+        base_entities = apply_lexicon(text, base_entities, model_type, enable_lexicon)
+        
+        # 根据设置决定是否使用LLM增强
+        llm_entities = None
+        if enable_llm:
+            try:
+                # 调用LLM进行实体修正和补充
+                with NER_STAGE_SECONDS.time(stage="llm_correction", model_type=model_type):
+                    llm_entities = correct_entities(text, base_entities, tag_confidence, model_type)
             except Exception as e:
                 logger.error(f"大模型处理失败: {str(e)}")
-                # 失败时退回到使用基础模型结果
-                token_label_pairs = [
-                    {"char": char, "label": label, "source": "bert"} 
-                    for char, label in zip(list(text), pred_tags)
-                ]
-        else:
-            # 不使用LLM，直接返回基础模型结果
-            token_label_pairs = [
-                {"char": char, "label": label, "source": "bert"} 
-                for char, label in zip(list(text), pred_tags)
-            ]
         
-        # 恢复原来的模型类型
-        if model_type:
-            config.current_model_type = original_model_type
-                           
-        return token_label_pairs, None
+        return build_token_label_pairs(text, pred_tags, base_entities, llm_entities, model_type, tag_confidence), None
+        
+    except Exception as e:
+        error_msg = f"处理文本时发生错误: {str(e)}"
+        logger.error(f"{error_msg}\n{traceback.format_exc()}")
+        return None, error_msg
+
+async def process_text_async(text, enable_llm=False, model_type=None, enable_lexicon=True):
+    """
+    process_text 的协程版本（异步服务模式）
+    BERT 推理在推理线程池中执行，大模型修正使用异步客户端
+    """
+    if not text:
+        return None, "输入文本不能为空"
+        
+    if model_type not in ["A", "C"]:
+        model_type = config.current_model_type
+        
+    try:
+        loop = asyncio.get_running_loop()
+        pred_tags, base_entities, tag_confidence = await loop.run_in_executor(
+            inference_executor, contextvars.copy_context().run, run_bert_inference, text, model_type
+        )
+        base_entities = apply_lexicon(text, base_entities, model_type, enable_lexicon)
+        
+        llm_entities = None
+        if enable_llm:
+            try:
+                with NER_STAGE_SECONDS.time(stage="llm_correction", model_type=model_type):
+                    llm_entities = await correct_entities_async(text, base_entities, tag_confidence, model_type)
+            except Exception as e:
+                logger.error(f"大模型处理失败: {str(e)}")
+        
+        return build_token_label_pairs(text, pred_tags, base_entities, llm_entities, model_type, tag_confidence), None
         
     except Exception as e:
-        # 恢复原来的模型类型
-        if model_type:
-            config.current_model_type = original_model_type
-            
         error_msg = f"处理文本时发生错误: {str(e)}"
         logger.error(f"{error_msg}\n{traceback.format_exc()}")
         return None, error_msg
 
 # API端点
+def parse_ner_request():
+    """解析 /api/ner 请求，返回 ((文本, 是否启用大模型, 模型类型, 是否启用词典), None) 或 (None, 错误响应)"""
+    # 解析请求
+    data = request.json
+    if not data:
+        return None, (jsonify({"error": "无效的请求数据"}), 400)
+        
+    # 获取参数
+    text = data.get("text", "").strip()
+    enable_llm = data.get("enable_llm", False)
+    model_type = data.get("model_type", config.current_model_type)  # 支持模型热切换
+    enable_lexicon = data.get("enable_lexicon", True)
+    
+    # 验证参数
+    if not text:
+        return None, (jsonify({"error": "输入文本不能为空"}), 400)
+        
+    if model_type not in ["A", "C"]:
+        return None, (jsonify({"error": f"不支持的模型类型: {model_type}"}), 400)
+    
+    return (text, enable_llm, model_type, enable_lexicon), None
+
+def ner_response(token_label_pairs, error, model_type):
+    """构建 /api/ner 的响应"""
+    if error:
+        return jsonify({"error": error}), 400
+        
+    with NER_STAGE_SECONDS.time(stage="serialize", model_type=model_type):
+        return jsonify(token_label_pairs)
+
 @ner_bp.route("/ner", methods=["POST"])
+@limiter.limit("60 per minute", scope="ner")
+@profiled
 def ner():
     """文本实体识别API"""
     try:
-        # 解析请求
-        data = request.json
-        if not data:
-            return jsonify({"error": "无效的请求数据"}), 400
-            
-        # 获取参数
-        text = data.get("text", "").strip()
-        enable_llm = data.get("enable_llm", False)
-        model_type = data.get("model_type", config.current_model_type)  # 支持模型热切换
-        
-        # 验证参数
-        if not text:
-            return jsonify({"error": "输入文本不能为空"}), 400
-            
-        if model_type not in ["A", "C"]:
-            return jsonify({"error": f"不支持的模型类型: {model_type}"}), 400
+        params, error_response = parse_ner_request()
+        if error_response is not None:
+            return error_response
+        text, enable_llm, model_type, enable_lexicon = params
 
-        # 处理文本
-        token_label_pairs, error = process_text(text, enable_llm, model_type)
+        # 处理文本（大模型增强受全局并发上限约束）
+        with limiter.admit("llm_ner") if enable_llm else nullcontext():
+            token_label_pairs, error = process_text(text, enable_llm, model_type, enable_lexicon)
         
         # 返回结果
-        if error:
-            return jsonify({"error": error}), 400
-            
-        return jsonify(token_label_pairs)
+        return ner_response(token_label_pairs, error, model_type)
         
+    except AdmissionRejected as e:
+        return admission_rejected_response(e, message="当前大模型增强请求较多，请稍后重试")
     except Exception as e:
         logger.error(f"处理API请求时发生错误: {traceback.format_exc()}")
         return jsonify({"error": f"处理请求时发生错误: {str(e)}"}), 500
 
+async def ner_async():
+    """/api/ner 的协程版本（异步服务模式，见 async_server.py）"""
+    try:
+        params, error_response = parse_ner_request()
+        if error_response is not None:
+            return error_response
+        text, enable_llm, model_type, enable_lexicon = params
+
+        if enable_llm:
+            async with limiter.admit_async("llm_ner"):
+                token_label_pairs, error = await process_text_async(text, enable_llm, model_type, enable_lexicon)
+        else:
+            token_label_pairs, error = await process_text_async(text, enable_llm, model_type, enable_lexicon)
+        
+        return ner_response(token_label_pairs, error, model_type)
+        
+    except AdmissionRejected as e:
+        return admission_rejected_response(e, message="当前大模型增强请求较多，请稍后重试")
+    except Exception as e:
+        logger.error(f"处理API请求时发生错误: {traceback.format_exc()}")
+        return jsonify({"error": f"处理请求时发生错误: {str(e)}"}), 500
+
+def parse_ner_file_request():
+    """解析上传文件的识别请求，返回 ((文件名, 文件内容, 是否启用大模型, 模型类型), None) 或 (None, 错误响应)"""
+    # 验证文件存在
+    if "file" not in request.files:
+        return None, (jsonify({"error": "未找到上传的文件"}), 400)
+        
+    # 获取文件和参数
+    file = request.files["file"]
+    enable_llm = request.form.get("enable_llm", "false").lower() == "true"
+    model_type = request.form.get("model_type", config.current_model_type)  # 支持模型热切换
+    
+    # 验证文件名
+    if file.filename == "":
+        return None, (jsonify({"error": "未选择文件"}), 400)
+        
+    # 验证文件扩展名
+    if not file.filename.endswith(".txt"):
+        return None, (jsonify({"error": "仅支持.txt文件"}), 400)
+        
+    # 验证模型类型
+    if model_type not in ["A", "C"]:
+        return None, (jsonify({"error": f"不支持的模型类型: {model_type}"}), 400)
+    
+    # 读取文件内容
+    content = file.read().decode("utf-8").strip()
+    if not content:
+        return None, (jsonify({"error": "文件内容为空"}), 400)
+    
+    return (file.filename, content, enable_llm, model_type), None
+
+def result_file_response(token_label_pairs, filename, model_type):
+    """把识别结果格式化为文本文件下载"""
+    # 格式化结果
+    with NER_STAGE_SECONDS.time(stage="serialize", model_type=model_type):
+        result_text = format_result_text(token_label_pairs)
+    
+    # 创建输出文件
+    output = BytesIO()
+    output.write(result_text.encode('utf-8'))
+    output.seek(0)
+    
+    # 生成下载文件名
+    filename = secure_filename(filename)
+    download_name = f"NER_{os.path.splitext(filename)[0]}_result.txt"
+    
+    # 返回文件
+    return send_file(
+        output,
+        as_attachment=True,
+        download_name=download_name,
+        mimetype="text/plain"
+    )
+
 @ner_bp.route("/ner/file", methods=["POST"])
+@limiter.limit("10 per minute", scope="ner_file")
 def ner_file():
     """文件实体识别API"""
     try:
-        # 验证文件存在
-        if "file" not in request.files:
-            return jsonify({"error": "未找到上传的文件"}), 400
-            
-        # 获取文件和参数
-        file = request.files["file"]
-        enable_llm = request.form.get("enable_llm", "false").lower() == "true"
-        model_type = request.form.get("model_type", config.current_model_type)  # 支持模型热切换
-        
-        # 验证文件名
-        if file.filename == "":
-            return jsonify({"error": "未选择文件"}), 400
+        params, error_response = parse_ner_file_request()
+        if error_response is not None:
+            return error_response
+        filename, content, enable_llm, model_type = params
             
-        # 验证文件扩展名
-        if not file.filename.endswith(".txt"):
-            return jsonify({"error": "仅支持.txt文件"}), 400
-            
-        # 验证模型类型
-        if model_type not in ["A", "C"]:
-            return jsonify({"error": f"不支持的模型类型: {model_type}"}), 400
-        
-        # 读取并处理文件内容
-        content = file.read().decode("utf-8").strip()
-        if not content:
-            return jsonify({"error": "文件内容为空"}), 400
-            
-        # 处理文本
-        token_label_pairs, error = process_text(content, enable_llm, model_type)
+        # 处理文本（大模型增强受全局并发上限约束）
+        with limiter.admit("llm_ner") if enable_llm else nullcontext():
+            token_label_pairs, error = process_text(content, enable_llm, model_type)
         if error:
             return jsonify({"error": error}), 400
             
-        # 格式化结果
-        result_text = format_result_text(token_label_pairs)
-        
-        # 创建输出文件
-        output = BytesIO()
-        output.write(result_text.encode('utf-8'))
-        output.seek(0)
-        
-        # 生成下载文件名
-        filename = secure_filename(file.filename)
-        download_name = f"NER_{os.path.splitext(filename)[0]}_result.txt"
-        
-        # 返回文件
-        return send_file(
-            output,
-            as_attachment=True,
-            download_name=download_name,
-            mimetype="text/plain"
-        )
+        return result_file_response(token_label_pairs, filename, model_type)
         
+    except AdmissionRejected as e:
+        return admission_rejected_response(e, message="当前大模型增强请求较多，请稍后重试")
     except Exception as e:
         logger.error(f"文件处理失败: {traceback.format_exc()}")
         return jsonify({"error": f"文件处理失败: {str(e)}"}), 500
 
+def _get_visible_job(job_id):
+    """查找任务；登录用户提交的任务只对本人和管理员可见"""
+    job = NerJob.query.get(job_id)
+    if job is None or job.user_id is None:
+        return job
+    current_user = get_current_user()
+    if current_user is not None and (current_user.id == job.user_id or is_admin(current_user)):
+        return job
+    return None
+
+@ner_bp.route("/ner/jobs", methods=["POST"])
+@limiter.limit("10 per minute", scope="ner_jobs")
+def submit_ner_job():
+    """
+    提交文件实体识别后台任务，参数与 /api/ner/file 相同
+    立即返回任务ID，通过 /api/ner/jobs/<job_id> 查询进度，完成后从 /api/ner/jobs/<job_id>/result 下载结果
+    """
+    try:
+        params, error_response = parse_ner_file_request()
+        if error_response is not None:
+            return error_response
+        filename, content, enable_llm, model_type = params
+        
+        current_user = get_current_user()
+        job_id, total_segments = create_job(
+            filename, content, model_type, enable_llm, current_user.id if current_user else None
+        )
+        return jsonify({
+            "job_id": job_id,
+            "status": "queued" if total_segments else "completed",
+            "total_segments": total_segments
+        }), 202
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"提交文件任务失败: {traceback.format_exc()}")
+        return jsonify({"error": f"提交文件任务失败: {str(e)}"}), 500
+
+@ner_bp.route("/ner/jobs/<job_id>", methods=["GET"])
+def get_ner_job(job_id):
+    """查询后台任务的状态、进度和预计剩余时间"""
+    job = _get_visible_job(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在"}), 404
+    return jsonify(job_status(job))
+
+@ner_bp.route("/ner/jobs/<job_id>/result", methods=["GET"])
+def get_ner_job_result(job_id):
+    """下载已完成任务的识别结果（格式与 /api/ner/file 相同）"""
+    job = _get_visible_job(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在"}), 404
+    if job.status != "completed":
+        return jsonify({"error": "任务尚未完成", "status": job.status}), 409
+    try:
+        return result_file_response(assemble_result(job), job.filename, job.model_type)
+    except Exception as e:
+        logger.error(f"生成任务结果失败: {traceback.format_exc()}")
+        return jsonify({"error": f"生成任务结果失败: {str(e)}"}), 500
+
 # 添加获取模型信息的API
 @ner_bp.route("/ner/models", methods=["GET"])
 def get_models_info():
@@ -810,121 +1117,361 @@ def switch_model():
         return jsonify({"error": f"切换模型失败: {str(e)}"}), 500
 
 # 添加实体分析API
+def entity_analysis_request():
+    """解析实体解析请求并构建大模型请求，返回 (请求信息, None) 或 (None, 错误响应)"""
+    # 解析请求
+    data = request.json
+    if not data:
+        return None, (jsonify({"error": "无效的请求数据"}), 400)
+        
+    # 获取参数
+    entity_text = data.get("entity_text")
+    entity_type = data.get("entity_type")
+    context_text = data.get("context_text")
+    model_type = data.get("model_type", config.current_model_type)
+    # 精确缓存未命中时是否先返回与上下文无关的词条（默认不返回，保持原有的结合上下文解析）
+    use_glossary = bool(data.get("glossary", False))
+    # 是否以 SSE 流式返回大模型的增量输出
+    stream = bool(data.get("stream", False))
+    
+    # 验证参数
+    if not entity_text:
+        return None, (jsonify({"error": "实体文本不能为空"}), 400)
+    if not entity_type:
+        return None, (jsonify({"error": "实体类型不能为空"}), 400)
+    if not context_text:
+        return None, (jsonify({"error": "上下文文本不能为空"}), 400)
+        
+    # 验证模型类型
+    if model_type not in ["A", "C"]:
+        return None, (jsonify({"error": f"不支持的模型类型: {model_type}"}), 400)
+        
+    # 根据模型类型选择提示词模板并填充
+    entity_type = base_entity_type(entity_type)
+    prompt = analysis_prompt(model_type, entity_text, entity_type, context_text)
+    
+    # 调用大模型API
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {config.api_key}"
+    }
+    
+    payload = {
+        "model": config.selected_model_name,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": False
+    }
+        
+    return {
+        "headers": headers,
+        "payload": payload,
+        "model_type": model_type,
+        "entity_text": entity_text,
+        "entity_type": entity_type,
+        "entity_type_desc": entity_type_description(model_type, entity_type),
+        "cache_key": entity_analysis_cache.key(model_type, entity_type, entity_text, context_text),
+        "use_glossary": use_glossary,
+        "stream": stream
+    }, None
+
+def entity_analysis_result(analysis_request, analysis, source):
+    """实体解析结果；source 为 llm（大模型生成）、cache（精确缓存）或 glossary（通用词条）"""
+    return jsonify({
+        "analysis": analysis,
+        "entity_text": analysis_request["entity_text"],
+        "entity_type": analysis_request["entity_type"],
+        "entity_type_desc": analysis_request["entity_type_desc"],
+        "source": source
+    })
+
+def cached_entity_analysis(analysis_request):
+    """依次查找精确缓存和通用词条，命中时返回 (解析内容, 来源)，否则返回 None"""
+    analysis = entity_analysis_cache.get(analysis_request["cache_key"])
+    if analysis is not None:
+        return analysis, "cache"
+    if analysis_request["use_glossary"]:
+        entry = get_glossary(
+            analysis_request["model_type"], analysis_request["entity_type"], analysis_request["entity_text"]
+        )
+        if entry is not None:
+            return entry.analysis, "glossary"
+    return None
+
+def entity_analysis_event(kind, **fields):
+    """SSE 事件（data 为 JSON，type 字段区分事件类型）"""
+    return f"data: {json.dumps(dict({'type': kind}, **fields), ensure_ascii=False)}\n\n"
+
+def entity_analysis_stream(analysis_request, cached):
+    """
+    以 SSE 流式返回实体解析：先发送 start（实体信息），大模型的每段增量发送一个 delta，
+    完成后发送 done（完整解析，同时写入精确缓存），出错时发送 error；命中缓存或词条时直接发送 done
+    客户端断开时关闭生成器，随即关闭与大模型接口的连接，停止生成
+    """
+    def generate():
+        yield entity_analysis_event(
+            "start",
+            entity_text=analysis_request["entity_text"],
+            entity_type=analysis_request["entity_type"],
+            entity_type_desc=analysis_request["entity_type_desc"]
+        )
+        if cached is not None:
+            analysis, source = cached
+            yield entity_analysis_event("done", analysis=analysis, source=source)
+            return
+
+        payload = dict(analysis_request["payload"], stream=True, stream_options={"include_usage": True})
+        pieces = []
+        response = None
+        try:
+            with track_llm_call("entity_analysis", config.selected_model_name) as call:
+                response = requests.post(
+                    config.api_endpoint,
+                    headers=analysis_request["headers"],
+                    json=payload,
+                    stream=True,
+                    timeout=config.request_timeout
+                )
+                response.raise_for_status()
+                try:
+                    for line in response.iter_lines():
+                        line = line.decode("utf-8")
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            break
+                        chunk = json.loads(data)
+                        if chunk.get("usage"):
+                            call.record(chunk["usage"])
+                        for choice in chunk.get("choices") or []:
+                            content = (choice.get("delta") or {}).get("content")
+                            if content:
+                                pieces.append(content)
+                                yield entity_analysis_event("delta", content=content)
+                except GeneratorExit:
+                    call.status = "cancelled"
+                    raise
+
+            analysis = "".join(pieces)
+            if not analysis:
+                yield entity_analysis_event("error", error="大模型返回内容为空")
+                return
+            entity_analysis_cache.put(analysis_request["cache_key"], analysis)
+            yield entity_analysis_event("done", analysis=analysis, source="llm")
+        except requests.exceptions.Timeout:
+            yield entity_analysis_event("error", error="大模型API请求超时")
+        except Exception as e:
+            logger.error(f"实体分析失败: {traceback.format_exc()}")
+            yield entity_analysis_event("error", error=f"实体分析失败: {str(e)}")
+        finally:
+            if response is not None:
+                response.close()
+            # after_request 在响应流开始前就已执行，这里自行写入本次的大模型调用记录
+            persist_pending_usage()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def entity_analysis_response(analysis_request, response_json):
+    """由大模型响应构建实体解析结果，并写入精确缓存"""
+    # 解析API响应
+    content = response_json.get('choices', [{}])[0].get('message', {}).get('content', '')
+    
+    if not content:
+        return jsonify({"error": "大模型返回内容为空"}), 500
+        
+    entity_analysis_cache.put(analysis_request["cache_key"], content)
+    return entity_analysis_result(analysis_request, content, "llm")
+
 @ner_bp.route("/ner/entity_analysis", methods=["POST"])
+@limiter.limit("20 per minute", scope="entity_analysis")
 def entity_analysis():
     """实体解析API，调用大模型解释选中的实体"""
     try:
-        # 解析请求
-        data = request.json
-        if not data:
-            return jsonify({"error": "无效的请求数据"}), 400
-            
-        # 获取参数
-        entity_text = data.get("entity_text")
-        entity_type = data.get("entity_type")
-        context_text = data.get("context_text")
-        model_type = data.get("model_type", config.current_model_type)
-        
-        # 验证参数
-        if not entity_text:
-            return jsonify({"error": "实体文本不能为空"}), 400
-        if not entity_type:
-            return jsonify({"error": "实体类型不能为空"}), 400
-        if not context_text:
-            return jsonify({"error": "上下文文本不能为空"}), 400
-            
-        # 验证模型类型
-        if model_type not in ["A", "C"]:
-            return jsonify({"error": f"不支持的模型类型: {model_type}"}), 400
-            
-        # 根据模型类型选择提示词模板
-        if model_type == "A":
-            # 历史模型的提示词
-            prompt_template = """你是古汉语领域专家，请解释以下古汉语文本中标注的实体。
-文本上下文：{context_text}
-实体：{entity_text}
-实体类型：{entity_type_desc}
-
-请根据实体类型提供详细解释，包括：
-1. 该实体在古汉语中的含义、来源和背景知识
-2. 在文本中的具体作用和意义
-3. 相关历史背景信息
-4. 如有必要，提供现代解释或对应概念
-
-请以学术严谨的态度回答，如果信息不足或有歧义，请明确指出。回答需要全面但简洁，使用通俗易懂的语言。"""
-        else:
-            # 医疗模型的提示词
-            prompt_template = """你是古代中医文献专家，请解释以下古代中医文本中标注的实体。
-文本上下文：{context_text}
-实体：{entity_text}
-实体类型：{entity_type_desc}
-
-请根据实体类型提供详细解释，包括：
-1. 该实体在中医学中的含义、功效和应用
-2. 在文本中的具体医学意义
-3. 相关中医理论背景
-4. 如有可能，提供现代医学对应的解释
-
-请以专业严谨的态度回答，如果信息不足或有歧义，请明确指出。回答需要专业且易懂，方便理解古代中医知识。"""
-            
-        # 获取实体类型中文描述
-        entity_type_desc = ""
-        if model_type == "A":
-            entity_mappings = {
-                "NR": "人名", "NS": "地名", "NB": "书名", 
-                "NO": "官职名", "NG": "国家名", "T": "时间"
-            }
-            entity_type_desc = entity_mappings.get(entity_type, entity_type)
-        else:
-            entity_mappings = {
-                "ZD": "中医疾病", "ZZ": "证候", "ZF": "中药方剂",
-                "ZP": "中药饮片", "ZS": "症状", "ZA": "穴位"
-            }
-            entity_type_desc = entity_mappings.get(entity_type, entity_type)
-            
-        # 填充提示词模板
-        prompt = prompt_template.format(
-            context_text=context_text,
-            entity_text=entity_text,
-            entity_type_desc=entity_type_desc
-        )
-        
-        # 调用大模型API
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {config.api_key}"
-        }
+        analysis_request, error_response = entity_analysis_request()
+        if error_response is not None:
+            return error_response
+        cached = cached_entity_analysis(analysis_request)
+        if analysis_request["stream"]:
+            return entity_analysis_stream(analysis_request, cached)
+        if cached is not None:
+            return entity_analysis_result(analysis_request, *cached)
         
-        payload = {
-            "model": config.selected_model_name,
-            "messages": [{"role": "user", "content": prompt}],
-            "stream": False
-        }
+        with track_llm_call("entity_analysis", config.selected_model_name) as call:
+            response = requests.post(
+                config.api_endpoint,
+                headers=analysis_request["headers"],
+                json=analysis_request["payload"],
+                timeout=config.request_timeout
+            )
+            
+            response.raise_for_status()
+            response_json = response.json()
+            call.record(response_json.get("usage"))
         
-        response = requests.post(
-            config.api_endpoint,
-            headers=headers,
-            json=payload,
-            timeout=config.request_timeout
-        )
+        return entity_analysis_response(analysis_request, response_json)
         
-        response.raise_for_status()
+    except requests.exceptions.Timeout:
+        return jsonify({"error": "大模型API请求超时"}), 504
+    except Exception as e:
+        logger.error(f"实体分析失败: {traceback.format_exc()}")
+        return jsonify({"error": f"实体分析失败: {str(e)}"}), 500
+
+async def entity_analysis_async():
+    """实体解析API 的协程版本（异步服务模式，见 async_server.py）"""
+    try:
+        analysis_request, error_response = entity_analysis_request()
+        if error_response is not None:
+            return error_response
+        cached = await run_sync(cached_entity_analysis, analysis_request)
+        if analysis_request["stream"]:
+            # 流式响应体由异步服务在单独的线程中迭代（见 async_server.AsyncApp._stream_response）
+            return entity_analysis_stream(analysis_request, cached)
+        if cached is not None:
+            return entity_analysis_result(analysis_request, *cached)
         
-        # 解析API响应
-        content = response.json().get('choices', [{}])[0].get('message', {}).get('content', '')
+        with track_llm_call("entity_analysis", config.selected_model_name) as call:
+            response = await async_llm.post_json(
+                config.api_endpoint, analysis_request["headers"], analysis_request["payload"], config.request_timeout
+            )
+            response.raise_for_status()
+            response_json = response.json()
+            call.record(response_json.get("usage"))
         
-        if not content:
-            return jsonify({"error": "大模型返回内容为空"}), 500
-            
-        return jsonify({
-            "analysis": content,
-            "entity_text": entity_text,
-            "entity_type": entity_type,
-            "entity_type_desc": entity_type_desc
-        })
+        return entity_analysis_response(analysis_request, response_json)
         
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         return jsonify({"error": "大模型API请求超时"}), 504
     except Exception as e:
         logger.error(f"实体分析失败: {traceback.format_exc()}")
         return jsonify({"error": f"实体分析失败: {str(e)}"}), 500
+
+def parse_entity_batch_request():
+    """
+    解析批量实体解析请求，返回 (参数, None) 或 (None, 错误响应)
+    请求体：{"text": 文档, "spans": [{"start", "end", "type"}], "model_type", "glossary"}，end 为实体最后一个字的位置
+    """
+    data = request.get_json(silent=True)
+    if not data:
+        return None, (jsonify({"error": "无效的请求数据"}), 400)
+    document = data.get("text")
+    spans = data.get("spans")
+    model_type = data.get("model_type", config.current_model_type)
+    if not document or not isinstance(document, str):
+        return None, (jsonify({"error": "文本不能为空"}), 400)
+    if not spans or not isinstance(spans, list):
+        return None, (jsonify({"error": "实体列表不能为空"}), 400)
+    if len(spans) > ENTITY_BATCH_MAX_SPANS:
+        return None, (jsonify({"error": f"实体数量超过上限 {ENTITY_BATCH_MAX_SPANS}"}), 400)
+    if model_type not in ["A", "C"]:
+        return None, (jsonify({"error": f"不支持的模型类型: {model_type}"}), 400)
+
+    # 按 (实体类型, 实体文本) 去重，记录每个实体在文档中的全部位置
+    entities = {}
+    for i, span in enumerate(spans):
+        try:
+            start, end, entity_type = int(span["start"]), int(span["end"]), str(span["type"])
+        except (KeyError, TypeError, ValueError):
+            return None, (jsonify({"error": f"第 {i + 1} 个实体格式无效"}), 400)
+        if not 0 <= start <= end < len(document) or not entity_type:
+            return None, (jsonify({"error": f"第 {i + 1} 个实体的位置超出文本范围"}), 400)
+        entity_type = base_entity_type(entity_type)
+        entity_text = document[start:end + 1]
+        entity = entities.get((entity_type, entity_text))
+        if entity is None:
+            context = entity_context(document, start, end)
+            entities[(entity_type, entity_text)] = entity = {
+                "entity_text": entity_text,
+                "entity_type": entity_type,
+                "entity_type_desc": entity_type_description(model_type, entity_type),
+                "context": context,
+                # 批量回答较短且只基于实体片段，单独使用 batch 键，不与单实体接口的结果混用
+                "cache_key": entity_analysis_cache.key(model_type, entity_type, entity_text, context, "batch"),
+                "spans": []
+            }
+        entity["spans"].append([start, end])
+
+    return {
+        "model_type": model_type,
+        "entities": list(entities.values()),
+        "span_count": len(spans),
+        "use_glossary": bool(data.get("glossary", True))
+    }, None
+
+def entity_batch_line(kind, entity=None, **fields):
+    """批量解析响应中的一行（NDJSON）"""
+    if entity is not None:
+        fields = dict({
+            "entity_text": entity["entity_text"],
+            "entity_type": entity["entity_type"],
+            "entity_type_desc": entity["entity_type_desc"],
+            "spans": entity["spans"]
+        }, **fields)
+    return json.dumps(dict({"type": kind}, **fields), ensure_ascii=False) + "\n"
+
+@ner_bp.route("/ner/entity_analysis/batch", methods=["POST"])
+@limiter.limit("5 per minute", scope="entity_analysis_batch")
+def entity_analysis_batch():
+    """
+    批量解析整篇文档中标注的实体，以 NDJSON 流式返回：
+    先返回一行 start，每个实体完成时返回一行 result（source 为 cache、glossary 或 llm）或 error，最后返回一行 done
+    客户端中途断开时，尚未开始的大模型调用会被取消
+    """
+    params, error_response = parse_entity_batch_request()
+    if error_response is not None:
+        return error_response
+    model_type = params["model_type"]
+    app = current_app._get_current_object()
+    api = (config.api_endpoint, config.api_key, config.selected_model_name, config.request_timeout)
+
+    def generate():
+        started = time.perf_counter()
+        counts = {"cache": 0, "glossary": 0, "llm": 0, "error": 0}
+        yield entity_batch_line("start", entities=len(params["entities"]), spans=params["span_count"])
+
+        pending = []
+        for entity in params["entities"]:
+            analysis = entity_analysis_cache.get(entity["cache_key"])
+            source = "cache"
+            if analysis is None and params["use_glossary"]:
+                entry = get_glossary(model_type, entity["entity_type"], entity["entity_text"])
+                analysis, source = (entry.analysis, "glossary") if entry is not None else (None, None)
+            if analysis is None:
+                pending.append(entity)
+                continue
+            counts[source] += 1
+            yield entity_batch_line("result", entity, analysis=analysis, source=source)
+
+        groups = plan_batches(pending)
+        batches = run_batches(app, api, model_type, groups)
+        usage = []
+        try:
+            for results, records in batches:
+                usage.extend(records)
+                for entity, analysis, error in results:
+                    if error is not None:
+                        counts["error"] += 1
+                        yield entity_batch_line("error", entity, error=error)
+                        continue
+                    counts["llm"] += 1
+                    entity_analysis_cache.put(entity["cache_key"], analysis)
+                    yield entity_batch_line("result", entity, analysis=analysis, source="llm")
+        finally:
+            batches.close()
+            # after_request 在响应流开始前就已执行，这里自行写入本次的大模型调用记录
+            usage.extend(take_usage_records())
+            if usage:
+                try:
+                    insert_usage_records(db.session.connection(), usage)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.warning(f"写入大模型调用记录失败: {str(e)}")
+        yield entity_batch_line(
+            "done", llm_calls=len(usage), elapsed_ms=round((time.perf_counter() - started) * 1000, 1), **counts
+        )
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
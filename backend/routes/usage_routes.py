@@ -0,0 +1,85 @@
+# backend/routes/usage_routes.py
+from flask import Blueprint, request, jsonify
+from datetime import datetime, timedelta
+import logging
+import math
+
+from database.models import db, LLMUsage
+from llm_usage import estimate_cost
+from routes.auth_routes import admin_required
+
+logger = logging.getLogger(__name__)
+
+usage_bp = Blueprint("usage", __name__)
+
+# 可用的分组维度
+GROUP_BY_FIELDS = ("route", "model", "day")
+# 最多可查询的天数
+USAGE_MAX_DAYS = 90
+
+
+def _percentile(sorted_values, p):
+    """最近秩法百分位数，输入需已排序"""
+    if not sorted_values:
+        return 0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+@usage_bp.route("/usage/summary", methods=["GET"])
+@admin_required
+def usage_summary(current_user):
+    """
+    按路由、模型、日期汇总大模型调用的次数、token 用量、估算费用和延迟百分位数
+    参数：days（最近几天，默认 7），group_by（逗号分隔，可选 route、model、day，默认全部）
+    """
+    days = max(1, min(request.args.get("days", 7, type=int), USAGE_MAX_DAYS))
+    group_by = [f.strip() for f in request.args.get("group_by", ",".join(GROUP_BY_FIELDS)).split(",") if f.strip()]
+    if any(f not in GROUP_BY_FIELDS for f in group_by):
+        return jsonify({"success": False, "message": f"group_by 只能包含 {', '.join(GROUP_BY_FIELDS)}"}), 400
+
+    since = datetime.utcnow() - timedelta(days=days)
+    try:
+        # 按列流式读取，避免为每行构造 ORM 对象
+        rows = db.session.query(
+            LLMUsage.created_at, LLMUsage.route, LLMUsage.model, LLMUsage.status,
+            LLMUsage.prompt_tokens, LLMUsage.completion_tokens, LLMUsage.cached_tokens, LLMUsage.latency_ms
+        ).filter(LLMUsage.created_at >= since).execution_options(yield_per=1000)
+
+        groups = {}
+        for row in rows:
+            values = {"route": row.route, "model": row.model, "day": row.created_at.date().isoformat()}
+            key = tuple(values[f] for f in group_by)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {
+                    **{f: values[f] for f in group_by},
+                    "calls": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                    "cached_tokens": 0, "cost_usd": 0.0, "latencies": []
+                }
+            group["calls"] += 1
+            group["errors"] += row.status != "ok"
+            group["prompt_tokens"] += row.prompt_tokens
+            group["completion_tokens"] += row.completion_tokens
+            group["cached_tokens"] += row.cached_tokens
+            group["cost_usd"] += estimate_cost(row.model, row.prompt_tokens, row.completion_tokens, row.cached_tokens)
+            group["latencies"].append(row.latency_ms)
+
+        summary = []
+        for key in sorted(groups):
+            group = groups[key]
+            latencies = sorted(group.pop("latencies"))
+            group["cost_usd"] = round(group["cost_usd"], 6)
+            group["cache_hit_ratio"] = round(group["cached_tokens"] / group["prompt_tokens"], 4) if group["prompt_tokens"] else 0.0
+            group["latency_ms"] = {
+                "p50": _percentile(latencies, 50),
+                "p95": _percentile(latencies, 95),
+                "p99": _percentile(latencies, 99),
+                "max": latencies[-1]
+            }
+            summary.append(group)
+
+        return jsonify({"success": True, "days": days, "group_by": group_by, "summary": summary})
+    except Exception as e:
+        logger.error(f"汇总大模型用量失败: {str(e)}")
+        return jsonify({"success": False, "message": f"汇总大模型用量失败: {str(e)}"}), 500
@@ -0,0 +1,106 @@
+# backend/text_alignment.py
+"""
+文本对齐索引：为大模型返回的实体快速定位其在原文中的位置
+
+每篇文档只构建一次，保存：
+- 原文与清理后文本（去除空白和标点）之间的偏移映射
+- 原文和清理后文本的字符 n-gram 位置倒排索引
+之后每个实体的定位只需查询倒排索引中最稀有的 n-gram 并校验少量候选位置，
+当实体在文中多次出现时选择距离提示位置最近的一处。
+"""
+import re
+from bisect import bisect_left
+
+# 与原有 clean_text 逻辑保持一致的可忽略字符
+IGNORABLE_CHARS_PATTERN = re.compile(r'[\s,.，。、；！？:;!?]')
+
+
+def clean_text(s):
+    """去除空白和标点字符"""
+    return IGNORABLE_CHARS_PATTERN.sub('', s)
+
+
+class TextAlignmentIndex:
+    """单篇文档的对齐索引，构建一次后供所有实体复用"""
+
+    def __init__(self, text, ngram_size=2):
+        self.text = text
+        self.ngram_size = ngram_size
+
+        # 清理后文本第 i 个字符在原文中的位置
+        self.cleaned_to_original = []
+        # 原文前 i 个字符清理后的长度（长度为 len(text) + 1）
+        self.original_to_cleaned = [0]
+        cleaned_chars = []
+        for i, char in enumerate(text):
+            if not IGNORABLE_CHARS_PATTERN.match(char):
+                cleaned_chars.append(char)
+                self.cleaned_to_original.append(i)
+            self.original_to_cleaned.append(len(cleaned_chars))
+        self.cleaned_text = ''.join(cleaned_chars)
+
+        self._original_grams = self._build_ngram_index(self.text)
+        self._cleaned_grams = self._build_ngram_index(self.cleaned_text)
+
+    def _build_ngram_index(self, s):
+        """构建 n-gram -> 有序位置列表 的倒排索引（同时索引单字，便于定位单字实体）"""
+        index = {}
+        for n in {1, self.ngram_size}:
+            for i in range(len(s) - n + 1):
+                index.setdefault(s[i:i + n], []).append(i)
+        return index
+
+    def _occurrences(self, s, index, target):
+        """利用最稀有的 n-gram 枚举 target 在 s 中出现的全部起始位置（升序）"""
+        n = self.ngram_size if len(target) >= self.ngram_size else 1
+
+        # 选择出现次数最少的 n-gram 作为锚点
+        best_offset, best_positions = 0, None
+        for offset in range(len(target) - n + 1):
+            positions = index.get(target[offset:offset + n])
+            if positions is None:
+                return []
+            if best_positions is None or len(positions) < len(best_positions):
+                best_offset, best_positions = offset, positions
+
+        matches = []
+        for pos in best_positions:
+            start = pos - best_offset
+            if start >= 0 and s.startswith(target, start):
+                matches.append(start)
+        return matches
+
+    @staticmethod
+    def _nearest(positions, hint):
+        """在升序位置列表中选择距离 hint 最近的位置（距离相同时取靠前者）"""
+        i = bisect_left(positions, hint)
+        candidates = positions[max(0, i - 1):i + 1]
+        return min(candidates, key=lambda p: (abs(p - hint), p))
+
+    def locate(self, target, start_hint=0):
+        """
+        定位目标字符串，返回原文中的 (start, end)，end 为最后一个字符的位置；找不到时返回 None
+        先做原文精确匹配，失败后忽略空白和标点再匹配
+        """
+        if not target:
+            return None
+
+        cleaned_target = clean_text(target)
+        if not cleaned_target:
+            return None
+
+        # 原文精确匹配
+        exact_target = target.strip()
+        matches = self._occurrences(self.text, self._original_grams, exact_target)
+        if matches:
+            start = self._nearest(matches, start_hint)
+            return start, start + len(exact_target) - 1
+
+        # 清理后匹配，并映射回原文位置
+        matches = self._occurrences(self.cleaned_text, self._cleaned_grams, cleaned_target)
+        if not matches:
+            return None
+        hint_index = min(max(0, start_hint), len(self.text))
+        cleaned_start = self._nearest(matches, self.original_to_cleaned[hint_index])
+        cleaned_end = cleaned_start + len(cleaned_target) - 1
+        return self.cleaned_to_original[cleaned_start], self.cleaned_to_original[cleaned_end]
@@ -1,15 +1,22 @@
 import os
+import logging
 from dotenv import load_dotenv
 from typing import List, Dict, Any, Tuple, Optional
 import string
+from metrics import CHAT_STAGE_SECONDS
+from llm_usage import track_llm_call
+
+logger = logging.getLogger(__name__)
 
 # 加载环境变量
 load_dotenv()
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+# 接口地址，可通过环境变量指向本地替身服务（见 benchmarks/deepseek_stub.py）
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
 
 # 验证 API 密钥是否存在
 if not DEEPSEEK_API_KEY:
-    print("警告: DEEPSEEK_API_KEY 未设置，请检查 .env 文件")
+    logger.warning("DEEPSEEK_API_KEY 未设置，请检查 .env 文件")
     DEEPSEEK_AVAILABLE = False
 else:
     try:
@@ -17,7 +24,7 @@ else:
         # 配置 DeepSeek 客户端
         deepseek_client = OpenAI(
             api_key=DEEPSEEK_API_KEY,
-            base_url="https://api.deepseek.com/v1",  # 使用 v1 路径以保持兼容性
+            base_url=DEEPSEEK_BASE_URL,  # 默认使用 v1 路径以保持兼容性
             timeout=150
         )
         # 测试连接
@@ -27,21 +34,22 @@ else:
             max_tokens=5
         )
         DEEPSEEK_AVAILABLE = True
-        print("DeepSeek API 连接测试成功")
+        logger.info("DeepSeek API 连接测试成功")
     except Exception as e:
-        print(f"DeepSeek 客户端初始化失败: {str(e)}")
+        logger.error(f"DeepSeek 客户端初始化失败: {str(e)}")
         DEEPSEEK_AVAILABLE = False
         deepseek_client = None
 
-def classify_input_complexity(query: str) -> str:
+def estimate_tokens(text: str) -> int:
     """
-    使用DeepSeek-V3模型分析查询复杂度
-    返回'easy'或'hard'
+    粗略估算文本的token数
+    DeepSeek 分词器中一个汉字约0.6个token，一个英文字符约0.3个token
     """
-    if not DEEPSEEK_AVAILABLE:
-        print("DeepSeek不可用，默认返回'hard'")
-        return "hard"
-        
+    cjk_chars = sum(1 for char in text if '\u4e00' <= char <= '\u9fff' or '\u3400' <= char <= '\u4dbf')
+    return int(cjk_chars * 0.6 + (len(text) - cjk_chars) * 0.3) + 1
+
+def classify_messages(query: str) -> List[Dict[str, str]]:
+    """构建复杂度分类请求的消息列表"""
     prompt = (
         "你是一个专门判断查询复杂度的助手。分析以下查询，判断其复杂度。\n\n"
         "判断标准：\n"
@@ -50,33 +58,73 @@ def classify_input_complexity(query: str) -> str:
         f"查询: {query}\n\n"
         "只返回'Easy'或'Hard'，不要有任何解释："
     )
+    return [
+        {'role': 'system', 'content': '你是一个严格按照规则输出的AI助手'},
+        {'role': 'user', 'content': prompt}
+    ]
+
+def parse_complexity(content: str) -> str:
+    """解析分类模型的输出，不符合预期时按'hard'处理"""
+    classification = content.strip().lower()
+    logger.debug(f"DeepSeek返回的原始分类结果: {classification}")
     
-    try:
-        print(f"开始分析查询复杂度，查询内容: {query}")  # 添加日志
-        response = deepseek_client.chat.completions.create(
-            model='deepseek-chat',
-            messages=[
-                {'role': 'system', 'content': '你是一个严格按照规则输出的AI助手'},
-                {'role': 'user', 'content': prompt}
-            ],
-            temperature=0,
-            max_tokens=5
-        )
-        classification = response.choices[0].message.content.strip().lower()
-        print(f"DeepSeek返回的原始分类结果: {classification}")  # 添加日志
+    # 严格验证返回值
+    if classification not in ['easy', 'hard']:
+        logger.warning(f"分类结果不符合预期，默认设为'hard': {classification}")
+        return 'hard'
         
-        # 严格验证返回值
-        if classification not in ['easy', 'hard']:
-            print(f"分类结果不符合预期，默认设为'hard': {classification}")  # 添加日志
-            return 'hard'
-            
-        print(f"最终确定的复杂度: {classification}")  # 添加日志
-        return classification
+    logger.debug(f"最终确定的复杂度: {classification}")
+    return classification
+
+def classify_input_complexity(query: str) -> str:
+    """
+    使用DeepSeek-V3模型分析查询复杂度
+    返回'easy'或'hard'
+    """
+    if not DEEPSEEK_AVAILABLE:
+        logger.warning("DeepSeek不可用，默认返回'hard'")
+        return "hard"
+    
+    try:
+        logger.debug(f"开始分析查询复杂度，查询内容: {query}")
+        with CHAT_STAGE_SECONDS.time(stage="classify"), track_llm_call("classify", "deepseek-chat") as call:
+            response = deepseek_client.chat.completions.create(
+                model='deepseek-chat',
+                messages=classify_messages(query),
+                temperature=0,
+                max_tokens=5
+            )
+            call.record(response.usage)
+        return parse_complexity(response.choices[0].message.content)
         
     except Exception as e:
-        print(f'分类过程发生错误: {str(e)}')  # 添加错误日志
+        logger.error(f'分类过程发生错误: {str(e)}')
         return 'hard'
 
+def traditional_culture_messages(query: str) -> List[Dict[str, str]]:
+    """构建传统文化视角分析的消息列表"""
+    prompt = f"""你现在是一个古汉语和中国传统文化专家。请分析以下问题，提供相关的见解和知识：
+
+{query}
+
+请从传统文化和古汉语的角度提供详细、准确的回答。尽量引用相关典籍和传统文化知识支持你的观点。"""
+    return [
+        {'role': 'system', 'content': '你是一个专精于古汉语和中国传统文化的AI助手'},
+        {'role': 'user', 'content': prompt}
+    ]
+
+def logical_analysis_messages(query: str) -> List[Dict[str, str]]:
+    """构建逻辑分析视角的消息列表"""
+    prompt = f"""请分析以下问题，提供详细的思考过程和逻辑推理：
+
+{query}
+
+请分步骤思考，先分析问题的关键点，然后给出清晰的解答。"""
+    return [
+        {'role': 'system', 'content': '你是一个专注于逻辑分析和推理的AI助手'},
+        {'role': 'user', 'content': prompt}
+    ]
+
 def process_with_traditional_culture_view(query: str) -> str:
     """
     使用DeepSeek-V3处理查询，提供传统文化视角的分析
@@ -85,29 +133,21 @@ def process_with_traditional_culture_view(query: str) -> str:
         return "DeepSeek模型不可用，请检查API密钥和网络连接"
     
     try:
-        # 构建提示词
-        prompt = f"""你现在是一个古汉语和中国传统文化专家。请分析以下问题，提供相关的见解和知识：
-
-{query}
-
-请从传统文化和古汉语的角度提供详细、准确的回答。尽量引用相关典籍和传统文化知识支持你的观点。"""
-        
         # 生成回答
-        response = deepseek_client.chat.completions.create(
-            model='deepseek-chat',
-            messages=[
-                {'role': 'system', 'content': '你是一个专精于古汉语和中国传统文化的AI助手'},
-                {'role': 'user', 'content': prompt}
-            ],
-            temperature=0.7,
-            max_tokens=1024
-        )
+        with CHAT_STAGE_SECONDS.time(stage="auxiliary_a"), track_llm_call("auxiliary_a", "deepseek-chat") as call:
+            response = deepseek_client.chat.completions.create(
+                model='deepseek-chat',
+                messages=traditional_culture_messages(query),
+                temperature=0.7,
+                max_tokens=1024
+            )
+            call.record(response.usage)
         
         return response.choices[0].message.content.strip()
             
     except Exception as e:
         error_msg = str(e).encode('utf-8', errors='replace').decode('utf-8')
-        print(f"传统文化视角处理错误: {error_msg}")
+        logger.error(f"传统文化视角处理错误: {error_msg}")
         return f"处理错误: {error_msg}"
 
 def process_with_deepseek(query: str) -> str:
@@ -119,26 +159,19 @@ def process_with_deepseek(query: str) -> str:
         return "DeepSeek模型不可用，请检查API密钥和网络连接"
         
     try:
-        prompt = f"""请分析以下问题，提供详细的思考过程和逻辑推理：
-
-{query}
-
-请分步骤思考，先分析问题的关键点，然后给出清晰的解答。"""
-        
-        response = deepseek_client.chat.completions.create(
-            model='deepseek-chat',  # DeepSeek-V3模型
-            messages=[
-                {'role': 'system', 'content': '你是一个专注于逻辑分析和推理的AI助手'},
-                {'role': 'user', 'content': prompt}
-            ],
-            temperature=0.7,
-            max_tokens=1024
-        )
+        with CHAT_STAGE_SECONDS.time(stage="auxiliary_b"), track_llm_call("auxiliary_b", "deepseek-chat") as call:
+            response = deepseek_client.chat.completions.create(
+                model='deepseek-chat',  # DeepSeek-V3模型
+                messages=logical_analysis_messages(query),
+                temperature=0.7,
+                max_tokens=1024
+            )
+            call.record(response.usage)
         
         return response.choices[0].message.content.strip()
     except Exception as e:
         error_msg = str(e).encode('utf-8', errors='replace').decode('utf-8')
-        print(f"DeepSeek模型处理错误: {error_msg}")
+        logger.error(f"DeepSeek模型处理错误: {error_msg}")
         return f"DeepSeek模型处理错误: {error_msg}"
 
 def create_combined_prompt(query: str, traditional_culture_response: str, deepseek_response: str) -> str:
@@ -1,8 +1,18 @@
 import { createApp } from "vue";
+import axios from "axios";
 import App from "./App.vue";
 import router from "./router"; // 导入路由实例
 import "./assets/global.css"; // 导入全局CSS样式
 
+// 为所有请求附带登录token，后端据此区分会话归属
+axios.interceptors.request.use((config) => {
+  const token = localStorage.getItem("token");
+  if (token) {
+    config.headers.Authorization = `Bearer ${token}`;
+  }
+  return config;
+});
+
 const app = createApp(App);
 app.use(router); // 使用路由实例
 app.mount("#app");
\ No newline at end of file
@@ -5,6 +5,7 @@ from torch.utils.data import Dataset
 from sklearn.model_selection import train_test_split
 from transformers import BertTokenizerFast
 from collections import Counter
+from ner_token_cache import PreTokenizedDataset, load_or_build_cache
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -111,8 +112,14 @@ class NERDataset(Dataset):
         }
 
 
-def prepare_datasets(data_path, tokenizer, test_size=0.2):
-    """数据准备"""
+def prepare_datasets(data_path, tokenizer, test_size=0.2, cache_dir=None):
+    """
+    数据准备
+    指定 cache_dir 时语料只分词一次并缓存（见 ner_token_cache），返回不做填充的 PreTokenizedDataset，
+    需配合 ner_token_cache.create_dataloader 按长度分桶、动态填充；划分结果与不使用缓存时相同
+    """
+    if cache_dir is not None:
+        return prepare_cached_datasets(data_path, tokenizer, test_size, cache_dir)
     sequences, labels = read_file(data_path)
     train_seq, val_seq, train_lbl, val_lbl = train_test_split(
         sequences, labels, test_size=test_size, random_state=42, shuffle=True
@@ -128,3 +135,21 @@ def prepare_datasets(data_path, tokenizer, test_size=0.2):
         NERDataset(val_seq, val_lbl, tokenizer),
     )
 
+
+def prepare_cached_datasets(data_path, tokenizer, test_size=0.2, cache_dir=".ner_cache", max_len=512):
+    """使用预分词缓存的数据准备：按样本下标划分（与直接划分样本的结果一致）"""
+    cache_path = load_or_build_cache(data_path, tokenizer, generate_label_map(), read_file, cache_dir, max_len)
+    corpus = PreTokenizedDataset(cache_path)
+    train_idx, val_idx = train_test_split(
+        list(range(len(corpus))), test_size=test_size, random_state=42, shuffle=True
+    )
+    train_dataset = PreTokenizedDataset(cache_path, train_idx)
+    val_dataset = PreTokenizedDataset(cache_path, val_idx)
+    logger.info(f"数据集划分结果：\n"
+                f"- 总序列数：{len(corpus)}\n"
+                f"- 训练集序列数：{len(train_dataset)}\n"
+                f"- 验证集序列数：{len(val_dataset)}\n"
+                f"- 平均长度：{corpus.lengths.mean():.1f}（原先一律填充到 {max_len}）")
+    print("训练集标签分布:", Counter(train_dataset.label_counts()))
+    print("验证集标签分布:", Counter(val_dataset.label_counts()))
+    return train_dataset, val_dataset
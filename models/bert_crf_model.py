@@ -1,4 +1,5 @@
 from transformers import BertPreTrainedModel, BertModel
+import torch
 import torch.nn as nn
 from torchcrf import CRF
 
@@ -19,16 +20,56 @@ class BERT_CRF(BertPreTrainedModel):
         self.init_weights()
 
 
-    def forward(self, input_ids, attention_mask=None, labels=None):
+    def compute_emissions(self, input_ids, attention_mask=None):
+        """BERT编码并计算发射分数"""
         # BERT编码 (后续的 BERT 层 *需要* attention_mask 参数)
         outputs = self.bert(input_ids, attention_mask=attention_mask)  # BERT 模型整体 forward  *需要* attention_mask
         sequence_output = outputs.last_hidden_state
         sequence_output = self.dropout(sequence_output)
-        emissions = self.classifier(sequence_output)
+        return self.classifier(sequence_output)
+
+    def decode(self, emissions, mask=None):
+        """CRF维特比解码"""
+        return self.crf.decode(emissions, mask=mask)
+
+    def marginals(self, emissions, mask=None):
+        """
+        CRF前向-后向算法，按批次向量化计算每个位置各标签的边缘概率
+        emissions: (batch, seq_len, num_labels)；mask: (batch, seq_len)，填充须在序列右侧（与 torchcrf 相同）
+        返回 (batch, seq_len, num_labels)，填充位置为 0
+        """
+        if mask is None:
+            mask = emissions.new_ones(emissions.shape[:2], dtype=torch.bool)
+        mask = mask.bool()
+        batch_size, seq_len, num_labels = emissions.shape
+        transitions = self.crf.transitions.unsqueeze(0)  # (1, 上一标签, 当前标签)
+        end = self.crf.end_transitions.unsqueeze(0).expand(batch_size, num_labels)
+
+        # 前向：alpha[t][b, j] = 以标签 j 结束于位置 t 的全部路径的对数分数；填充位置沿用上一位置的值
+        alphas = [self.crf.start_transitions.unsqueeze(0) + emissions[:, 0]]
+        for t in range(1, seq_len):
+            step = torch.logsumexp(alphas[-1].unsqueeze(2) + transitions, dim=1) + emissions[:, t]
+            alphas.append(torch.where(mask[:, t].unsqueeze(1), step, alphas[-1]))
+
+        # 后向：beta[t][b, i] = 位置 t 取标签 i 时其后全部路径（含结束转移）的对数分数
+        betas = [end]
+        for t in range(seq_len - 2, -1, -1):
+            step = torch.logsumexp(transitions + (emissions[:, t + 1] + betas[-1]).unsqueeze(1), dim=2)
+            betas.append(torch.where(mask[:, t + 1].unsqueeze(1), step, end))
+
+        alpha = torch.stack(alphas, dim=1)
+        beta = torch.stack(betas[::-1], dim=1)
+        # 填充位置沿用了前一位置的 alpha，最后一个位置即为每条序列末尾的 alpha
+        log_partition = torch.logsumexp(alphas[-1] + end, dim=1)
+        probs = torch.exp(alpha + beta - log_partition.view(-1, 1, 1))
+        return probs * mask.unsqueeze(2).to(probs.dtype)
+
+    def forward(self, input_ids, attention_mask=None, labels=None):
+        emissions = self.compute_emissions(input_ids, attention_mask=attention_mask)
 
         # CRF处理
         mask = attention_mask.bool() if attention_mask is not None else None
-        tags = self.crf.decode(emissions, mask=mask)
+        tags = self.decode(emissions, mask=mask)
 
         loss = None
         if labels is not None:
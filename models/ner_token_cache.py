@@ -0,0 +1,264 @@
+# ner_token_cache.py
+"""
+训练数据的预分词缓存、按长度分桶的采样器和动态填充
+
+NERDataset 每个 epoch 都对每条样本重新分词，并且一律填充到 512；古文句子大多很短，
+训练的大部分算力花在填充上，大部分 CPU 花在分词器上。这里：
+
+- 语料只分词一次，结果以 NumPy 数组保存并用内存映射读取：
+  input_ids.npy、labels.npy、word_starts.npy 为全部样本首尾相接的一维数组，lengths.npy 为每条样本的长度（含 [CLS]/[SEP]）
+- 缓存目录名为缓存键：数据文件内容、分词器（类型、名称、词表）、标签映射、最大长度和缓存格式版本的哈希，
+  任何一项变化都会生成新的缓存，旧目录可以直接删除
+- LengthBucketSampler 把长度相近的样本放进同一批，DynamicPaddingCollator 只把每批填充到其中最长的样本
+
+用法：
+    train_dataset, val_dataset = prepare_datasets(data_path, tokenizer, cache_dir="data/.ner_cache")
+    train_loader = create_dataloader(train_dataset, batch_size=32, pad_token_id=tokenizer.pad_token_id, shuffle=True)
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 2
+# 每次交给分词器的样本数
+TOKENIZE_CHUNK_SIZE = 1000
+CACHE_ARRAYS = ("input_ids", "labels", "word_starts", "lengths")
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """分词器的标识：类型、名称、是否小写和词表内容的哈希"""
+    vocab = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    return {
+        "class": type(tokenizer).__name__,
+        "name_or_path": getattr(tokenizer, "name_or_path", ""),
+        "do_lower_case": getattr(tokenizer, "do_lower_case", None),
+        "vocab": hashlib.sha256(vocab.encode("utf-8")).hexdigest()
+    }
+
+
+def cache_key(data_path, tokenizer, label_map, max_len):
+    """计算缓存键，返回 (键, 参与计算的内容)"""
+    meta = {
+        "version": CACHE_FORMAT_VERSION,
+        "data": _file_digest(data_path),
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "label_map": label_map,
+        "max_len": max_len
+    }
+    key = hashlib.sha256(json.dumps(meta, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return key, meta
+
+
+def tokenize_corpus(sequences, labels, tokenizer, max_len=512):
+    """
+    对全部样本分词并对齐标签（特殊符号的标签为 0，同一个字拆出的子词沿用该字的标签），
+    返回 (input_ids, labels, word_starts, lengths) 四个数组，word_starts 标记每个字的第一个子词
+    """
+    all_ids = []
+    all_labels = []
+    all_starts = []
+    lengths = np.zeros(len(sequences), dtype=np.int32)
+    for chunk_start in range(0, len(sequences), TOKENIZE_CHUNK_SIZE):
+        chunk = sequences[chunk_start:chunk_start + TOKENIZE_CHUNK_SIZE]
+        encoding = tokenizer(chunk, is_split_into_words=True, truncation=True, max_length=max_len)
+        for i, input_ids in enumerate(encoding["input_ids"]):
+            idx = chunk_start + i
+            word_labels = labels[idx]
+            word_ids = encoding.word_ids(i)
+            aligned_labels = [0 if word_id is None else word_labels[word_id] for word_id in word_ids]
+            word_starts = [
+                word_id is not None and (j == 0 or word_ids[j - 1] != word_id) for j, word_id in enumerate(word_ids)
+            ]
+            all_ids.append(np.asarray(input_ids, dtype=np.int32))
+            all_labels.append(np.asarray(aligned_labels, dtype=np.int16))
+            all_starts.append(np.asarray(word_starts, dtype=bool))
+            lengths[idx] = len(input_ids)
+    empty_ids = np.zeros(0, dtype=np.int32)
+    empty_labels = np.zeros(0, dtype=np.int16)
+    return (
+        np.concatenate(all_ids) if all_ids else empty_ids,
+        np.concatenate(all_labels) if all_labels else empty_labels,
+        np.concatenate(all_starts) if all_starts else np.zeros(0, dtype=bool),
+        lengths
+    )
+
+
+def load_or_build_cache(data_path, tokenizer, label_map, read_fn, cache_dir, max_len=512):
+    """
+    返回数据文件的预分词缓存目录，缓存不存在时调用 read_fn(data_path) 读取 (sequences, labels) 并分词写入
+    写入先在临时目录完成再改名，中断不会留下不完整的缓存
+    """
+    key, meta = cache_key(data_path, tokenizer, label_map, max_len)
+    path = os.path.join(cache_dir, key)
+    if os.path.isfile(os.path.join(path, "meta.json")):
+        logger.info(f"使用预分词缓存：{path}")
+        return path
+
+    sequences, labels = read_fn(data_path)
+    assert len(sequences) == len(labels), "数据标签数量不匹配"
+    arrays = tokenize_corpus(sequences, labels, tokenizer, max_len)
+    lengths = arrays[-1]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in zip(CACHE_ARRAYS, arrays):
+        np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+    meta.update(num_examples=len(lengths), num_tokens=int(lengths.sum()))
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # 其他进程已经写入了同一个缓存
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    logger.info(f"已写入预分词缓存：{path}（{len(lengths)} 条样本，{int(lengths.sum())} 个 token）")
+    return path
+
+
+class PreTokenizedDataset(Dataset):
+    """从预分词缓存读取样本（内存映射），indices 为该数据集使用的样本下标；样本不做填充"""
+
+    def __init__(self, cache_path, indices=None):
+        self.cache_path = cache_path
+        lengths = np.load(os.path.join(cache_path, "lengths.npy"))
+        self.offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.indices = np.arange(len(lengths)) if indices is None else np.asarray(indices, dtype=np.int64)
+        self.lengths = lengths[self.indices]
+        self._arrays = None
+
+    def _open(self):
+        # 在使用时才打开内存映射：DataLoader 的工作进程各自打开，不会把整个数组序列化过去
+        if self._arrays is None:
+            self._arrays = tuple(
+                np.load(os.path.join(self.cache_path, f"{name}.npy"), mmap_mode="r")
+                for name in CACHE_ARRAYS[:3]
+            )
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        input_ids, labels, _ = self._open()
+        example = self.indices[idx]
+        start, end = self.offsets[example], self.offsets[example + 1]
+        return {
+            "input_ids": torch.from_numpy(input_ids[start:end].astype(np.int64)),
+            "labels": torch.from_numpy(labels[start:end].astype(np.int64))
+        }
+
+    def label_counts(self):
+        """各标签的出现次数，只统计每个字的第一个子词，对应原始语料中每个字的标签（被截断的字除外）"""
+        _, labels, word_starts = self._open()
+        mask = np.zeros(len(labels), dtype=bool)
+        for example in self.indices:
+            mask[self.offsets[example]:self.offsets[example + 1]] = True
+        mask &= word_starts
+        return {label: int(count) for label, count in enumerate(np.bincount(labels[mask])) if count}
+
+
+class LengthBucketSampler(Sampler):
+    """
+    按长度分桶的批采样器（作为 DataLoader 的 batch_sampler）
+    打乱时先随机打乱全部样本，每 bucket_batches 个批次的样本为一个桶，桶内按长度排序后切成批次，
+    最后打乱批次顺序；不打乱时（验证集）直接按长度排序切分。每个 epoch 前调用 set_epoch 改变打乱顺序
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_batches=50, drop_last=False, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_batches = bucket_batches
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind="stable")
+            return [order[i:i + self.batch_size].tolist() for i in range(0, len(order), self.batch_size)]
+
+        rng = random.Random(self.seed + self.epoch)
+        order = list(range(len(self.lengths)))
+        rng.shuffle(order)
+        bucket_size = self.batch_size * self.bucket_batches
+        batches = []
+        for bucket_start in range(0, len(order), bucket_size):
+            bucket = sorted(order[bucket_start:bucket_start + bucket_size], key=lambda i: self.lengths[i])
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        for batch in self._batches():
+            if self.drop_last and len(batch) < self.batch_size:
+                continue
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            # 分桶后不足一批的可能不止最后一批，这里按实际批次计数
+            return sum(1 for _ in self)
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+
+class DynamicPaddingCollator:
+    """把一批样本填充到其中最长的长度（可选向上取整到 pad_to_multiple_of），标签填充为 0（CRF要求）"""
+
+    def __init__(self, pad_token_id, pad_to_multiple_of=None):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, examples):
+        max_len = max(len(example["input_ids"]) for example in examples)
+        if self.pad_to_multiple_of:
+            max_len = math.ceil(max_len / self.pad_to_multiple_of) * self.pad_to_multiple_of
+        input_ids = torch.full((len(examples), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(examples), max_len), dtype=torch.long)
+        labels = torch.zeros((len(examples), max_len), dtype=torch.long)
+        for i, example in enumerate(examples):
+            length = len(example["input_ids"])
+            input_ids[i, :length] = example["input_ids"]
+            attention_mask[i, :length] = 1
+            labels[i, :length] = example["labels"]
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+def create_dataloader(dataset, batch_size, pad_token_id, shuffle=False, pad_to_multiple_of=None, **kwargs):
+    """为预分词数据集创建按长度分桶、动态填充的 DataLoader；其他参数（num_workers 等）传给 DataLoader"""
+    sampler = LengthBucketSampler(dataset.lengths, batch_size, shuffle=shuffle)
+    return DataLoader(
+        dataset,
+        batch_sampler=sampler,
+        collate_fn=DynamicPaddingCollator(pad_token_id, pad_to_multiple_of),
+        **kwargs
+    )